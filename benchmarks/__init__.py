@@ -0,0 +1,7 @@
+import os
+
+import django
+
+# everything under webhooks reads settings on import
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "line_bot.settings")
+django.setup()
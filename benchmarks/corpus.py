@@ -0,0 +1,56 @@
+# coding=utf-8
+# Messages and postbacks the way users actually send them, shared by the
+# benchmarks and the load harness.
+
+TEXT_MESSAGES = [
+    "30度C溫度",
+    "溫度 100F",
+    "今天外面華氏98度 溫度是多少",
+    "攝氏25溫度",
+    "溫度 -5c",
+    "what is 72F in 溫度",
+    "溫度 37 C please",
+    "10公里轉英里",
+    "100 USD to TWD",
+    "換算 5 kg 3 lb 2.5 oz",
+    "USD 100 50 EUR 轉 台幣",
+    "台灣時間轉換日本",
+    "LA時間轉換台灣",
+    "日本大阪時間轉換美國洛杉磯",
+    "Taipei 時間轉換 LA",
+    "美國時間轉換台灣",
+    "提醒 明天早上九點開會",
+    "提醒我下午三點拿包裹",
+    "提醒 call mom tonight",
+    "提醒 weekly report due Friday",
+]
+
+# messages no intent claims, the parser raises KeyError for them
+UNROUTED_MESSAGES = ["hello", "哈囉大家好", "ok 👍", "where is the meeting?"]
+
+POSTBACKS = [
+    (
+        "type=reminder&action=choose_date&tz=Asia/Taipei&text=提醒 明天早上九點開會",
+        None,
+    ),
+    (
+        "type=reminder&action=choose_date&tz=America/Los_Angeles&text=提醒 call mom tonight",
+        None,
+    ),
+    (
+        "type=reminder&action=add_to_reminder&tz=Asia/Taipei&text=提醒 明天早上九點開會",
+        {"datetime": "2030-01-02T09:00"},
+    ),
+    (
+        "type=reminder&action=add_to_reminder&tz=Asia/Tokyo&text=提醒我下午三點拿包裹",
+        {"datetime": "2030-01-02T15:00"},
+    ),
+    (
+        "type=date_convert&action=choose&from_country=台灣&to_country=日本&from_tz=Asia/Taipei&to_tz=Asia/Tokyo",
+        {"datetime": "2030-01-02T09:00"},
+    ),
+    (
+        "type=date_convert&action=choose&from_country=LA&to_country=台灣&from_tz=America/Los_Angeles&to_tz=Asia/Taipei",
+        {"datetime": "2030-01-02T18:30"},
+    ),
+]
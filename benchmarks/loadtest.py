@@ -0,0 +1,563 @@
+"""
+End-to-end load harness. Generates correctly signed webhook batches, replays
+them against the callback at a fixed rate or a multiple of the recorded
+speed, and reads back from a stub LINE API what the bot replied and pushed.
+
+    python -m benchmarks.loadtest generate --events 5000 --rate 50 --out trace.jsonl
+    python -m benchmarks.loadtest replay trace.jsonl --speed 2 --procfile
+    python -m benchmarks.loadtest saturate --start-rate 20 --step 20 --procfile
+    python -m benchmarks.loadtest compare trace.jsonl --rate 100 --stub-latency 0.2
+
+With --procfile the web and worker processes from the Procfile are started
+against the stub, otherwise the stack at --url has to be running with
+LINE_API_ENDPOINT pointing at --stub-port and LINE_BOT_HANDLER at --secret.
+A trace is one json object per line, {"offset": seconds, "body": webhook};
+reply tokens and timestamps are rewritten on replay. --server async swaps
+the web process for the aiohttp front end, compare replays the same trace
+against each server in turn.
+"""
+
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import requests
+
+from benchmarks.corpus import POSTBACKS, TEXT_MESSAGES
+from benchmarks.stub_server import StubServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROCESSES = ("web", "worker")
+
+# web commands replacing the Procfile's, None keeps it
+SERVERS = {
+    "sync": None,
+    "async": "gunicorn line_bot.aio:app --worker-class aiohttp.GunicornWebWorker",
+}
+REMINDER_MARK = "loadtest-reminder-"
+
+
+def sign(secret, body):
+    digest = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("utf-8")
+
+
+def make_source(rng, group_share):
+    user_id = "U{:032x}".format(rng.getrandbits(128))
+    roll = rng.random()
+    if roll < group_share / 2:
+        return {
+            "type": "group",
+            "groupId": "C{:032x}".format(rng.getrandbits(20)),
+            "userId": user_id,
+        }
+    if roll < group_share:
+        return {
+            "type": "room",
+            "roomId": "R{:032x}".format(rng.getrandbits(20)),
+            "userId": user_id,
+        }
+    return {"type": "user", "userId": user_id}
+
+
+def make_event(rng, postback_share, reminder_share, group_share):
+    event = {"replyToken": "", "timestamp": 0, "source": make_source(rng, group_share)}
+    roll = rng.random()
+    if roll < reminder_share:
+        # the due time is filled in on replay, relative to when it is sent
+        event["type"] = "postback"
+        event["postback"] = {
+            "data": "type=reminder&action=add_to_reminder&tz=UTC&text={}".format(
+                REMINDER_MARK
+            ),
+            "params": {"datetime": ""},
+        }
+    elif roll < reminder_share + postback_share:
+        data, params = rng.choice(POSTBACKS)
+        event["type"] = "postback"
+        event["postback"] = {"data": data}
+        if params:
+            event["postback"]["params"] = params
+    else:
+        event["type"] = "message"
+        event["message"] = {
+            "type": "text",
+            "id": "0",
+            "text": rng.choice(TEXT_MESSAGES),
+        }
+    return event
+
+
+def generate(args):
+    rng = random.Random(args.seed)
+    offset = 0.0
+    written = 0
+    with open(args.out, "w") as output:
+        while written < args.events:
+            # poisson arrivals at the requested rate of webhook requests
+            offset += rng.expovariate(args.rate)
+            size = min(args.events - written, rng.randint(1, args.batch_max))
+            events = [
+                make_event(
+                    rng, args.postback_share, args.reminder_share, args.group_share
+                )
+                for _ in range(size)
+            ]
+            output.write(
+                json.dumps(
+                    {
+                        "offset": offset,
+                        "body": {"destination": "Uloadtest", "events": events},
+                    }
+                )
+                + "\n"
+            )
+            written += size
+    print("wrote {} events to {}".format(written, args.out))
+
+
+def load_trace(path):
+    with open(path) as trace:
+        return [json.loads(line) for line in trace if line.strip()]
+
+
+class Replayer(object):
+    def __init__(self, url, secret, concurrency):
+        self.url = url
+        self.secret = secret
+        self.pool = ThreadPoolExecutor(max_workers=concurrency)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.results = []
+        self.tokens = {}
+        self.reminders = {}
+
+    @property
+    def session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def prepare(self, body):
+        now = time.time()
+        for event in body["events"]:
+            event["timestamp"] = int(now * 1000)
+            event["replyToken"] = uuid.uuid4().hex
+            postback = event.get("postback", {})
+            if postback.get("data", "").endswith(REMINDER_MARK):
+                # minute precision is all the date picker gives, due next minute
+                due = datetime.utcfromtimestamp(now).replace(second=0, microsecond=0)
+                due += timedelta(minutes=1)
+                text = REMINDER_MARK + uuid.uuid4().hex[:12]
+                postback["data"] = postback["data"][: -len(REMINDER_MARK)] + text
+                postback["params"]["datetime"] = due.strftime("%Y-%m-%dT%H:%M")
+                self.reminders[text] = (due - datetime(1970, 1, 1)).total_seconds()
+        return body
+
+    def send(self, body):
+        payload = json.dumps(body).encode("utf-8")
+        headers = {
+            "Content-Type": "application/json",
+            "X-Line-Signature": sign(self.secret, payload),
+        }
+        started = time.time()
+        for event in body["events"]:
+            self.tokens[event["replyToken"]] = started
+        try:
+            status = self.session.post(
+                self.url, data=payload, headers=headers, timeout=30
+            ).status_code
+        except requests.RequestException:
+            status = None
+        with self.lock:
+            self.results.append(
+                (started, time.time() - started, status, len(body["events"]))
+            )
+
+    def replay(self, bodies, offsets):
+        started = time.time()
+        futures = []
+        for body, offset in zip(bodies, offsets):
+            delay = started + offset - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(self.pool.submit(self.send, self.prepare(body)))
+        for future in futures:
+            future.result()
+        return time.time() - started
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(replayer, calls, duration):
+    latencies = [latency for _, latency, status, _ in replayer.results if status == 200]
+    errors = sum(1 for _, _, status, _ in replayer.results if status != 200)
+    events = sum(size for _, _, _, size in replayer.results)
+
+    reply_delays = []
+    throttled = 0
+    for call in calls:
+        if call["status"] != 200:
+            throttled += 1
+            continue
+        if call["kind"] == "reply":
+            sent = replayer.tokens.get(call["body"].get("replyToken"))
+            if sent is not None:
+                reply_delays.append(call["at"] - sent)
+
+    firing = []
+    for call in calls:
+        if call["status"] != 200 or call["kind"] not in ("push", "multicast"):
+            continue
+        for message in call["body"].get("messages", []):
+            text = message.get("text", "")
+            start = text.find(REMINDER_MARK)
+            if start != -1:
+                due = replayer.reminders.get(
+                    text[start : start + len(REMINDER_MARK) + 12]
+                )
+                if due is not None:
+                    firing.append(call["at"] - due)
+
+    summary = {
+        "requests": len(replayer.results),
+        "events": events,
+        "errors": errors,
+        "duration": duration,
+        "throughput_rps": len(replayer.results) / duration if duration else 0.0,
+        "callback_p50": percentile(latencies, 0.5),
+        "callback_p99": percentile(latencies, 0.99),
+        "replies": len(reply_delays),
+        "reply_p50": percentile(reply_delays, 0.5),
+        "reply_p99": percentile(reply_delays, 0.99),
+        "throttled_calls": throttled,
+        "reminders_scheduled": len(replayer.reminders),
+        "reminders_fired": len(firing),
+        "firing_lag_p50": percentile(firing, 0.5),
+        "firing_lag_max": max(firing) if firing else float("nan"),
+    }
+    return summary
+
+
+def print_summary(summary):
+    print(
+        "{requests} requests / {events} events in {duration:.1f}s "
+        "({throughput_rps:.1f} req/s), {errors} errors".format(**summary)
+    )
+    print(
+        "callback latency p50 {callback_p50:.3f}s p99 {callback_p99:.3f}s".format(
+            **summary
+        )
+    )
+    print(
+        "time until reply p50 {reply_p50:.3f}s p99 {reply_p99:.3f}s "
+        "({replies} replies, {throttled_calls} throttled calls)".format(**summary)
+    )
+    print(
+        "reminders fired {reminders_fired}/{reminders_scheduled}, lag after due "
+        "p50 {firing_lag_p50:.3f}s max {firing_lag_max:.3f}s".format(**summary)
+    )
+
+
+class Stack(object):
+    """Runs the Procfile processes against the stub API."""
+
+    def __init__(self, port, endpoint, secret, web=None):
+        self.port = port
+        self.web = web
+        self.env = dict(
+            os.environ,
+            PORT=str(port),
+            LINE_API_ENDPOINT=endpoint,
+            LINE_BOT_HANDLER=secret,
+            LINE_BOT_API=os.environ.get("LINE_BOT_API", "loadtest"),
+        )
+        self.processes = []
+
+    def __enter__(self):
+        with open(os.path.join(ROOT, "Procfile")) as procfile:
+            for line in procfile:
+                if ":" not in line:
+                    continue
+                name, command = line.split(":", 1)
+                name = name.strip()
+                # the single pool worker already takes every queue
+                if name not in PROCESSES:
+                    continue
+                if name == "web" and self.web:
+                    command = self.web
+                self.processes.append(
+                    subprocess.Popen(
+                        shlex.split(command.strip()),
+                        cwd=ROOT,
+                        env=self.env,
+                        preexec_fn=os.setsid,
+                    )
+                )
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                return self
+            except socket.error:
+                time.sleep(0.2)
+        self.__exit__()
+        raise RuntimeError(
+            "the web process did not start listening on {}".format(self.port)
+        )
+
+    def __exit__(self, *exc_info):
+        for process in self.processes:
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for process in self.processes:
+            process.wait()
+
+
+def with_stack(args, run):
+    stub = StubServer(
+        ("127.0.0.1", args.stub_port), args.stub_latency, args.stub_throttle
+    ).start()
+    try:
+        if args.procfile:
+            port = int(args.url.split(":")[2].split("/")[0])
+            with Stack(port, stub.endpoint, args.secret, SERVERS[args.server]):
+                return run(stub)
+        return run(stub)
+    finally:
+        stub.shutdown()
+
+
+def get_offsets(args, trace):
+    if args.rate:
+        return [index / args.rate for index in range(len(trace))]
+    return [entry["offset"] / args.speed for entry in trace]
+
+
+def replay_trace(args, trace, offsets, stub):
+    # bodies are rewritten while sending, every run gets its own copy
+    bodies = [json.loads(json.dumps(entry["body"])) for entry in trace]
+    replayer = Replayer(args.url, args.secret, args.concurrency)
+    duration = replayer.replay(bodies, offsets)
+    if replayer.reminders:
+        # everything is due within the next minute after the last send
+        time.sleep(args.reminder_wait)
+    else:
+        time.sleep(args.settle)
+    summary = summarize(replayer, stub.state.snapshot(), duration)
+    print_summary(summary)
+    return summary
+
+
+def replay(args):
+    trace = load_trace(args.trace)
+    offsets = get_offsets(args, trace)
+    summary = with_stack(args, lambda stub: replay_trace(args, trace, offsets, stub))
+    if args.save:
+        with open(args.save, "w") as output:
+            json.dump(summary, output, indent=2, sort_keys=True)
+
+
+def saturate(args):
+    rng = random.Random(args.seed)
+
+    def run(stub):
+        best = None
+        rate = args.start_rate
+        while rate <= args.max_rate:
+            count = int(rate * args.duration)
+            bodies = [
+                {
+                    "destination": "Uloadtest",
+                    "events": [
+                        make_event(rng, args.postback_share, 0.0, args.group_share)
+                        for _ in range(rng.randint(1, args.batch_max))
+                    ],
+                }
+                for _ in range(count)
+            ]
+            stub.state.reset()
+            replayer = Replayer(args.url, args.secret, args.concurrency)
+            duration = replayer.replay(
+                bodies, [index / float(rate) for index in range(count)]
+            )
+            time.sleep(args.settle)
+            summary = summarize(replayer, stub.state.snapshot(), duration)
+            healthy = (
+                summary["errors"] <= count * 0.01
+                and summary["callback_p99"] <= args.max_p99
+                and summary["throughput_rps"] >= rate * 0.9
+            )
+            print(
+                "target {:>6.1f} req/s: achieved {:>6.1f} req/s, p99 {:.3f}s, "
+                "{} errors {}".format(
+                    rate,
+                    summary["throughput_rps"],
+                    summary["callback_p99"],
+                    summary["errors"],
+                    "" if healthy else "<- saturated",
+                )
+            )
+            if not healthy:
+                break
+            best = summary
+            rate += args.step
+
+        if best:
+            print(
+                "sustained {:.1f} req/s before saturating".format(
+                    best["throughput_rps"]
+                )
+            )
+        return best
+
+    with_stack(args, run)
+
+
+COMPARED = [
+    ("throughput_rps", "req/s", "{:.1f}"),
+    ("errors", "errors", "{}"),
+    ("callback_p50", "callback p50", "{:.3f}s"),
+    ("callback_p99", "callback p99", "{:.3f}s"),
+    ("reply_p50", "reply p50", "{:.3f}s"),
+    ("reply_p99", "reply p99", "{:.3f}s"),
+    ("replies", "replies", "{}"),
+]
+
+
+def compare(args):
+    trace = load_trace(args.trace)
+    offsets = get_offsets(args, trace)
+    args.procfile = True
+    summaries = []
+    for server in args.servers:
+        print("== {} ==".format(server))
+        args.server = server
+        summaries.append(
+            with_stack(args, lambda stub: replay_trace(args, trace, offsets, stub))
+        )
+
+    print()
+    print("{:<14}".format("") + "".join("{:>12}".format(s) for s in args.servers))
+    for key, label, template in COMPARED:
+        print(
+            "{:<14}".format(label)
+            + "".join(
+                "{:>12}".format(template.format(summary[key])) for summary in summaries
+            )
+        )
+    if args.save:
+        with open(args.save, "w") as output:
+            json.dump(
+                dict(zip(args.servers, summaries)), output, indent=2, sort_keys=True
+            )
+
+
+def add_common(parser):
+    parser.add_argument("--url", default="http://127.0.0.1:8000/webhooks/callback")
+    parser.add_argument(
+        "--secret", default=os.environ.get("LINE_BOT_HANDLER") or "loadtest"
+    )
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--stub-port", type=int, default=8081)
+    parser.add_argument("--stub-latency", type=float, default=0.0)
+    parser.add_argument("--stub-throttle", type=float, default=0.0)
+    parser.add_argument(
+        "--procfile", action="store_true", help="start the Procfile processes"
+    )
+    parser.add_argument(
+        "--server", choices=sorted(SERVERS), default="sync", help="web process"
+    )
+    parser.add_argument(
+        "--settle", type=float, default=5.0, help="wait for queued replies"
+    )
+
+
+def add_replay(parser):
+    parser.add_argument("trace")
+    speed = parser.add_mutually_exclusive_group()
+    speed.add_argument(
+        "--speed", type=float, default=1.0, help="multiple of recorded speed"
+    )
+    speed.add_argument("--rate", type=float, help="fixed requests per second")
+    parser.add_argument("--reminder-wait", type=float, default=75.0)
+    parser.add_argument("--save")
+    add_common(parser)
+
+
+def add_mix(parser):
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--batch-max", type=int, default=5)
+    parser.add_argument("--postback-share", type=float, default=0.3)
+    parser.add_argument("--group-share", type=float, default=0.3)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command")
+
+    generate_parser = commands.add_parser("generate")
+    generate_parser.add_argument("--events", type=int, default=1000)
+    generate_parser.add_argument(
+        "--rate", type=float, default=20.0, help="requests per second"
+    )
+    generate_parser.add_argument("--reminder-share", type=float, default=0.02)
+    generate_parser.add_argument("--out", default="trace.jsonl")
+    add_mix(generate_parser)
+
+    replay_parser = commands.add_parser("replay")
+    add_replay(replay_parser)
+
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument(
+        "--servers", nargs="+", choices=sorted(SERVERS), default=["sync", "async"]
+    )
+    add_replay(compare_parser)
+
+    saturate_parser = commands.add_parser("saturate")
+    saturate_parser.add_argument("--start-rate", type=float, default=10.0)
+    saturate_parser.add_argument("--step", type=float, default=10.0)
+    saturate_parser.add_argument("--max-rate", type=float, default=1000.0)
+    saturate_parser.add_argument("--duration", type=float, default=10.0)
+    saturate_parser.add_argument("--max-p99", type=float, default=1.0)
+    add_common(saturate_parser)
+    add_mix(saturate_parser)
+
+    args = parser.parse_args(argv)
+    if args.command == "generate":
+        generate(args)
+    elif args.command == "replay":
+        replay(args)
+    elif args.command == "saturate":
+        saturate(args)
+    elif args.command == "compare":
+        compare(args)
+    else:
+        parser.print_help()
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
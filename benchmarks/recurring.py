@@ -0,0 +1,113 @@
+"""
+Arms a large number of recurring reminders and plays a simulated clock
+forward over several days, checking that every rule stays one scheduled
+entry however many times it fires. Needs the Redis from REMINDER_REDIS_URL,
+keys go under a separate prefix.
+
+    python -m benchmarks.recurring --rules 100000 --days 7
+"""
+
+import argparse
+import json
+import sys
+import time
+from datetime import datetime, timedelta
+
+from django.conf import settings
+
+from webhooks.recurrence import Recurrence
+from webhooks.scheduler import ReminderScheduler, to_timestamp
+
+REPEATS = ["daily", "weekdays", "weekly", "monthly", "cron(0 */6 * * *)"]
+ZONES = ["Asia/Taipei", "America/Los_Angeles", "Europe/London"]
+EPOCH = datetime(2030, 3, 1)
+
+
+def arm(scheduler, rules, chunk=5000):
+    for offset in range(0, rules, chunk):
+        pipeline = scheduler.redis.pipeline(transaction=False)
+        for index in range(offset, min(offset + chunk, rules)):
+            recurrence = Recurrence(
+                REPEATS[index % len(REPEATS)],
+                ZONES[index % len(ZONES)],
+                EPOCH + timedelta(minutes=index % 1440),
+            )
+            due = to_timestamp(recurrence.first())
+            reminder_id = "rule-{}".format(index)
+            reminder = {
+                "target": "U{}".format(index),
+                "text": "recurring",
+                "due": due,
+                "rule": recurrence.as_dict(),
+            }
+            pipeline.hset(scheduler.payload_key, reminder_id, json.dumps(reminder))
+            pipeline.zadd(scheduler.due_key, {reminder_id: due})
+        pipeline.execute()
+
+
+def footprint(scheduler):
+    pipeline = scheduler.redis.pipeline(transaction=False)
+    pipeline.zcard(scheduler.due_key)
+    pipeline.zcard(scheduler.inflight_key)
+    pipeline.hlen(scheduler.payload_key)
+    pipeline.memory_usage(scheduler.due_key)
+    pipeline.memory_usage(scheduler.payload_key)
+    due, inflight, payloads, due_bytes, payload_bytes = pipeline.execute()
+    return due, inflight, payloads, (due_bytes or 0) + (payload_bytes or 0)
+
+
+def run(rules, days, step):
+    scheduler = ReminderScheduler(
+        settings.REMINDER_REDIS_URL, prefix="bench:recurring", batch_size=2000
+    )
+    keys = [scheduler.due_key, scheduler.inflight_key, scheduler.payload_key]
+    scheduler.redis.delete(*keys)
+
+    started = time.time()
+    arm(scheduler, rules)
+    print("armed {} rules in {:.1f}s".format(rules, time.time() - started))
+    print(
+        "{:>6} {:>10} {:>10} {:>9} {:>10} {:>10}".format(
+            "day", "fired", "scheduled", "inflight", "payloads", "bytes"
+        )
+    )
+
+    fired = [0]
+
+    def deliver(reminders):
+        fired[0] += len(reminders)
+
+    baseline = footprint(scheduler)
+    stable = True
+    now = to_timestamp(EPOCH)
+    for day in range(days + 1):
+        due, inflight, payloads, size = footprint(scheduler)
+        print(
+            "{:>6} {:>10} {:>10} {:>9} {:>10} {:>10}".format(
+                day, fired[0], due, inflight, payloads, size
+            )
+        )
+        stable = stable and (due, inflight, payloads) == baseline[:3]
+        stable = stable and size <= baseline[3] * 1.1
+        end = now + 24 * 3600
+        while now < end:
+            now += step
+            while scheduler.poll(deliver, now=now, max_batches=50):
+                pass
+
+    scheduler.redis.delete(*keys)
+    print(
+        "{} firings, scheduled entries {}".format(
+            fired[0], "constant" if stable else "GREW"
+        )
+    )
+    return stable
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rules", type=int, default=100000)
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--step", type=float, default=600.0, help="clock seconds")
+    args = parser.parse_args()
+    sys.exit(0 if run(args.rules, args.days, args.step) else 1)
@@ -0,0 +1,95 @@
+"""
+Time of listing a user's reminders and counting the ones due in the next
+hour as the reminder table grows, with the plan the database picks for each.
+Rows are written to the configured database under made up targets and
+deleted again, so point it at a scratch one.
+
+    python -m benchmarks.reminders --sizes 10000,100000,1000000
+"""
+
+import argparse
+import random
+import timeit
+from datetime import timedelta
+
+import django
+
+TARGETS = 10000
+# most rows of a grown table are history
+DELIVERED_SHARE = 0.8
+
+
+def explain(queryset):
+    from django.db import connection
+
+    sql, params = queryset.query.sql_with_params()
+    prefix = "EXPLAIN QUERY PLAN " if connection.vendor == "sqlite" else "EXPLAIN "
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params)
+        return " / ".join(str(row[-1]) for row in cursor.fetchall())
+
+
+def grow(count, now):
+    from webhooks.models import Reminder
+
+    rows = []
+    for _ in range(count):
+        delivered = random.random() < DELIVERED_SHARE
+        offset = random.uniform(-365, 0) if delivered else random.uniform(0, 365)
+        rows.append(
+            Reminder(
+                key="{:032x}".format(random.getrandbits(128)),
+                target="Ubench{}".format(random.randrange(TARGETS)),
+                text="benchmark",
+                status=Reminder.DELIVERED if delivered else Reminder.PENDING,
+                due_at=now + timedelta(days=offset),
+            )
+        )
+        if len(rows) == 10000:
+            Reminder.objects.bulk_create(rows)
+            rows = []
+    Reminder.objects.bulk_create(rows)
+
+
+def run(sizes, number=200):
+    from django.utils import timezone
+
+    from webhooks.models import Reminder
+
+    now = timezone.now()
+    queries = [
+        ("list", lambda: Reminder.objects.pending_for("Ubench1")),
+        (
+            "due count",
+            lambda: Reminder.objects.due_between(now, now + timedelta(hours=1)),
+        ),
+    ]
+    print("{:>10} {:>12} {:>14}".format("rows", "list (us)", "due count (us)"))
+    rows = 0
+    try:
+        for size in sizes:
+            grow(size - rows, now)
+            rows = size
+            listing = timeit.timeit(lambda: list(queries[0][1]()), number=number)
+            count = timeit.timeit(lambda: queries[1][1]().count(), number=number)
+            print(
+                "{:>10} {:>12.1f} {:>14.1f}".format(
+                    rows, listing / number * 1e6, count / number * 1e6
+                )
+            )
+        for name, query in queries:
+            print("{}: {}".format(name, explain(query())))
+    finally:
+        Reminder.objects.filter(target__startswith="Ubench").delete()
+
+
+def main():
+    django.setup()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    args = parser.parse_args()
+    run([int(size) for size in args.sizes.split(",")])
+
+
+if __name__ == "__main__":
+    main()
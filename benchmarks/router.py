@@ -0,0 +1,50 @@
+"""
+Dispatch cost of the compiled IntentRouter against the linear re.search scan
+it replaced, as the number of intents grows.
+
+    python -m benchmarks.router
+"""
+
+import re
+import timeit
+
+from webhooks.router import IntentRouter
+
+INTENT_COUNTS = [3, 10, 30, 100, 300]
+SLOTS = [
+    ("number", None, r"\d+"),
+    ("unit", "C", "(?:[cC])+|(?:攝)+"),
+    ("unit", "F", "(?:[fF])+|(?:華)+"),
+]
+
+
+def build_intents(count):
+    return [("功能{}號".format(index), index) for index in range(count)]
+
+
+def linear_scan(intents, message):
+    for pattern, intent in intents:
+        if re.search(pattern, message):
+            return intent
+
+
+def run(number=2000):
+    print("{:>8} {:>14} {:>14}".format("intents", "linear (us)", "router (us)"))
+    for count in INTENT_COUNTS:
+        intents = build_intents(count)
+        router = IntentRouter(intents, slots=SLOTS)
+        # the worst case for the scan: only the last intent matches
+        message = "今天30度C 請幫我用功能{}號".format(count - 1)
+        assert linear_scan(intents, message) == router.route(message).intent
+
+        linear = timeit.timeit(lambda: linear_scan(intents, message), number=number)
+        compiled = timeit.timeit(lambda: router.route(message), number=number)
+        print(
+            "{:>8} {:>14.2f} {:>14.2f}".format(
+                count, linear / number * 1e6, compiled / number * 1e6
+            )
+        )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,108 @@
+"""
+Loads the Redis reminder scheduler with a large backlog of future reminders
+and measures poller memory and firing jitter for the ones coming due.
+Needs the Redis from REMINDER_REDIS_URL, keys go under a separate prefix.
+
+    python -m benchmarks.scheduler --pending 1000000
+"""
+
+import argparse
+import json
+import resource
+import time
+from datetime import datetime
+
+from django.conf import settings
+
+from webhooks.scheduler import ReminderScheduler
+
+
+def rss_mb():
+    # peak resident size, kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def fill_backlog(scheduler, pending, chunk=10000):
+    far_future = time.time() + 30 * 24 * 3600
+    payload = json.dumps({"target": "U0", "text": "backlog", "due": far_future})
+    for offset in range(0, pending, chunk):
+        ids = [
+            "backlog-{}".format(i) for i in range(offset, min(offset + chunk, pending))
+        ]
+        pipeline = scheduler.redis.pipeline(transaction=False)
+        pipeline.hmset(scheduler.payload_key, {i: payload for i in ids})
+        pipeline.zadd(
+            scheduler.due_key,
+            {i: far_future + index for index, i in enumerate(ids)},
+        )
+        pipeline.execute()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(pending, due, window, interval):
+    scheduler = ReminderScheduler(settings.REMINDER_REDIS_URL, prefix="bench:reminders")
+    scheduler.redis.delete(
+        scheduler.due_key, scheduler.inflight_key, scheduler.payload_key
+    )
+
+    started = time.time()
+    fill_backlog(scheduler, pending)
+    print(
+        "backlog of {} reminders loaded in {:.1f}s, redis used {}".format(
+            scheduler.pending(),
+            time.time() - started,
+            scheduler.redis.info("memory")["used_memory_human"],
+        )
+    )
+
+    start = time.time() + 1
+    for index in range(due):
+        scheduler.schedule(
+            "U{}".format(index),
+            "due",
+            datetime.utcfromtimestamp(start + window * index / float(due)),
+        )
+
+    lags = []
+    memory = []
+
+    def deliver(reminders):
+        fired_at = time.time()
+        lags.extend(fired_at - reminder["due"] for reminder in reminders)
+
+    deadline = start + window + 2
+    while time.time() < deadline and len(lags) < due:
+        scheduler.poll(deliver)
+        memory.append(rss_mb())
+        time.sleep(interval)
+
+    print("fired {}/{} due reminders".format(len(lags), due))
+    print(
+        "firing lag p50 {:.3f}s p99 {:.3f}s max {:.3f}s (poll interval {}s)".format(
+            percentile(lags, 0.5), percentile(lags, 0.99), max(lags), interval
+        )
+    )
+    print(
+        "poller peak rss {:.1f}MB first tick, {:.1f}MB last tick".format(
+            memory[0], memory[-1]
+        )
+    )
+    scheduler.redis.delete(
+        scheduler.due_key, scheduler.inflight_key, scheduler.payload_key
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pending", type=int, default=1000000)
+    parser.add_argument("--due", type=int, default=2000)
+    parser.add_argument("--window", type=float, default=10.0)
+    parser.add_argument(
+        "--interval", type=float, default=settings.REMINDER_POLL_INTERVAL
+    )
+    args = parser.parse_args()
+    run(args.pending, args.due, args.window, args.interval)
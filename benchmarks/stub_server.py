@@ -0,0 +1,132 @@
+"""
+A stand-in for the LINE Messaging API. It accepts reply, push and multicast
+calls, records them with their arrival time and can add latency or answer
+429. Point the bot at it with LINE_API_ENDPOINT=http://127.0.0.1:<port>.
+
+    python -m benchmarks.stub_server --port 8081 --latency 0.05 --throttle 0.01
+
+GET /__calls returns what was recorded, POST /__config changes latency and
+throttle at runtime, POST /__reset clears the record.
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+MESSAGE_PATHS = {
+    "/v2/bot/message/reply": "reply",
+    "/v2/bot/message/push": "push",
+    "/v2/bot/message/multicast": "multicast",
+}
+
+
+class StubState(object):
+    def __init__(self, latency=0.0, throttle=0.0):
+        self.latency = latency
+        self.throttle = throttle
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def record(self, kind, status, body):
+        with self.lock:
+            self.calls.append(
+                {"kind": kind, "status": status, "at": time.time(), "body": body}
+            )
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.calls)
+
+    def reset(self):
+        with self.lock:
+            self.calls = []
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _send(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length).decode("utf-8") or "{}")
+
+    def do_GET(self):
+        if self.path == "/__calls":
+            return self._send(200, self.server.state.snapshot())
+        self._send(404, {"message": "Not found"})
+
+    def do_POST(self):
+        state = self.server.state
+        body = self._read_json()
+        if self.path == "/__config":
+            state.latency = float(body.get("latency", state.latency))
+            state.throttle = float(body.get("throttle", state.throttle))
+            return self._send(
+                200, {"latency": state.latency, "throttle": state.throttle}
+            )
+        if self.path == "/__reset":
+            state.reset()
+            return self._send(200, {})
+
+        kind = MESSAGE_PATHS.get(self.path)
+        if kind is None:
+            return self._send(404, {"message": "Not found"})
+
+        if state.latency:
+            time.sleep(state.latency)
+        if state.throttle and random.random() < state.throttle:
+            state.record(kind, 429, body)
+            return self._send(
+                429,
+                {"message": "The API rate limit has been exceeded."},
+                {"Retry-After": "1"},
+            )
+
+        state.record(kind, 200, body)
+        self._send(200, {})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, throttle=0.0):
+        HTTPServer.__init__(self, address, StubHandler)
+        self.state = StubState(latency, throttle)
+
+    @property
+    def endpoint(self):
+        return "http://{}:{}".format(*self.server_address[:2])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--throttle", type=float, default=0.0, help="share of 429s")
+    args = parser.parse_args()
+    server = StubServer((args.host, args.port), args.latency, args.throttle)
+    print("stub LINE API on {}".format(server.endpoint))
+    server.serve_forever()
@@ -0,0 +1,61 @@
+import json
+
+from linebot.http_client import HttpClient, HttpResponse
+
+
+class StubResponse(HttpResponse):
+    def __init__(self, status_code=200, body="{}", headers=None):
+        self._status_code = status_code
+        self._body = body
+        self._headers = headers or {}
+
+    @property
+    def status_code(self):
+        return self._status_code
+
+    @property
+    def headers(self):
+        return self._headers
+
+    @property
+    def text(self):
+        return self._body
+
+    @property
+    def content(self):
+        return self._body.encode("utf-8")
+
+    @property
+    def json(self):
+        return json.loads(self._body)
+
+    def iter_content(self, chunk_size=1024, decode_unicode=False):
+        return iter([self.content])
+
+
+class StubHttpClient(HttpClient):
+    # answers every LINE API call with 200 and keeps what was sent
+    def __init__(self, timeout=HttpClient.DEFAULT_TIMEOUT):
+        super(StubHttpClient, self).__init__(timeout)
+        self.calls = []
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        self.calls.append(("GET", url, params))
+        return StubResponse()
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        self.calls.append(("POST", url, data))
+        return StubResponse()
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        self.calls.append(("DELETE", url, data))
+        return StubResponse()
+
+
+class StubScheduler(object):
+    def __init__(self):
+        self.scheduled = []
+
+    def schedule(self, target, text, due_at, reminder_id=None, rule=None):
+        self.scheduled.append((target, text, due_at))
+        return reminder_id or str(len(self.scheduled))
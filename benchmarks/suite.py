@@ -0,0 +1,247 @@
+"""
+Microbenchmarks for the parse / dispatch / render hot path over a fixed
+corpus, with the LINE API and the reminder scheduler stubbed in-process and
+reminders written to a migrated throwaway test database. Flow state stays in
+an in-process store and replies skip the rate limiter, so no stage waits on
+Redis.
+
+    python -m benchmarks.suite run --save before.json
+    python -m benchmarks.suite compare before.json after.json
+"""
+
+import argparse
+import gc
+import itertools
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from urllib.parse import parse_qsl
+
+from django.db import connection
+from django.test.utils import override_settings
+from linebot import LineBotApi
+from linebot.models.events import Postback
+
+from benchmarks.corpus import POSTBACKS, TEXT_MESSAGES
+from benchmarks.stubs import StubHttpClient, StubScheduler
+from webhooks import jobs, outbound
+from webhooks.Parsers import (
+    DateTimeConvertController,
+    ReminderController,
+    TextGenerator,
+    TextParser,
+    UnitConvertController,
+)
+from webhooks.state import StateStore
+from webhooks.views import _handle_postback_data
+
+KEY = "U4af4980629_"
+
+
+def routed(controller):
+    return [m for m in TEXT_MESSAGES if TextParser(m).from_key_to_class() is controller]
+
+
+def postbacks(woody_type, action):
+    selected = []
+    for data, params in POSTBACKS:
+        fields = dict(parse_qsl(data))
+        if fields["type"] == woody_type and fields["action"] == action:
+            selected.append(Postback(data=data, params=params))
+    return selected
+
+
+def action_stage(woody_type, action):
+    def run(postback):
+        data, func_name, type = _handle_postback_data(postback)
+        return jobs.JOB_API.dispatch(type, func_name, data=data, key=KEY)
+
+    return run, postbacks(woody_type, action)
+
+
+def build_stages():
+    api = LineBotApi("benchmark", http_client=StubHttpClient)
+    reply = ReminderController("提醒 明天早上九點開會").result
+    return [
+        (
+            "TextGenerator.generate",
+            lambda m: TextGenerator(m).generate(),
+            TEXT_MESSAGES,
+        ),
+        (
+            "BaseParser.from_key_to_class",
+            lambda m: TextParser(m).from_key_to_class(),
+            TEXT_MESSAGES,
+        ),
+        (
+            "UnitConvertController.result",
+            lambda m: UnitConvertController(m).result,
+            routed(UnitConvertController),
+        ),
+        (
+            "DateTimeConvertController.result",
+            lambda m: DateTimeConvertController(m).result,
+            routed(DateTimeConvertController),
+        ),
+        (
+            "ReminderController.result",
+            lambda m: ReminderController(m).result,
+            routed(ReminderController),
+        ),
+        (
+            "_handle_postback_data",
+            _handle_postback_data,
+            [Postback(data=data, params=params) for data, params in POSTBACKS],
+        ),
+        ("WoodyReminder.can_choose_date",) + action_stage("reminder", "choose_date"),
+        ("WoodyReminder.can_add_to_reminder",)
+        + action_stage("reminder", "add_to_reminder"),
+        ("WoodyTimeConverter.can_choose",) + action_stage("date_convert", "choose"),
+        (
+            "outbound.reply_message",
+            lambda token: outbound.reply_message(token, reply, api=api),
+            ["reply-token-{}".format(index) for index in range(16)],
+        ),
+    ]
+
+
+def measure(func, inputs, min_time=0.2, repeat=5):
+    assert inputs, "a stage needs at least one input"
+    for value in inputs:
+        func(value)
+
+    number = len(inputs)
+    while True:
+        values = list(itertools.islice(itertools.cycle(inputs), number))
+        started = time.perf_counter()
+        for value in values:
+            func(value)
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    best = elapsed
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for value in values:
+            func(value)
+        best = min(best, time.perf_counter() - started)
+
+    # allocations are traced on a separate, shorter pass, tracing is slow.
+    # The peak of every single op is what it allocated at most while running
+    sample = values[: min(len(values), 200)]
+    peaks = 0
+    gc.collect()
+    gc.disable()
+    blocks = sys.getallocatedblocks()
+    for value in sample:
+        tracemalloc.start()
+        func(value)
+        peaks += tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    live_blocks = sys.getallocatedblocks() - blocks
+    gc.enable()
+
+    return {
+        "ops_per_sec": number / best,
+        "us_per_op": best / number * 1e6,
+        "peak_bytes_per_op": peaks / float(len(sample)),
+        "retained_blocks_per_op": live_blocks / float(len(sample)),
+    }
+
+
+def run(save=None, only=None):
+    database = connection.creation.create_test_db(verbosity=0)
+    scheduler, jobs.reminder_scheduler = jobs.reminder_scheduler, StubScheduler()
+    state_store, jobs.state_store = jobs.state_store, StateStore(alias=None)
+    try:
+        with override_settings(OUTBOUND_RATE_LIMITED=False):
+            results = {}
+            for name, func, inputs in build_stages():
+                if only and only not in name:
+                    continue
+                results[name] = measure(func, inputs)
+                print_result(name, results[name])
+    finally:
+        jobs.reminder_scheduler = scheduler
+        jobs.state_store = state_store
+        connection.creation.destroy_test_db(database, verbosity=0)
+
+    if save:
+        with open(save, "w") as output:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "created": time.time(),
+                    "stages": results,
+                },
+                output,
+                indent=2,
+                sort_keys=True,
+            )
+    return results
+
+
+def print_result(name, result):
+    print(
+        "{:<36} {:>12,.0f} ops/s {:>9.2f} us {:>10,.0f} B peak {:>7.1f} blocks".format(
+            name,
+            result["ops_per_sec"],
+            result["us_per_op"],
+            result["peak_bytes_per_op"],
+            result["retained_blocks_per_op"],
+        )
+    )
+
+
+def compare(before, after, threshold=0.1):
+    with open(before) as first, open(after) as second:
+        old = json.load(first)["stages"]
+        new = json.load(second)["stages"]
+
+    regressions = []
+    print(
+        "{:<36} {:>14} {:>14} {:>8}".format(
+            "stage", "before ops/s", "after ops/s", "change"
+        )
+    )
+    for name in sorted(set(old) | set(new)):
+        if name not in old or name not in new:
+            print("{:<36} {:>14}".format(name, "only in one run"))
+            continue
+        change = new[name]["ops_per_sec"] / old[name]["ops_per_sec"] - 1
+        flag = ""
+        if change < -threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(
+            "{:<36} {:>14,.0f} {:>14,.0f} {:>+7.1%}{}".format(
+                name, old[name]["ops_per_sec"], new[name]["ops_per_sec"], change, flag
+            )
+        )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command")
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("--save")
+    run_parser.add_argument("--only", help="run stages whose name contains this")
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        return 1 if compare(args.before, args.after, args.threshold) else 0
+    run(save=args.save, only=args.only)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
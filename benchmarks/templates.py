@@ -0,0 +1,138 @@
+"""
+Cost of a reply built as sdk model objects and serialized by the sdk,
+against the same reply rendered from a pre-serialized MessageTemplate.
+
+    python -m benchmarks.templates
+"""
+
+import json
+import timeit
+
+from linebot.models import (
+    ButtonsTemplate,
+    DatetimePickerAction,
+    PostbackAction,
+    TemplateSendMessage,
+)
+
+from webhooks.Parsers import DateTimeConvertController, ReminderController
+from webhooks.jobs import WoodyReminder
+from webhooks.outbound import _messages_json
+
+
+def reminder_objects(state):
+    return TemplateSendMessage(
+        alt_text="提醒小幫手",
+        template=ButtonsTemplate(
+            title="提醒事項",
+            text="請選擇時區",
+            actions=[
+                PostbackAction(
+                    label=label,
+                    data="type=reminder&action=choose_date&tz={}&s={}".format(
+                        tz, state
+                    ),
+                )
+                for label, tz in [
+                    ("台灣時區", "Asia/Taipei"),
+                    ("美國時區", "America/Los_Angeles"),
+                    ("日本時區", "Asia/Tokyo"),
+                ]
+            ],
+        ),
+    )
+
+
+def date_convert_objects(from_country, to_country, from_tz, to_tz):
+    return TemplateSendMessage(
+        alt_text="時間轉換",
+        template=ButtonsTemplate(
+            title="時間轉換",
+            text="{} 轉換至 {}".format(from_country, to_country),
+            actions=[
+                DatetimePickerAction(
+                    label="請選擇想轉換的時間",
+                    data="type=date_convert&action=choose&from_country={}&to_country={}&from_tz={}&to_tz={}".format(
+                        from_country, to_country, from_tz, to_tz
+                    ),
+                    mode="datetime",
+                )
+            ],
+        ),
+    )
+
+
+def choose_date_objects(state):
+    return TemplateSendMessage(
+        alt_text="提醒小幫手",
+        template=ButtonsTemplate(
+            title="提醒事項",
+            text="請選擇想提醒的時間",
+            actions=[
+                DatetimePickerAction(
+                    label="選擇時間",
+                    data="type=reminder&action=add_to_reminder&s={}".format(state),
+                    mode="datetime",
+                )
+            ],
+        ),
+    )
+
+
+CASES = [
+    (
+        "ReminderController",
+        lambda: reminder_objects("RQ9O_YZt"),
+        lambda: ReminderController.TEMPLATE.render(state="RQ9O_YZt"),
+    ),
+    (
+        "DateTimeConvertController",
+        lambda: date_convert_objects("台灣", "日本", "Asia/Taipei", "Asia/Tokyo"),
+        lambda: DateTimeConvertController.TEMPLATE.render(
+            from_country="台灣",
+            to_country="日本",
+            from_tz="Asia/Taipei",
+            to_tz="Asia/Tokyo",
+        ),
+    ),
+    (
+        "WoodyReminder.can_choose_date",
+        lambda: choose_date_objects("JDtCYx8E"),
+        lambda: WoodyReminder.CHOOSE_DATE_TEMPLATE.render(
+            type="reminder", state="JDtCYx8E"
+        ),
+    ),
+]
+
+
+def sdk_body(build):
+    # what LineBotApi.reply_message does with a model tree
+    return json.dumps({"replyToken": "token", "messages": [build().as_json_dict()]})
+
+
+def template_body(render):
+    return '{{"replyToken": "token", "messages": {}}}'.format(_messages_json(render()))
+
+
+def run(number=20000):
+    print(
+        "{:<32} {:>12} {:>14} {:>8}".format(
+            "reply", "sdk (us)", "template (us)", "speedup"
+        )
+    )
+    for name, build, render in CASES:
+        assert json.loads(sdk_body(build)) == json.loads(template_body(render))
+        objects = timeit.timeit(lambda: sdk_body(build), number=number)
+        template = timeit.timeit(lambda: template_body(render), number=number)
+        print(
+            "{:<32} {:>12.2f} {:>14.2f} {:>7.1f}x".format(
+                name,
+                objects / number * 1e6,
+                template / number * 1e6,
+                objects / template,
+            )
+        )
+
+
+if __name__ == "__main__":
+    run()
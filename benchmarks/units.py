@@ -0,0 +1,67 @@
+"""
+Cost of finding and converting the quantities of a message as the unit table
+grows from the shipped units to thousands of made up ones, against a scan
+over one pattern per alias.
+
+    python -m benchmarks.units
+"""
+
+import re
+import timeit
+
+from webhooks.units import LENGTH, NUMBER, UNITS, UnitTable
+
+EXTRA_UNITS = [0, 1000, 5000, 20000]
+MESSAGE = "換算 5 kg 3 lb 2.5 oz 10公里 轉 英里"
+
+
+def build_entries(extra):
+    # made up units, none of them in the message
+    return UNITS + [
+        (
+            "unit{}".format(index),
+            LENGTH,
+            1.0,
+            0,
+            "m",
+            "單位",
+            ["單位{}號".format(index)],
+        )
+        for index in range(extra)
+    ]
+
+
+def linear_scan(patterns, message):
+    return [
+        (match.group(1), unit)
+        for pattern, unit in patterns
+        for match in pattern.finditer(message)
+    ]
+
+
+def run(number=2000):
+    print("{:>8} {:>14} {:>14}".format("aliases", "scan (us)", "table (us)"))
+    for extra in EXTRA_UNITS:
+        table = UnitTable(build_entries(extra))
+        patterns = [
+            (
+                re.compile(
+                    r"({})\s*{}(?![a-z])".format(NUMBER, re.escape(alias)),
+                    re.IGNORECASE,
+                ),
+                unit,
+            )
+            for alias, unit in table.aliases.items()
+        ]
+
+        scan = timeit.timeit(lambda: linear_scan(patterns, MESSAGE), number=number)
+        found = timeit.timeit(lambda: table.convert(table.find(MESSAGE)), number=number)
+        print(
+            "{:>8} {:>14.2f} {:>14.2f}".format(
+                len(table), scan / number * 1e6, found / number * 1e6
+            )
+        )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,126 @@
+"""
+Per-request overhead of the webhook callback through the full Django stack
+against the fast path in line_bot.wsgi, and how long a fresh web process
+takes to import the app and answer its first callback in either mode.
+
+    python -m benchmarks.wsgi overhead
+    python -m benchmarks.wsgi startup --runs 5
+
+The webhook carries no events, so what is left is the stack around
+dispatch_webhook plus parsing an empty payload.
+"""
+
+import argparse
+import base64
+import hashlib
+import hmac
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import timeit
+from wsgiref.util import setup_testing_defaults
+
+MODES = [("django", "0"), ("fast path", "1")]
+
+# run in a fresh interpreter, prints the import and first request seconds
+STARTUP_SCRIPT = """
+import time
+started = time.time()
+from line_bot.wsgi import application
+imported = time.time()
+from benchmarks.wsgi import callback_environ
+application(callback_environ(), lambda status, headers: None)
+print(imported - started, time.time() - imported)
+"""
+
+
+def sign(body, secret):
+    digest = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("ascii")
+
+
+def callback_environ(secret=None):
+    from django.conf import settings
+
+    body = json.dumps({"destination": "bench", "events": []}).encode("utf-8")
+    environ = {
+        "REQUEST_METHOD": "POST",
+        "PATH_INFO": "/webhooks/callback",
+        "CONTENT_TYPE": "application/json",
+        "CONTENT_LENGTH": str(len(body)),
+        "HTTP_X_LINE_SIGNATURE": sign(body, secret or settings.LINE_BOT_HANDLER),
+        "wsgi.input": io.BytesIO(body),
+    }
+    setup_testing_defaults(environ)
+    return environ
+
+
+def call(application):
+    statuses = []
+    body = b"".join(
+        application(callback_environ(), lambda status, headers: statuses.append(status))
+    )
+    assert statuses == ["200 OK"] and body == b"Ok", (statuses, body)
+
+
+def overhead(number):
+    import django
+    from django.core.wsgi import get_wsgi_application
+
+    django.setup(set_prefix=False)
+    from webhooks.fastpath import FastPathApplication
+
+    applications = [
+        ("django", get_wsgi_application()),
+        ("fast path", FastPathApplication(get_wsgi_application)),
+    ]
+    baseline = timeit.timeit(callback_environ, number=number)
+    print("{:<10} {:>12}".format("stack", "us/request"))
+    for name, application in applications:
+        call(application)
+        elapsed = timeit.timeit(lambda: call(application), number=number)
+        print("{:<10} {:>12.1f}".format(name, (elapsed - baseline) / number * 1e6))
+
+
+def startup(runs):
+    print("{:<10} {:>12} {:>16}".format("stack", "import (s)", "first call (s)"))
+    for name, flag in MODES:
+        imports, calls = [], []
+        for _ in range(runs):
+            output = subprocess.check_output(
+                [sys.executable, "-c", STARTUP_SCRIPT],
+                env=dict(os.environ, WEBHOOK_FAST_PATH=flag),
+            )
+            imported, called = output.split()[-2:]
+            imports.append(float(imported))
+            calls.append(float(called))
+        print(
+            "{:<10} {:>12.3f} {:>16.3f}".format(
+                name, statistics.median(imports), statistics.median(calls)
+            )
+        )
+
+
+def main():
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "line_bot.settings")
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command")
+    command = commands.add_parser("overhead")
+    command.add_argument("--number", type=int, default=5000)
+    command = commands.add_parser("startup")
+    command.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.command == "overhead":
+        overhead(args.number)
+    elif args.command == "startup":
+        startup(args.runs)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
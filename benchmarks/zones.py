@@ -0,0 +1,66 @@
+"""
+Cost of finding the places of a message and converting a datetime, as the
+gazetteer grows from the shipped names to thousands of made up ones, against
+a scan over one pattern per place.
+
+    python -m benchmarks.zones
+"""
+
+import re
+import timeit
+from datetime import datetime
+
+from webhooks.zones import CITY, GAZETTEER, Gazetteer, convert
+
+EXTRA_NAMES = [0, 1000, 5000, 20000]
+MESSAGE = "明天早上台北時間轉換紐約跟倫敦"
+TO_ZONES = ["America/New_York", "Europe/London", "Asia/Tokyo", "Australia/Sydney"]
+
+
+def build_entries(extra):
+    # made up places, none of them in the message
+    names = ["地名{}號".format(index) for index in range(extra // 2)]
+    names += ["Place{}ville".format(index) for index in range(extra - len(names))]
+    return GAZETTEER + [("UTC", "", CITY, names)]
+
+
+def linear_scan(patterns, message):
+    return [place for pattern, place in patterns if pattern.search(message)]
+
+
+def run(number=2000):
+    print("{:>8} {:>14} {:>14}".format("names", "scan (us)", "gazetteer (us)"))
+    for extra in EXTRA_NAMES:
+        gazetteer = Gazetteer(build_entries(extra))
+        patterns = [
+            (re.compile(re.escape(name), re.IGNORECASE), place)
+            for name, place in gazetteer.places.items()
+        ]
+        assert set(mention.place for mention in gazetteer.find(MESSAGE)) == set(
+            linear_scan(patterns, MESSAGE)
+        )
+
+        scan = timeit.timeit(lambda: linear_scan(patterns, MESSAGE), number=number)
+        found = timeit.timeit(lambda: gazetteer.find(MESSAGE), number=number)
+        print(
+            "{:>8} {:>14.2f} {:>14.2f}".format(
+                len(gazetteer), scan / number * 1e6, found / number * 1e6
+            )
+        )
+
+    local = datetime(2030, 3, 10, 9, 30)
+    one = timeit.timeit(
+        lambda: convert(local, "Asia/Taipei", TO_ZONES[:1]), number=number * 10
+    )
+    many = timeit.timeit(
+        lambda: convert(local, "Asia/Taipei", TO_ZONES), number=number * 10
+    )
+    print(
+        "convert to 1 zone {:.2f}us, to {} zones {:.2f}us".format(
+            one / number / 10 * 1e6, len(TO_ZONES), many / number / 10 * 1e6
+        )
+    )
+
+
+if __name__ == "__main__":
+    run()
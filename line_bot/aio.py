@@ -0,0 +1,16 @@
+"""
+aiohttp entry point for line_bot, the asyncio counterpart of wsgi.py.
+
+    gunicorn line_bot.aio:app --worker-class aiohttp.GunicornWebWorker
+"""
+
+import os
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "line_bot.settings")
+django.setup()
+
+from webhooks.aioserver import create_app  # noqa: E402
+
+app = create_app()
@@ -46,6 +46,150 @@ CELERY_ACCEPT_CONTENT = ["application/json"]
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
 CELERY_TIMEZONE = "UTC"
+# nothing reads task results, a task that needs one sets ignore_result=False
+CELERY_TASK_IGNORE_RESULT = True
+
+# Interactive replies, reminder delivery and bulk fan-out have queues of their
+# own, so a reminder backlog never sits in front of a reply. The Procfile's
+# worker takes all three, always looking at interactive first, the other
+# process types run a pool per queue. Lower priority numbers go first.
+CELERY_TASK_DEFAULT_QUEUE = "bulk"
+CELERY_TASK_ROUTES = {
+    "webhooks.tasks.handle_webhook": {"queue": "interactive", "priority": 0},
+    "webhooks.tasks.reply": {"queue": "interactive", "priority": 0},
+    "webhooks.tasks.poll_reminders": {"queue": "reminders", "priority": 0},
+    "webhooks.tasks.deliver_reminders": {"queue": "reminders", "priority": 3},
+    "webhooks.tasks.send": {"queue": "reminders", "priority": 3},
+    "webhooks.tasks.drain_outbound": {"queue": "bulk", "priority": 6},
+    "webhooks.tasks.drain_parked": {"queue": "bulk", "priority": 6},
+    "webhooks.tasks.broadcast": {"queue": "bulk", "priority": 6},
+    "webhooks.tasks.broadcast_chunk": {"queue": "bulk", "priority": 9},
+}
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    "queue_order_strategy": "priority",
+    "priority_steps": [0, 3, 6, 9],
+    "sep": ":",
+    # unacked acks_late tasks of a lost worker come back after this long
+    "visibility_timeout": 300,
+}
+# a worker holds one task per process beyond the ones it runs, the Procfile
+# pools set their own
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+# How webhook events are processed once the signature is verified: "sync"
+# handles them inside the request, "celery" hands the raw body to a worker
+# and "thread" to an in-process queue, so LINE gets its 200 right away.
+WEBHOOK_DISPATCH_MODE = os.environ.get("WEBHOOK_DISPATCH_MODE", "sync")
+WEBHOOK_DISPATCH_THREADS = int(os.environ.get("WEBHOOK_DISPATCH_THREADS", "2"))
+# line_bot.wsgi answers the webhook callback and metrics without the django
+# middleware and url resolution, everything else still goes through django
+WEBHOOK_FAST_PATH = os.environ.get("WEBHOOK_FAST_PATH", "1") == "1"
+
+# conversations of one webhook handled at the same time, on threads shared
+# by the whole process
+WEBHOOK_EVENT_CONCURRENCY = int(os.environ.get("WEBHOOK_EVENT_CONCURRENCY", "4"))
+WEBHOOK_EVENT_THREADS = int(os.environ.get("WEBHOOK_EVENT_THREADS", "16"))
+
+# LINE API calls per second, per endpoint and for the whole channel, shared
+# by every process through this cache's redis. Replies wait up to the max
+# wait for a token, pushes and multicasts queue behind the limit and are
+# sent by the drain task, leaving the reserve of the channel to replies.
+OUTBOUND_RATE_LIMITED = os.environ.get("OUTBOUND_RATE_LIMITED", "1") == "1"
+OUTBOUND_REDIS_ALIAS = "default"
+OUTBOUND_RATE_LIMITS = {"reply": 2000, "push": 2000, "multicast": 200}
+OUTBOUND_SHARED_RATE = 2000
+OUTBOUND_REPLY_RESERVE = 0.2
+OUTBOUND_REPLY_MAX_WAIT = 1.0
+OUTBOUND_DRAIN_INTERVAL = 1.0
+OUTBOUND_DRAIN_SECONDS = 1.0
+
+# Shared by every process through this cache's redis, the breaker opens when
+# LINE API calls of the last window fail at error_rate or their percentile
+# latency reaches slow_seconds. While open, replies fail fast and pushes and
+# multicasts are parked in redis, a probe is let through after open_seconds
+# and the drain task sends the parked calls once one succeeded.
+LINE_API_BREAKER = os.environ.get("LINE_API_BREAKER", "1") == "1"
+LINE_API_BREAKER_ALIAS = "default"
+LINE_API_BREAKER_OPTIONS = {
+    "window": 30,
+    "min_calls": 20,
+    "error_rate": 0.5,
+    "slow_seconds": 2.0,
+    "percentile": 0.95,
+    "open_seconds": 30,
+    "probes": 1,
+}
+LINE_API_PARKED_DRAIN_INTERVAL = 5.0
+LINE_API_PARKED_DRAIN_SECONDS = 5.0
+
+# Users, groups and rooms the bot heard from are kept in redis sets of this
+# cache, a broadcast sends to a snapshot of them in chunks on the bulk queue,
+# a multicast per MAX_MULTICAST_RECIPIENTS users and this many groups and
+# rooms per chunk. A process skips adding a member it added within the last
+# AUDIENCE_LOCAL_TTL seconds.
+AUDIENCE_REDIS_ALIAS = "default"
+AUDIENCE_LOCAL_SIZE = 100000
+AUDIENCE_LOCAL_TTL = 300
+BROADCAST_CONVERSATION_CHUNK = 100
+
+# Pending reminders live in a Redis sorted set, beat polls it for due ones
+# instead of celery holding every future reminder as an ETA task.
+REMINDER_REDIS_URL = CELERY_BROKER_URL
+REMINDER_BATCH_SIZE = 500
+REMINDER_POLL_INTERVAL = 1.0
+CELERY_BEAT_SCHEDULE = {
+    "poll-reminders": {
+        "task": "webhooks.tasks.poll_reminders",
+        "schedule": REMINDER_POLL_INTERVAL,
+        "options": {"expires": REMINDER_POLL_INTERVAL},
+    },
+    "drain-outbound": {
+        "task": "webhooks.tasks.drain_outbound",
+        "schedule": OUTBOUND_DRAIN_INTERVAL,
+        "options": {"expires": OUTBOUND_DRAIN_INTERVAL},
+    },
+    "drain-parked": {
+        "task": "webhooks.tasks.drain_parked",
+        "schedule": LINE_API_PARKED_DRAIN_INTERVAL,
+        "options": {"expires": LINE_API_PARKED_DRAIN_INTERVAL},
+    },
+}
+
+CACHES = {
+    "default": {
+        "BACKEND": "django_redis.cache.RedisCache",
+        "LOCATION": CELERY_BROKER_URL,
+        "OPTIONS": {"CLIENT_CLASS": "django_redis.client.DefaultClient"},
+    }
+}
+
+# Redelivered webhook events are dropped for this long. The local filter
+# mirrors seen events in every process so new ones skip the Redis check.
+WEBHOOK_DEDUP_TTL = 3600
+WEBHOOK_DEDUP_LOCAL_FILTER = os.environ.get("WEBHOOK_DEDUP_LOCAL_FILTER") == "1"
+
+# Reply tokens are good for about 30 seconds after LINE sends the event, an
+# answer later than the margin before that is pushed instead, which counts
+# against the monthly message quota.
+WEBHOOK_REPLY_TOKEN_TTL = float(os.environ.get("WEBHOOK_REPLY_TOKEN_TTL", "30"))
+WEBHOOK_REPLY_MARGIN = float(os.environ.get("WEBHOOK_REPLY_MARGIN", "3"))
+
+# Replies of deterministic controllers are cached per normalized message,
+# set the alias to share entries between processes through that cache.
+RESPONSE_CACHE_SIZE = 1024
+RESPONSE_CACHE_TTL = 600
+RESPONSE_CACHE_SHARED_ALIAS = os.environ.get("RESPONSE_CACHE_SHARED_ALIAS") or None
+
+# Flow state between the steps of a conversation, postbacks only carry a
+# token for it. Without the alias it is kept per process.
+FLOW_STATE_ALIAS = os.environ.get("FLOW_STATE_ALIAS", "default") or None
+FLOW_STATE_TTL = 7 * 24 * 3600
+FLOW_STATE_LOCAL_SIZE = 10000
+
+# metrics of every process are added up in this cache's redis, unset to only
+# show the process serving the endpoint
+METRICS_REDIS_ALIAS = os.environ.get("METRICS_REDIS_ALIAS", "default") or None
+METRICS_FLUSH_INTERVAL = 5.0
 
 MIDDLEWARE_CLASSES = (
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -113,3 +257,16 @@ STATIC_URL = "/static/"
 
 LINE_BOT_API = os.environ.get("LINE_BOT_API", "")
 LINE_BOT_HANDLER = os.environ.get("LINE_BOT_HANDLER", "")
+
+# Outbound client used by line_bot_api, one connection pool per process.
+LINE_API_ENDPOINT = os.environ.get("LINE_API_ENDPOINT", "https://api.line.me")
+LINE_API_HTTP_CLIENT = "webhooks.http_client.PooledHttpClient"
+LINE_API_HTTP_OPTIONS = {
+    "pool_size": int(os.environ.get("LINE_API_POOL_SIZE", "10")),
+    "max_retries": int(os.environ.get("LINE_API_MAX_RETRIES", "3")),
+    "backoff": float(os.environ.get("LINE_API_BACKOFF", "0.2")),
+}
+LINE_API_CONNECT_TIMEOUT = float(os.environ.get("LINE_API_CONNECT_TIMEOUT", "3.05"))
+LINE_API_READ_TIMEOUT = float(os.environ.get("LINE_API_READ_TIMEOUT", "5"))
+# the aiohttp front end keeps many replies in flight per process
+LINE_API_ASYNC_POOL_SIZE = int(os.environ.get("LINE_API_ASYNC_POOL_SIZE", "100"))
@@ -9,8 +9,17 @@ https://docs.djangoproject.com/en/1.8/howto/deployment/wsgi/
 
 import os
 
+import django
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "line_bot.settings")
 
-application = get_wsgi_application()
+if settings.WEBHOOK_FAST_PATH:
+    django.setup(set_prefix=False)
+
+    from webhooks.fastpath import FastPathApplication
+
+    application = FastPathApplication(get_wsgi_application)
+else:
+    application = get_wsgi_application()
@@ -1,8 +1,6 @@
 # coding=utf-8
 
 from abc import ABCMeta
-import json
-import re
 from six import with_metaclass
 from linebot.models import (
     TextSendMessage,
@@ -12,105 +10,153 @@ from linebot.models import (
     PostbackAction,
 )
 
-from .jobs import WoodyReminder, WoodyTimeConverter
+from .cache import normalize, response_cache
+from .jobs import JOB_API, WoodyReminder
+from .messages import MessageTemplate
+from .recurrence import DAILY, MONTHLY, WEEKDAYS, WEEKLY
+from .metrics import STAGE_SECONDS
+from .router import IntentRouter
+from .units import unit_table
+from .zones import Mention, gazetteer
 
 
 class BaseController(with_metaclass(ABCMeta, object)):
-    def __init__(self, message, default="對不起，我看不懂> <", user_id="", room_id=""):
+    SLOTS = []  # should be a tuple ("slot name", value, pattern)
+    # only for controllers whose result depends on nothing but the message
+    CACHE_RESPONSES = False
+
+    def __init__(self, message, default="對不起，我看不懂> <", key="", slots=None):
         self.message = message
         self.default = default
-        self.key = "{}_{}".format(user_id, room_id)
+        # the conversation the flow state of the controller is saved under
+        self.key = key
+        self.slots = slots if slots is not None else self.get_slots(message)
+
+    @classmethod
+    def get_slots(cls, message):
+        router = cls.__dict__.get("_router")
+        if router is None:
+            router = cls._router = IntentRouter([], slots=cls.SLOTS)
+        return router.route(message).slots
 
     @property
     def result(self):
         raise NotImplementedError
 
+    @property
+    def response(self):
+        if not self.CACHE_RESPONSES:
+            return self.result
+
+        return response_cache.get_or_build(
+            "{}:{}".format(self.__class__.__name__, normalize(self.message)),
+            lambda: self.result,
+        )
 
-class TemperatureController(BaseController):
-    # a tool to calculator tempature and return result
-    TEMP_PATTERN = "\d+"
-    CEL_PATTERN = "(?:[cC])+|(?:攝)+"
-    FAH_PATTERN = "(?:[fF])+|(?:華)+"
 
-    def get_temp(self, value):
-        find_match = re.search(self.TEMP_PATTERN, value)
-        if find_match:
-            return find_match.group(0)
+class UnitConvertController(BaseController):
+    # every quantity of the message in the unit asked for, or the usual one
+    CACHE_RESPONSES = True
+    KEYWORDS = ["溫度", "換算", "匯率", "單位轉換"]
 
     @property
     def result(self):
-        try:
-            temp = int(self.get_temp(self.message))
-            if re.search(self.CEL_PATTERN, self.message):
-                return TextSendMessage(
-                    text="華氏溫度: {}".format(round((temp * 9.0 / 5) + 32, 2))
-                )
-
-            elif re.search(self.FAH_PATTERN, self.message):
-                return TextSendMessage(
-                    text="攝氏溫度: {}".format(round((temp - 32.0) / 9 * 5, 2))
-                )
-
-        except (ValueError, TypeError):
-            pass
+        quantities = unit_table.find(self.message)
+        if not quantities:
+            return TextSendMessage(
+                text="對不起 請輸入 <數字><單位> 例如 30C 或 10公里轉英里"
+            )
 
-        return TextSendMessage(text=self.default)
+        lines = [
+            "{} = {}".format(
+                unit_table.describe(quantity.value, quantity.unit),
+                unit_table.describe(value, target),
+            )
+            for quantity, target, value in unit_table.convert(quantities)
+        ]
+        return TextSendMessage(text="\n".join(lines))
 
 
 class DateTimeConvertController(BaseController):
-    TIME_ZONE_CONVERT = [
-        ("(?:台灣)+|(?:Tai)+|(?:tai)+", 8),
-        ("(?:美國)+|(?:洛杉磯)+|(?:LA)+", -7),
-        ("(?:日本)+|(?:大阪)+", 9),
-    ]
-
-    def _split_country(self, message):
-        countries = message.split("時間轉換")
-        return countries[0], countries[1]
+    CACHE_RESPONSES = True
+    KEYWORD = "時間轉換"
+    # the postback data of the button is capped at 300 characters
+    MAX_TO_ZONES = 4
+    SLOTS = [("keyword", None, KEYWORD), ("region", None, gazetteer.pattern)]
+    TEMPLATE = MessageTemplate(
+        TemplateSendMessage(
+            alt_text="時間轉換",
+            template=ButtonsTemplate(
+                title="時間轉換",
+                text="{} 轉換至 {}".format(
+                    MessageTemplate.slot("from_country"),
+                    MessageTemplate.slot("to_country"),
+                ),
+                actions=[
+                    DatetimePickerAction(
+                        label="請選擇想轉換的時間",
+                        data="type=date_convert&action=choose&from_country={from_country}&to_country={to_country}&from_tz={from_tz}&to_tz={to_tz}".format(
+                            from_country=MessageTemplate.slot("from_country"),
+                            to_country=MessageTemplate.slot("to_country"),
+                            from_tz=MessageTemplate.slot("from_tz"),
+                            to_tz=MessageTemplate.slot("to_tz"),
+                        ),
+                        mode="datetime",
+                    )
+                ],
+            ),
+        )
+    )
+
+    def _split_regions(self):
+        from_regions, to_regions = [], []
+        if not self.slots.get("keyword"):
+            return from_regions, to_regions
+
+        keyword = self.slots["keyword"][0]
+        for token in self.slots.get("region", []):
+            if token.end <= keyword.start:
+                from_regions.append(token)
+            elif token.start >= keyword.end:
+                to_regions.append(token)
+        return from_regions, to_regions
+
+    def _pick_places(self, regions):
+        return gazetteer.pick(
+            [
+                Mention(
+                    token.text, gazetteer.lookup(token.text), token.start, token.end
+                )
+                for token in regions
+            ]
+        )
 
     @property
     def result(self):
-        from_country, to_country = self._split_country(self.message)
-        from_hours = 0
-        to_hours = 0
-        for zone, shift_hours in self.TIME_ZONE_CONVERT:
-            from_country_match = re.search(zone, from_country)
-            if not from_hours and from_country_match:
-                from_hours = shift_hours
-                from_country = from_country_match.group(0)
-
-            to_country_match = re.search(zone, to_country)
-            if not to_hours and to_country_match:
-                to_hours = shift_hours
-                to_country = to_country_match.group(0)
-
-        if from_hours and to_hours:
-            return TemplateSendMessage(
-                alt_text="時間轉換",
-                template=ButtonsTemplate(
-                    title="時間轉換",
-                    text="{} 轉換至 {}".format(from_country, to_country),
-                    actions=[
-                        DatetimePickerAction(
-                            label="請選擇想轉換的時間",
-                            data="type=date_convert&action=choose&from_country={from_country}&to_country={to_country}&from_hours={from_hours}&to_hours={to_hours}".format(
-                                from_country=from_country,
-                                to_country=to_country,
-                                from_hours=from_hours,
-                                to_hours=to_hours,
-                            ),
-                            mode="datetime",
-                        )
-                    ],
-                ),
+        from_regions, to_regions = self._split_regions()
+        from_places = self._pick_places(from_regions)[:1]
+        to_places = self._pick_places(to_regions)[: self.MAX_TO_ZONES]
+
+        if from_places and to_places:
+            return self.TEMPLATE.render(
+                from_country=from_places[0].text,
+                to_country="、".join(mention.text for mention in to_places),
+                from_tz=from_places[0].place.zone,
+                to_tz=",".join(mention.place.zone for mention in to_places),
             )
         return TextSendMessage(text="對不起 請輸入 <地區> 時間轉換 <地區>")
 
 
 class ReminderController(BaseController):
-    @property
-    def result(self):
-        return TemplateSendMessage(
+    SLOTS = [
+        ("repeat", DAILY, "每天|每日"),
+        ("repeat", WEEKDAYS, "平日|工作日"),
+        ("repeat", WEEKLY, "每週|每周|每星期|每個禮拜"),
+        ("repeat", MONTHLY, "每月|每個月"),
+        ("repeat", None, r"cron\([^)]*\)"),
+    ]
+    TEMPLATE = MessageTemplate(
+        TemplateSendMessage(
             alt_text="提醒小幫手",
             template=ButtonsTemplate(
                 title="提醒事項",
@@ -118,74 +164,127 @@ class ReminderController(BaseController):
                 actions=[
                     PostbackAction(
                         label="台灣時區",
-                        data="type=reminder&action=choose_date&tz=8&text={}".format(
-                            self.message
+                        data="type=reminder&action=choose_date&tz=Asia/Taipei&s={}".format(
+                            MessageTemplate.slot("state")
                         ),
                     ),
                     PostbackAction(
                         label="美國時區",
-                        data="type=reminder&action=choose_date&tz=-7&text={}".format(
-                            self.message
+                        data="type=reminder&action=choose_date&tz=America/Los_Angeles&s={}".format(
+                            MessageTemplate.slot("state")
                         ),
                     ),
                     PostbackAction(
                         label="日本時區",
-                        data="type=reminder&action=choose_date&tz=9&text={}".format(
-                            self.message
+                        data="type=reminder&action=choose_date&tz=Asia/Tokyo&s={}".format(
+                            MessageTemplate.slot("state")
                         ),
                     ),
                 ],
             ),
         )
+    )
+
+    def get_repeat(self):
+        tokens = self.slots.get("repeat")
+        if not tokens:
+            return ""
+        token = min(tokens, key=lambda token: token.start)
+        return token.value or token.text
+
+    @property
+    def result(self):
+        # the text stays server side, the buttons only name the zone
+        state = WoodyReminder.save_state(
+            self.key, text=self.message, repeat=self.get_repeat()
+        )
+        return self.TEMPLATE.render(state=state)
+
+
+class ReminderListController(BaseController):
+    @property
+    def result(self):
+        return JOB_API.dispatch(WoodyReminder.TYPE, "list", data={}, key=self.key)
+
+
+class ReminderCancelController(BaseController):
+    SLOTS = [("number", None, r"\d+")]
+
+    @property
+    def result(self):
+        numbers = self.slots.get("number")
+        if not numbers:
+            return JOB_API.dispatch(WoodyReminder.TYPE, "list", data={}, key=self.key)
+        return JOB_API.dispatch(
+            WoodyReminder.TYPE,
+            "cancel",
+            data={"reminder_id": numbers[0].text},
+            key=self.key,
+        )
 
 
 class BaseParser(with_metaclass(ABCMeta, object)):
     CONVERT_CLASSES = []  # should be a tuple ("key", converter class)
 
-    def __init__(self, message, user_id=None, room_id=None):
+    def __init__(self, message, key=""):
         self.value = message
-        self.user_id = user_id
-        self.room_id = room_id
+        self.key = key
         assert self.CONVERT_CLASSES, "You should provide CONVERT_CLASSES when using"
 
+    @classmethod
+    def get_router(cls):
+        # intents only, the controller that wins extracts its own slots. In
+        # one alternation the slots of every controller compete for the same
+        # characters, a single letter unit took the C of Chicago from region
+        router = cls.__dict__.get("_router")
+        if router is None:
+            router = cls._router = IntentRouter(cls.CONVERT_CLASSES)
+        return router
+
     def parse(self):
-        converter = self.from_key_to_class()
-        return converter(
-            message=self.value, user_id=self.user_id, room_id=self.room_id
-        ).result
+        with STAGE_SECONDS.time(stage="route"):
+            route = self.get_router().route(self.value)
+        if route.intent is None:
+            raise KeyError
+
+        with STAGE_SECONDS.time(stage="controller", intent=route.intent.__name__):
+            return route.intent(message=self.value, key=self.key).response
 
     def from_key_to_class(self):
-        for type, converter in self.CONVERT_CLASSES:
-            if re.search(type, self.value):
-                return converter
+        converter = self.get_router().route(self.value).intent
+        if converter is None:
+            raise KeyError
 
-        raise KeyError
+        return converter
 
 
 class TextParser(BaseParser):
     CONVERT_CLASSES = [
-        ("溫度", TemperatureController),
+        (keyword, UnitConvertController) for keyword in UnitConvertController.KEYWORDS
+    ] + [
+        # before 提醒, which they contain
+        ("我的提醒", ReminderListController),
+        ("取消提醒", ReminderCancelController),
         ("提醒", ReminderController),
         ("時間轉換", DateTimeConvertController),
+        # a quantity asked to be converted, 10公里轉英里
+        (unit_table.pattern, UnitConvertController),
     ]
 
 
 class BaseGenerator(with_metaclass(ABCMeta, object)):
     PARSER = None
 
-    def __init__(self, message, user_id="", room_id=""):
+    def __init__(self, message, key=""):
         self.message = message
-        self.user_id = user_id
-        self.room_id = room_id
+        self.key = key
 
     def generate(self):
         parser = self.get_parser()
         return parser.parse()
 
     def get_parser(self):
-        return self.PARSER(
-            message=self.message, user_id=self.user_id, room_id=self.room_id
-        )
+        return self.PARSER(message=self.message, key=self.key)
 
 
 class TextGenerator(BaseGenerator):
@@ -0,0 +1,326 @@
+"""
+An asyncio front end for the webhook. It shares the signature check,
+TextGenerator and JOB_API with the django view, but replies through an
+aiohttp connection pool, so a process keeps many conversations in flight
+while their LINE API calls are outstanding.
+
+    gunicorn line_bot.aio:app --worker-class aiohttp.GunicornWebWorker
+"""
+
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, web
+from django.conf import settings
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
+from linebot.models import (
+    FollowEvent,
+    JoinEvent,
+    LeaveEvent,
+    MessageEvent,
+    PostbackEvent,
+    TextMessage,
+    UnfollowEvent,
+)
+from linebot.models.error import Error
+
+from webhooks.audience import audience
+from webhooks.breaker import CircuitOpen, line_api_breaker
+from webhooks.dedup import is_redelivered
+from webhooks.dispatch import (
+    db_connections,
+    get_push_target,
+    group_by_conversation,
+    parse_payload,
+    verify_signature,
+)
+from webhooks.http_client import (
+    RETRIES,
+    get_retry_delay,
+    is_accepted_before,
+    is_retryable,
+    with_retry_key,
+)
+from webhooks.line_api import line_bot_api
+from webhooks.metrics import STAGE_SECONDS, render
+from webhooks.outbound import (
+    BROKEN,
+    PUSH_PATH,
+    PUSHED,
+    REPLIED,
+    REPLY_PATH,
+    USED,
+    get_rejected_path,
+    has_reply_budget,
+    is_expired_token,
+    push_body,
+    record_answer,
+    reply_body,
+)
+from webhooks.ratelimit import PUSH, REPLY, THROTTLE_SECONDS, outbound_limiter
+from webhooks.views import (
+    build_postback_reply,
+    build_text_reply,
+    handle_gone,
+    handle_joined,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncLineClient(object):
+    def __init__(
+        self,
+        endpoint,
+        headers,
+        timeout,
+        pool_size=100,
+        max_retries=3,
+        backoff=0.2,
+        max_backoff=5.0,
+        on_throttle=None,
+    ):
+        self.endpoint = endpoint
+        self.headers = dict(headers, **{"Content-Type": "application/json"})
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.on_throttle = on_throttle
+        self.session = None
+
+    async def start(self):
+        # sessions belong to a loop, so they are made once the worker runs one
+        self.session = ClientSession(
+            connector=TCPConnector(limit=self.pool_size),
+            headers=self.headers,
+            timeout=self.timeout,
+        )
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def post(self, path, body):
+        url = self.endpoint + path
+        data = body.encode("utf-8")
+        headers = with_retry_key(url, {})
+        attempt = 0
+        while True:
+            async with self.session.post(url, data=data, headers=headers) as response:
+                status = response.status
+                payload = await response.text()
+                retry_after = response.headers.get("Retry-After")
+            if 200 <= status < 300 or is_accepted_before(attempt, status, headers):
+                return
+            if status == 429 and self.on_throttle is not None:
+                self.on_throttle(url, retry_after)
+            if not is_retryable("POST", status, headers) or attempt >= self.max_retries:
+                raise LineBotApiError(status, Error.new_from_json_dict(_loads(payload)))
+
+            RETRIES.inc(status=str(status))
+            await asyncio.sleep(
+                get_retry_delay(attempt, self.backoff, self.max_backoff, retry_after)
+            )
+            attempt += 1
+
+
+def _loads(payload):
+    try:
+        return json.loads(payload)
+    except ValueError:
+        return {"message": payload}
+
+
+line_client = AsyncLineClient(
+    line_bot_api.endpoint,
+    line_bot_api.headers,
+    ClientTimeout(
+        sock_connect=settings.LINE_API_CONNECT_TIMEOUT,
+        sock_read=settings.LINE_API_READ_TIMEOUT,
+    ),
+    pool_size=settings.LINE_API_ASYNC_POOL_SIZE,
+    max_retries=settings.LINE_API_HTTP_OPTIONS["max_retries"],
+    backoff=settings.LINE_API_HTTP_OPTIONS["backoff"],
+    on_throttle=outbound_limiter.throttled if settings.OUTBOUND_RATE_LIMITED else None,
+)
+
+
+async def _post(path, body, client):
+    with STAGE_SECONDS.time(stage="line_api", endpoint=path.rsplit("/", 1)[-1]):
+        if settings.LINE_API_BREAKER:
+            # record() may run the breaker script, it goes to the executor
+            try:
+                with line_api_breaker.measure() as outcome:
+                    await client.post(path, body)
+            finally:
+                if outcome:
+                    await run_sync(line_api_breaker.record, *outcome)
+        else:
+            await client.post(path, body)
+
+
+def run_sync(func, *args):
+    # redis and database calls block, they go to the loop's executor so a
+    # slow one holds up its own conversation only
+    return asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+
+async def acquire(kind, limiter=outbound_limiter):
+    # limiter.acquire, sleeping on the loop instead of the thread
+    deadline = time.time() + limiter.reply_max_wait
+    while True:
+        wait = min(await run_sync(limiter.try_acquire, kind), deadline - time.time())
+        if wait <= 0:
+            return
+        THROTTLE_SECONDS.inc(wait, kind=kind)
+        await asyncio.sleep(wait)
+
+
+async def reply_message(reply_token, messages, client=line_client):
+    if settings.LINE_API_BREAKER:
+        await run_sync(line_api_breaker.check, REPLY)
+    if settings.OUTBOUND_RATE_LIMITED:
+        await acquire(REPLY)
+    await _post(REPLY_PATH, reply_body(reply_token, messages), client)
+
+
+async def push_message(to, messages, client=line_client):
+    body = push_body(to, messages)
+    if settings.LINE_API_BREAKER and not await run_sync(line_api_breaker.allow):
+        await run_sync(line_api_breaker.park, PUSH, PUSH_PATH, body)
+        return
+    if settings.OUTBOUND_RATE_LIMITED and not await run_sync(
+        outbound_limiter.submit, PUSH, PUSH_PATH, body
+    ):
+        return
+    await _post(PUSH_PATH, body, client)
+
+
+async def answer(event, messages, client=line_client):
+    # outbound.answer on the loop
+    path = PUSHED
+    if has_reply_budget(event):
+        try:
+            await reply_message(event.reply_token, messages, client=client)
+            path = REPLIED
+        except LineBotApiError as e:
+            if not is_expired_token(e):
+                raise
+            path = get_rejected_path(event)
+            logger.warning("reply token of a %s event %s", event.type, path)
+        except CircuitOpen:
+            path = BROKEN
+    if path not in (REPLIED, USED):
+        await push_message(get_push_target(event.source), messages, client=client)
+    record_answer(event, path)
+
+
+def get_reply_builder(event):
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+        return build_text_reply
+    if isinstance(event, PostbackEvent):
+        return build_postback_reply
+    return None
+
+
+def build_reply(build, event):
+    # None for an event LINE delivered before
+    with db_connections():
+        if is_redelivered(event):
+            return None
+        audience.record(event.source)
+        return build(event)
+
+
+def get_membership_handler(event):
+    if isinstance(event, (FollowEvent, JoinEvent)):
+        return handle_joined
+    if isinstance(event, (UnfollowEvent, LeaveEvent)):
+        return handle_gone
+    return None
+
+
+async def handle_event(event):
+    membership = get_membership_handler(event)
+    if membership is not None:
+        await run_sync(membership, event)
+        return
+
+    build = get_reply_builder(event)
+    if build is None:
+        logger.info("no handler for %s", event.__class__.__name__)
+        return
+
+    with STAGE_SECONDS.time(stage="event", event=event.type):
+        messages = await run_sync(build_reply, build, event)
+        if messages is not None:
+            await answer(event, messages)
+
+
+async def callback(request):
+    received_at = time.time()
+    signature = request.headers.get("X-Line-Signature", "")
+    body = await request.text()
+    try:
+        verify_signature(body, signature)
+    except InvalidSignatureError:
+        return web.Response(status=403)
+
+    payload = parse_payload(body)
+    for event in payload.events:
+        event.received_at = received_at
+    await handle_events(payload.events)
+    return web.Response(text="Ok")
+
+
+async def handle_events(events, concurrency=settings.WEBHOOK_EVENT_CONCURRENCY):
+    # like dispatch.EventPool, a conversation's events run in order on one
+    # lane and a webhook gets at most `concurrency` lanes
+    pending = deque(group_by_conversation(events))
+
+    async def drain():
+        while pending:
+            for event in pending.popleft():
+                try:
+                    await handle_event(event)
+                except LineBotApiError as e:
+                    logger.warning(
+                        "LINE API error %s %s", e.status_code, e.error.message
+                    )
+                except Exception:
+                    logger.exception("failed to handle %s event", event.type)
+
+    await asyncio.gather(*[drain() for _ in range(min(concurrency, len(pending)))])
+
+
+async def metrics(request):
+    # the same content type as fastpath.metrics, aiohttp would only take a
+    # bare one and add the charset
+    return web.Response(
+        body=render().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+async def _start_client(app):
+    await line_client.start()
+
+
+async def _close_client(app):
+    await line_client.close()
+
+
+def create_app():
+    app = web.Application()
+    app.router.add_post("/webhooks/callback", callback)
+    app.router.add_post("/webhooks/callback/", callback)
+    app.router.add_get("/webhooks/metrics", metrics)
+    app.on_startup.append(_start_client)
+    app.on_cleanup.append(_close_client)
+    return app
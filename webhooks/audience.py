@@ -0,0 +1,274 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from webhooks.delivery import (
+    MAX_MULTICAST_RECIPIENTS,
+    MULTICAST,
+    PUSH,
+    Call,
+    execute_plan,
+)
+from webhooks.dispatch import get_conversation_id
+from webhooks.metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+# friends reached by multicast, and the groups and rooms pushed one by one
+USERS = "users"
+CONVERSATIONS = "conversations"
+
+BROADCAST_RECIPIENTS = Counter(
+    "broadcast_recipients_total", "Recipients a broadcast was sent to."
+)
+BROADCAST_FAILURES = Counter(
+    "broadcast_failed_total", "Recipients a broadcast failed to reach."
+)
+BROADCAST_CHUNK_SECONDS = Histogram(
+    "broadcast_chunk_seconds", "Time spent sending one chunk of a broadcast."
+)
+
+
+def get_audience_member(source):
+    # a user is only an audience of its own when it talks to the bot directly,
+    # users of a group are reached through the group
+    conversation_id = get_conversation_id(source)
+    if conversation_id:
+        return CONVERSATIONS, conversation_id
+    user_id = getattr(source, "user_id", None)
+    if user_id:
+        return USERS, user_id
+    return None
+
+
+class AudienceRegistry(object):
+    """
+    Every user, group and room the bot heard from, in two Redis sets. A
+    process remembers the members it already added in a bounded LRU for
+    ``ttl`` seconds, so a busy conversation costs a dict lookup per event,
+    not a Redis call, and a member another process forgot is added back
+    within ``ttl``. A follow or a join always adds its member.
+    """
+
+    def __init__(self, alias="default", size=100000, ttl=300, prefix="audience"):
+        self.alias = alias
+        self.size = size
+        self.ttl = ttl
+        self.prefix = prefix
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def redis(self):
+        return get_redis_connection(self.alias)
+
+    def key(self, kind):
+        return "{}:{}".format(self.prefix, kind)
+
+    def record(self, source, refresh=False):
+        member = get_audience_member(source)
+        if member is None:
+            return
+        now = time.time()
+        with self.lock:
+            added_at = self.seen.get(member)
+            if not refresh and added_at is not None and now - added_at < self.ttl:
+                self.seen.move_to_end(member)
+                return
+            self.seen[member] = now
+            self.seen.move_to_end(member)
+            while len(self.seen) > self.size:
+                self.seen.popitem(last=False)
+
+        kind, target = member
+        try:
+            self.redis.sadd(self.key(kind), target)
+        except Exception:
+            logger.exception("audience registry unavailable")
+            with self.lock:
+                self.seen.pop(member, None)
+
+    def forget(self, source):
+        member = get_audience_member(source)
+        if member is None:
+            return
+        with self.lock:
+            self.seen.pop(member, None)
+        kind, target = member
+        try:
+            self.redis.srem(self.key(kind), target)
+        except Exception:
+            logger.exception("audience registry unavailable")
+
+    def count(self):
+        return {
+            kind: self.redis.scard(self.key(kind)) for kind in (USERS, CONVERSATIONS)
+        }
+
+
+class Broadcaster(object):
+    """
+    Sends texts to a snapshot of the audience in chunks, one multicast per
+    chunk of users and a push per group or room, so the chunks can run on
+    as many celery workers as there are. Every finished chunk is checked
+    off in Redis, a chunk that is run again or resumed after a crash is
+    skipped once it finished, an interrupted one is sent again.
+    """
+
+    def __init__(
+        self,
+        registry,
+        alias="default",
+        user_chunk=MAX_MULTICAST_RECIPIENTS,
+        conversation_chunk=100,
+        ttl=7 * 24 * 3600,
+        prefix="broadcast",
+    ):
+        self.registry = registry
+        self.alias = alias
+        self.chunk_sizes = {USERS: user_chunk, CONVERSATIONS: conversation_chunk}
+        self.ttl = ttl
+        self.prefix = prefix
+
+    @property
+    def redis(self):
+        return get_redis_connection(self.alias)
+
+    def _key(self, broadcast_id, name):
+        return "{}:{}:{}".format(self.prefix, broadcast_id, name)
+
+    def start(self, texts):
+        """
+        Snapshots the audience and returns the id of the broadcast and its
+        chunks as (kind, start) pairs. Members recorded from now on are not
+        part of it.
+        """
+        broadcast_id = uuid.uuid4().hex[:12]
+        redis = self.redis
+        sizes = {}
+        for kind in (USERS, CONVERSATIONS):
+            # sorted into a list, so a chunk is a stable slice of it
+            sizes[kind] = redis.sort(
+                self.registry.key(kind),
+                alpha=True,
+                store=self._key(broadcast_id, kind),
+            )
+        chunks = [
+            (kind, start)
+            for kind in (USERS, CONVERSATIONS)
+            for start in range(0, sizes[kind], self.chunk_sizes[kind])
+        ]
+
+        pipeline = redis.pipeline()
+        pipeline.hmset(
+            self._key(broadcast_id, "meta"),
+            {
+                "texts": json.dumps(texts),
+                "users": sizes[USERS],
+                "conversations": sizes[CONVERSATIONS],
+                "chunks": len(chunks),
+                # a resumed broadcast slices the same chunks whatever the
+                # settings are by then
+                "users_chunk": self.chunk_sizes[USERS],
+                "conversations_chunk": self.chunk_sizes[CONVERSATIONS],
+                "started_at": time.time(),
+            },
+        )
+        for name in ("meta", USERS, CONVERSATIONS):
+            pipeline.expire(self._key(broadcast_id, name), self.ttl)
+        pipeline.execute()
+        return broadcast_id, chunks
+
+    def run_chunk(self, broadcast_id, kind, start):
+        redis = self.redis
+        done_key = self._key(broadcast_id, "done")
+        checkpoint = "{}:{}".format(kind, start)
+        if redis.sismember(done_key, checkpoint):
+            return 0
+
+        texts, size = redis.hmget(
+            self._key(broadcast_id, "meta"), "texts", "{}_chunk".format(kind)
+        )
+        targets = [
+            target.decode("utf-8")
+            for target in redis.lrange(
+                self._key(broadcast_id, kind), start, start + int(size) - 1
+            )
+        ]
+        texts = json.loads(texts)
+
+        started = time.time()
+        if kind == USERS:
+            failed = len(targets) * execute_plan([Call(MULTICAST, targets, texts)])
+        else:
+            failed = execute_plan([Call(PUSH, target, texts) for target in targets])
+        BROADCAST_CHUNK_SECONDS.observe(time.time() - started, kind=kind)
+        BROADCAST_RECIPIENTS.inc(len(targets) - failed, kind=kind)
+        if failed:
+            BROADCAST_FAILURES.inc(failed, kind=kind)
+
+        pipeline = redis.pipeline()
+        pipeline.sadd(done_key, checkpoint)
+        pipeline.expire(done_key, self.ttl)
+        pipeline.hincrby(self._key(broadcast_id, "meta"), "sent", len(targets) - failed)
+        pipeline.hincrby(self._key(broadcast_id, "meta"), "failed", failed)
+        pipeline.scard(done_key)
+        pipeline.hget(self._key(broadcast_id, "meta"), "chunks")
+        finished, chunks = pipeline.execute()[-2:]
+        if finished == int(chunks):
+            redis.hsetnx(self._key(broadcast_id, "meta"), "finished_at", time.time())
+            logger.info("broadcast %s %s", broadcast_id, self.status(broadcast_id))
+        return len(targets) - failed
+
+    def pending(self, broadcast_id):
+        # the chunks a resumed broadcast still has to send
+        meta = self._meta(broadcast_id)
+        done = self.redis.smembers(self._key(broadcast_id, "done"))
+        return [
+            (kind, start)
+            for kind in (USERS, CONVERSATIONS)
+            for start in range(0, int(meta[kind]), int(meta[kind + "_chunk"]))
+            if "{}:{}".format(kind, start).encode("utf-8") not in done
+        ]
+
+    def _meta(self, broadcast_id):
+        meta = self.redis.hgetall(self._key(broadcast_id, "meta"))
+        if not meta:
+            raise KeyError(broadcast_id)
+        return {
+            key.decode("utf-8"): value.decode("utf-8") for key, value in meta.items()
+        }
+
+    def status(self, broadcast_id):
+        meta = self._meta(broadcast_id)
+        started_at = float(meta["started_at"])
+        elapsed = float(meta.get("finished_at") or time.time()) - started_at
+        sent = int(meta.get("sent", 0))
+        return {
+            "recipients": int(meta[USERS]) + int(meta[CONVERSATIONS]),
+            "sent": sent,
+            "failed": int(meta.get("failed", 0)),
+            "chunks": int(meta["chunks"]),
+            "done": self.redis.scard(self._key(broadcast_id, "done")),
+            "finished": "finished_at" in meta,
+            "seconds": round(elapsed, 1),
+            "per_second": round(sent / elapsed, 1) if elapsed > 0 else 0.0,
+        }
+
+
+audience = AudienceRegistry(
+    settings.AUDIENCE_REDIS_ALIAS,
+    size=settings.AUDIENCE_LOCAL_SIZE,
+    ttl=settings.AUDIENCE_LOCAL_TTL,
+)
+broadcaster = Broadcaster(
+    audience,
+    settings.AUDIENCE_REDIS_ALIAS,
+    conversation_chunk=settings.BROADCAST_CONVERSATION_CHUNK,
+)
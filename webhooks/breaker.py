@@ -0,0 +1,375 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django_redis import get_redis_connection
+from linebot.exceptions import LineBotApiError
+
+from webhooks.metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+
+STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# Whether a call may go out. An open breaker turns half open once
+# open_seconds have passed, and a half open one lets `probes` calls through
+# until one of them is recorded, or another open_seconds passed without.
+ALLOW_SCRIPT = """
+local now, open_seconds, probes = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local state = redis.call('HGET', KEYS[1], 'state') or 'closed'
+local transition = ''
+
+if state ~= 'closed' then
+    local opened_at = tonumber(redis.call('HGET', KEYS[1], 'opened_at')) or 0
+    if now - opened_at >= open_seconds then
+        if state == 'open' then
+            transition = 'half_open'
+        end
+        state = 'half_open'
+        redis.call('HSET', KEYS[1], 'state', state, 'opened_at', tostring(now), 'probes', 0)
+    elseif state == 'open' then
+        return {state, '0', transition}
+    end
+end
+if state == 'half_open' then
+    local sent = redis.call('HINCRBY', KEYS[1], 'probes', 1)
+    return {state, sent <= probes and '1' or '0', transition}
+end
+return {state, '1', transition}
+"""
+
+# Adds a batch of calls to the window, counters in a hash per `bucket`
+# seconds. A closed breaker opens once the calls of the last `window`
+# seconds, at least min_calls of them, failed at error_rate or their
+# percentile latency reached slow_seconds, which is more of them than
+# lie above the percentile taking slow_seconds or longer. A probe of a half
+# open breaker closes or reopens it, other calls no longer count there.
+RECORD_SCRIPT = """
+local now, calls, failures, slow = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local probe, window, bucket = ARGV[5] == '1', tonumber(ARGV[6]), tonumber(ARGV[7])
+local min_calls, error_rate, percentile = tonumber(ARGV[8]), tonumber(ARGV[9]), tonumber(ARGV[10])
+local state = redis.call('HGET', KEYS[1], 'state') or 'closed'
+local current = math.floor(now / bucket)
+local oldest = math.floor((now - window) / bucket)
+
+local function open()
+    redis.call('HSET', KEYS[1], 'state', 'open', 'opened_at', tostring(now))
+    for index = oldest, current do
+        redis.call('DEL', KEYS[2] .. ':' .. index)
+    end
+    return {'open', 'open'}
+end
+
+if state == 'open' or (state == 'half_open' and not probe) then
+    return {state, ''}
+end
+if state == 'half_open' then
+    if failures > 0 or slow > 0 then
+        return open()
+    end
+    redis.call('HSET', KEYS[1], 'state', 'closed')
+    return {'closed', 'closed'}
+end
+
+local key = KEYS[2] .. ':' .. current
+redis.call('HINCRBY', key, 'calls', calls)
+redis.call('HINCRBY', key, 'failures', failures)
+redis.call('HINCRBY', key, 'slow', slow)
+redis.call('EXPIRE', key, window + bucket)
+
+local total, failed, slower = 0, 0, 0
+for index = oldest + 1, current do
+    local counts = redis.call('HMGET', KEYS[2] .. ':' .. index, 'calls', 'failures', 'slow')
+    total = total + (tonumber(counts[1]) or 0)
+    failed = failed + (tonumber(counts[2]) or 0)
+    slower = slower + (tonumber(counts[3]) or 0)
+end
+if total < min_calls then
+    return {state, ''}
+end
+if failed / total >= error_rate or slower > total - math.max(1, math.ceil(total * percentile)) then
+    return open()
+end
+return {state, ''}
+"""
+
+TRANSITIONS = Counter(
+    "line_api_breaker_transitions_total",
+    "Times the LINE API circuit breaker changed state.",
+)
+REJECTED_CALLS = Counter(
+    "line_api_breaker_rejected_total",
+    "LINE API calls failed fast or parked while the breaker was open.",
+)
+PARKED_CALLS = Counter(
+    "line_api_parked_total", "Pushes and multicasts parked while the breaker was open."
+)
+DRAINED_CALLS = Counter(
+    "line_api_parked_drained_total",
+    "Parked calls sent, or dropped when LINE refused them, after recovery.",
+)
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+def is_failure(error):
+    # a 4xx is about the request, not the health of the API, 429s are the
+    # rate limiter's business
+    if isinstance(error, LineBotApiError):
+        return error.status_code >= 500
+    return True
+
+
+class CircuitBreaker(object):
+    """
+    Trips on the error rate or latency of LINE API calls made by every web
+    and celery process, shared through Redis. While it is open calls fail
+    fast, pushes and multicasts are parked in a Redis list and drain() sends
+    them once a probe got through. Without Redis every call is let through.
+    A process counts its calls locally and adds them to the shared window
+    once every ``flush_seconds`` or ``flush_calls`` calls. A failed or slow
+    call, which may be what opens the breaker, and a probe are added right
+    away, they never wait for a call that may not come.
+    """
+
+    def __init__(
+        self,
+        alias="default",
+        window=30,
+        min_calls=20,
+        error_rate=0.5,
+        slow_seconds=2.0,
+        percentile=0.95,
+        open_seconds=30,
+        probes=1,
+        bucket_seconds=5,
+        flush_seconds=1.0,
+        flush_calls=1000,
+        cache_seconds=1.0,
+        prefix="line_api:breaker",
+    ):
+        self.alias = alias
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_seconds = slow_seconds
+        self.percentile = percentile
+        self.open_seconds = open_seconds
+        self.probes = probes
+        self.bucket_seconds = bucket_seconds
+        self.flush_seconds = flush_seconds
+        self.flush_calls = flush_calls
+        # a closed breaker is trusted locally this long between calls
+        self.cache_seconds = cache_seconds
+        self.state_key = "{}:state".format(prefix)
+        self.window_key = "{}:window".format(prefix)
+        self.parked_key = "{}:parked".format(prefix)
+        self.inflight_key = "{}:inflight".format(prefix)
+        self.drain_lock_key = "{}:draining".format(prefix)
+        self.state = CLOSED
+        self.checked_at = 0
+        # calls, failures and slow calls not yet added to the window
+        self.batch = [0, 0, 0]
+        self.flushed_at = 0
+        self.batch_lock = threading.Lock()
+        self._allow_script = None
+        self._record_script = None
+
+    @property
+    def redis(self):
+        return get_redis_connection(self.alias)
+
+    @property
+    def allow_script(self):
+        if self._allow_script is None:
+            self._allow_script = self.redis.register_script(ALLOW_SCRIPT)
+        return self._allow_script
+
+    @property
+    def record_script(self):
+        if self._record_script is None:
+            self._record_script = self.redis.register_script(RECORD_SCRIPT)
+        return self._record_script
+
+    def _update(self, state, transition):
+        self.state = state.decode("utf-8")
+        self.checked_at = time.time()
+        if transition:
+            transition = transition.decode("utf-8")
+            TRANSITIONS.inc(to=transition)
+            logger.warning("LINE API circuit breaker %s", transition)
+
+    def allow(self):
+        if self.state == CLOSED and time.time() - self.checked_at < self.cache_seconds:
+            return True
+        try:
+            state, allowed, transition = self.allow_script(
+                keys=[self.state_key],
+                args=[time.time(), self.open_seconds, self.probes],
+            )
+        except Exception:
+            logger.exception("circuit breaker unavailable")
+            return True
+        self._update(state, transition)
+        return allowed == b"1"
+
+    def record(self, latency, failed, probe=False):
+        call = [1, 1 if failed else 0, 1 if latency >= self.slow_seconds else 0]
+        if probe:
+            self._flush(call, probe=True)
+            return
+
+        now = time.time()
+        with self.batch_lock:
+            self.batch = [total + count for total, count in zip(self.batch, call)]
+            if (
+                not (call[1] or call[2])
+                and self.batch[0] < self.flush_calls
+                and now - self.flushed_at < self.flush_seconds
+            ):
+                return
+            batch, self.batch = self.batch, [0, 0, 0]
+            self.flushed_at = now
+        self._flush(batch)
+
+    def _flush(self, batch, probe=False):
+        try:
+            state, transition = self.record_script(
+                keys=[self.state_key, self.window_key],
+                args=[time.time()]
+                + batch
+                + [
+                    1 if probe else 0,
+                    self.window,
+                    self.bucket_seconds,
+                    self.min_calls,
+                    self.error_rate,
+                    self.percentile,
+                ],
+            )
+        except Exception:
+            logger.exception("circuit breaker unavailable")
+            return
+        self._update(state, transition)
+
+    def check(self, kind):
+        if not self.allow():
+            REJECTED_CALLS.inc(kind=kind)
+            raise CircuitOpen("LINE API circuit breaker is {}".format(self.state))
+
+    @contextmanager
+    def measure(self):
+        # fills the list with what record() takes once the call in the block
+        # returned or failed, for callers that record it somewhere else.
+        # allow() just let the call through as a probe when it left the
+        # breaker half open
+        outcome = []
+        probe = self.state == HALF_OPEN
+        started = time.time()
+        try:
+            yield outcome
+        except Exception as e:
+            outcome.extend([time.time() - started, is_failure(e), probe])
+            raise
+        outcome.extend([time.time() - started, False, probe])
+
+    @contextmanager
+    def track(self):
+        # measure() and record() in one, without nesting a second generator
+        # on every call
+        probe = self.state == HALF_OPEN
+        started = time.time()
+        try:
+            yield
+        except Exception as e:
+            self.record(time.time() - started, is_failure(e), probe=probe)
+            raise
+        self.record(time.time() - started, False, probe=probe)
+
+    def park(self, kind, path, body):
+        item = json.dumps(
+            {"kind": kind, "path": path, "body": body, "parked_at": time.time()}
+        )
+        # oldest at the right, where drain pops. The beat's drain_parked
+        # picks it up within LINE_API_PARKED_DRAIN_INTERVAL
+        self.redis.lpush(self.parked_key, item)
+        REJECTED_CALLS.inc(kind=kind)
+        PARKED_CALLS.inc(kind=kind)
+
+    def drain(self, send, budget=5.0):
+        """
+        Sends parked calls in order for up to ``budget`` seconds while the
+        breaker lets them through, and returns how many left the list.
+        ``send(path, body)`` records its calls with track(). An item
+        stays in the inflight list until it was sent, so a worker lost
+        mid-call leaves it for the next drain instead of losing it.
+        """
+        redis = self.redis
+        if not redis.set(self.drain_lock_key, 1, nx=True, px=int(budget * 2000) or 1):
+            return 0
+        try:
+            self._restore_inflight(redis)
+            deadline = time.time() + budget
+            sent = 0
+            # a probe is only spent on a parked call
+            while time.time() < deadline and redis.llen(self.parked_key):
+                if not self.allow():
+                    break
+                value = redis.rpoplpush(self.parked_key, self.inflight_key)
+                item = json.loads(value.decode("utf-8"))
+                try:
+                    send(item["path"], item["body"])
+                except Exception as e:
+                    if is_failure(e) or (
+                        isinstance(e, LineBotApiError) and e.status_code == 429
+                    ):
+                        self._restore_inflight(redis)
+                        break
+                    logger.exception("parked %s failed", item["kind"])
+                redis.lrem(self.inflight_key, 1, value)
+                DRAINED_CALLS.inc(kind=item["kind"])
+                sent += 1
+            return sent
+        finally:
+            redis.delete(self.drain_lock_key)
+
+    def _restore_inflight(self, redis):
+        # back to the oldest end of the parked list, in the same order
+        items = redis.lrange(self.inflight_key, 0, -1)
+        if items:
+            pipeline = redis.pipeline()
+            pipeline.rpush(self.parked_key, *reversed(items))
+            pipeline.delete(self.inflight_key)
+            pipeline.execute()
+
+    def parked_depth(self):
+        return self.redis.llen(self.parked_key) + self.redis.llen(self.inflight_key)
+
+    def current_state(self):
+        state = self.redis.hget(self.state_key, "state")
+        return state.decode("utf-8") if state else CLOSED
+
+
+line_api_breaker = CircuitBreaker(
+    settings.LINE_API_BREAKER_ALIAS, **settings.LINE_API_BREAKER_OPTIONS
+)
+
+BREAKER_STATE = Gauge(
+    "line_api_breaker_state",
+    "State of the LINE API circuit breaker, 0 closed, 1 half open and 2 open.",
+    collect=lambda: [({}, STATES[line_api_breaker.current_state()])],
+)
+PARKED_DEPTH = Gauge(
+    "line_api_parked_depth",
+    "Pushes and multicasts parked until the LINE API recovers.",
+    collect=lambda: [({}, line_api_breaker.parked_depth())],
+)
@@ -0,0 +1,120 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from webhooks.messages import SerializedMessage, to_json
+from webhooks.metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+CACHE_LOOKUPS = Counter(
+    "response_cache_lookups_total",
+    "Reply cache lookups, found in this process, in the shared cache or built.",
+)
+CACHE_SAVED_SECONDS = Counter(
+    "response_cache_saved_seconds_total",
+    "Controller time the cached replies saved, what they took to build.",
+)
+
+
+class ResponseCache(object):
+    """
+    LRU of serialized replies with a size and a ttl limit, optionally backed
+    by a shared Django cache so every process benefits from a warm entry.
+    Every entry remembers how long it took to build, which is what a hit
+    saves.
+    """
+
+    def __init__(self, size=1024, ttl=600, shared_alias=None, prefix="webhooks:reply"):
+        self.size = size
+        self.ttl = ttl
+        self.shared_alias = shared_alias
+        self.prefix = prefix
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def shared(self):
+        return caches[self.shared_alias] if self.shared_alias else None
+
+    def _get_local(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def _set_local(self, key, payload, cost):
+        with self.lock:
+            self.entries[key] = (payload, cost, time.time() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def _get_shared(self, key):
+        try:
+            value = self.shared.get("{}:{}".format(self.prefix, key))
+        except Exception:
+            logger.exception("shared reply cache unavailable")
+            return None
+        return json.loads(value) if value else None
+
+    def _set_shared(self, key, payload, cost):
+        try:
+            self.shared.set(
+                "{}:{}".format(self.prefix, key),
+                json.dumps([payload, cost]),
+                timeout=self.ttl,
+            )
+        except Exception:
+            logger.exception("shared reply cache unavailable")
+
+    def get_or_build(self, key, build):
+        entry = self._get_local(key)
+        if entry is not None:
+            CACHE_LOOKUPS.inc(result="hit")
+            CACHE_SAVED_SECONDS.inc(entry[1])
+            return SerializedMessage(json_string=entry[0])
+
+        if self.shared_alias:
+            entry = self._get_shared(key)
+            if entry is not None:
+                CACHE_LOOKUPS.inc(result="shared_hit")
+                CACHE_SAVED_SECONDS.inc(entry[1])
+                self._set_local(key, entry[0], entry[1])
+                return SerializedMessage(json_string=entry[0])
+
+        started = time.time()
+        payload = to_json(build())
+        cost = time.time() - started
+        CACHE_LOOKUPS.inc(result="miss")
+        self._set_local(key, payload, cost)
+        if self.shared_alias:
+            self._set_shared(key, payload, cost)
+        return SerializedMessage(json_string=payload)
+
+
+def normalize(message):
+    return " ".join(message.split())
+
+
+response_cache = ResponseCache(
+    size=settings.RESPONSE_CACHE_SIZE,
+    ttl=settings.RESPONSE_CACHE_TTL,
+    shared_alias=settings.RESPONSE_CACHE_SHARED_ALIAS,
+)
+
+CACHE_SIZE = Gauge(
+    "response_cache_entries",
+    "Replies kept in the cache of this process.",
+    collect=lambda: [({}, len(response_cache.entries))],
+)
@@ -0,0 +1,235 @@
+import hashlib
+import logging
+import math
+import os
+import struct
+import threading
+import time
+from functools import wraps
+from queue import Queue
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from webhooks.metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+DEDUP_EVENTS = Counter(
+    "webhook_dedup_events_total",
+    "Webhook events checked for redelivery, by result and by whether the "
+    "local filter or Redis decided it.",
+)
+DEDUP_FALSE_POSITIVES = Counter(
+    "webhook_dedup_filter_false_positives_total",
+    "Events the local filter took for possible duplicates that Redis found new.",
+)
+
+
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate=0.001):
+        # the textbook sizing for capacity items at the given error rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.md5(key.encode("utf-8")).digest()
+        first, second = struct.unpack("<QQ", digest)
+        return [
+            (first + index * second) % self.size for index in range(self.hash_count)
+        ]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+
+class RotatingBloomFilter(object):
+    # two generations swapped every half ttl keep memory bounded while a
+    # key stays visible for at least half and at most a full ttl
+    def __init__(self, capacity, ttl, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.interval = ttl / 2.0
+        self.current = BloomFilter(capacity, error_rate)
+        self.previous = BloomFilter(capacity, error_rate)
+        self.rotated_at = time.time()
+        self.lock = threading.Lock()
+
+    def _rotate(self):
+        if time.time() - self.rotated_at < self.interval:
+            return
+        with self.lock:
+            if time.time() - self.rotated_at >= self.interval:
+                self.previous = self.current
+                self.current = BloomFilter(self.capacity, self.error_rate)
+                self.rotated_at = time.time()
+
+    def add(self, key):
+        self._rotate()
+        self.current.add(key)
+
+    def __contains__(self, key):
+        self._rotate()
+        return key in self.current or key in self.previous
+
+
+class EventDeduplicator(object):
+    """
+    Remembers webhook events for ``ttl`` seconds in Redis so redeliveries are
+    dropped. With ``local_filter`` on, every process also mirrors the seen
+    keys in a Bloom filter, kept in sync over pub/sub. A key the filter has
+    never seen is new and is recorded write-behind, only possible duplicates
+    pay a round trip to Redis to be confirmed.
+    """
+
+    def __init__(
+        self,
+        alias="default",
+        ttl=3600,
+        prefix="webhooks:event",
+        local_filter=False,
+        capacity=100000,
+    ):
+        self.alias = alias
+        self.ttl = ttl
+        self.prefix = prefix
+        self.channel = "{}:seen".format(prefix)
+        self.local_filter = local_filter
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.pid = None
+        self.filter = None
+        self.pending = None
+
+    @property
+    def redis(self):
+        return get_redis_connection(self.alias)
+
+    def _key(self, event_key):
+        return "{}:{}".format(self.prefix, event_key)
+
+    def _ensure_local_filter(self):
+        # the filter and its threads are per process, rebuilt after a fork
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.filter = RotatingBloomFilter(self.capacity, self.ttl)
+            self.pending = Queue()
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.channel: self._on_seen})
+            pubsub.run_in_thread(sleep_time=1, daemon=True)
+            # events recorded before this process subscribed
+            offset = len(self.prefix) + 1
+            for key in self.redis.scan_iter(match=self._key("*"), count=1000):
+                self.filter.add(key.decode("utf-8")[offset:])
+            writer = threading.Thread(target=self._write_behind)
+            writer.daemon = True
+            writer.start()
+            self.pid = os.getpid()
+
+    def _on_seen(self, message):
+        for event_key in message["data"].decode("utf-8").split(","):
+            self.filter.add(event_key)
+
+    def _write_behind(self):
+        while True:
+            event_keys = [self.pending.get()]
+            while not self.pending.empty():
+                event_keys.append(self.pending.get())
+            try:
+                pipeline = self.redis.pipeline(transaction=False)
+                for event_key in event_keys:
+                    pipeline.set(self._key(event_key), 1, nx=True, ex=self.ttl)
+                pipeline.publish(self.channel, ",".join(event_keys))
+                pipeline.execute()
+            except Exception:
+                logger.exception("failed to record %d webhook events", len(event_keys))
+
+    def _claim(self, event_key):
+        return bool(self.redis.set(self._key(event_key), 1, nx=True, ex=self.ttl))
+
+    def is_duplicate(self, event_key):
+        if not self.local_filter:
+            duplicate = not self._claim(event_key)
+        else:
+            self._ensure_local_filter()
+            if event_key not in self.filter:
+                self.filter.add(event_key)
+                self.pending.put(event_key)
+                DEDUP_EVENTS.inc(result="new", checked="local")
+                return False
+
+            duplicate = not self._claim(event_key)
+            if not duplicate:
+                DEDUP_FALSE_POSITIVES.inc()
+
+        DEDUP_EVENTS.inc(result="duplicate" if duplicate else "new", checked="redis")
+        return duplicate
+
+    def write_behind_backlog(self):
+        if self.pid != os.getpid():
+            return 0
+        return self.pending.qsize()
+
+
+def get_event_key(event):
+    # the sdk drops webhookEventId, the reply token is unique per event too
+    event_key = getattr(event, "webhook_event_id", None) or getattr(
+        event, "reply_token", None
+    )
+    if event_key:
+        return event_key
+    source = event.source
+    return "{}:{}:{}".format(
+        event.type,
+        event.timestamp,
+        getattr(source, "room_id", None)
+        or getattr(source, "group_id", None)
+        or getattr(source, "user_id", ""),
+    )
+
+
+deduplicator = EventDeduplicator(
+    ttl=settings.WEBHOOK_DEDUP_TTL, local_filter=settings.WEBHOOK_DEDUP_LOCAL_FILTER
+)
+
+DEDUP_BACKLOG = Gauge(
+    "webhook_dedup_write_behind_backlog",
+    "Events the local filter let through that are not recorded in Redis yet.",
+    collect=lambda: [({}, deduplicator.write_behind_backlog())],
+)
+
+
+def is_redelivered(event):
+    try:
+        duplicate = deduplicator.is_duplicate(get_event_key(event))
+    except Exception:
+        # redis being down must not stop the bot from answering
+        logger.exception("webhook deduplication unavailable")
+        return False
+
+    if duplicate:
+        logger.info("dropped redelivered %s event", event.type)
+    return duplicate
+
+
+def deduplicate(func):
+    # the webhook handler counts the arguments of what it calls, so the
+    # wrapper has to take exactly the event
+    @wraps(func)
+    def wrapper(event):
+        if is_redelivered(event):
+            return
+        return func(event)
+
+    return wrapper
@@ -0,0 +1,93 @@
+import logging
+from collections import OrderedDict, namedtuple
+
+from linebot.exceptions import LineBotApiError
+from linebot.models import TextSendMessage
+
+from webhooks.line_api import line_bot_api
+from webhooks.outbound import multicast, push_message
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGES_PER_PUSH = 5
+MAX_MULTICAST_RECIPIENTS = 500
+
+PUSH = "push"
+MULTICAST = "multicast"
+
+Call = namedtuple("Call", ["method", "to", "texts"])
+
+
+def chunks(items, size):
+    return [items[index : index + size] for index in range(0, len(items), size)]
+
+
+def is_user(target):
+    # multicast only accepts user ids, groups and rooms need a push each
+    return target.startswith("U")
+
+
+def plan_delivery(reminders):
+    """
+    Turns due reminders into as few API calls as possible. Texts for the same
+    target are packed into pushes of up to five messages, and identical
+    packs for several users go out as one multicast per 500 recipients.
+    The n-th pack of every target lands in the n-th round, and rounds run in
+    order, so each target still receives its reminders in due order.
+    """
+    packs = OrderedDict()
+    for reminder in reminders:
+        packs.setdefault(reminder["target"], []).append(reminder["text"])
+    packs = OrderedDict(
+        (target, chunks(texts, MAX_MESSAGES_PER_PUSH))
+        for target, texts in packs.items()
+    )
+
+    calls = []
+    rounds = max([len(target_packs) for target_packs in packs.values()] or [0])
+    for index in range(rounds):
+        audiences = OrderedDict()
+        for target, target_packs in packs.items():
+            if index < len(target_packs):
+                audiences.setdefault(tuple(target_packs[index]), []).append(target)
+
+        for texts, targets in audiences.items():
+            users = [target for target in targets if is_user(target)]
+            if len(users) > 1:
+                for recipients in chunks(users, MAX_MULTICAST_RECIPIENTS):
+                    calls.append(Call(MULTICAST, recipients, texts))
+                targets = [target for target in targets if not is_user(target)]
+
+            for target in targets:
+                calls.append(Call(PUSH, target, texts))
+
+    return calls
+
+
+def execute_plan(calls, api=line_bot_api):
+    failed = 0
+    for call in calls:
+        messages = [TextSendMessage(text=text) for text in call.texts]
+        try:
+            if call.method == MULTICAST:
+                multicast(call.to, messages, api=api)
+            else:
+                push_message(call.to, messages, api=api)
+        except LineBotApiError:
+            # one blocked or unknown target must not hold up the others
+            failed += 1
+            logger.exception("%s to %s failed", call.method, call.to)
+    return failed
+
+
+def deliver(reminders, api=line_bot_api):
+    calls = plan_delivery(reminders)
+    failed = execute_plan(calls, api=api)
+    logger.info(
+        "delivered %d reminders in %d calls, %d calls saved, %d failed",
+        len(reminders),
+        len(calls),
+        len(reminders) - len(calls),
+        failed,
+    )
+    return calls
@@ -0,0 +1,300 @@
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from queue import Queue
+
+from django.conf import settings
+from django.db import close_old_connections
+from linebot.exceptions import InvalidSignatureError
+from linebot.models import (
+    AccountLinkEvent,
+    BeaconEvent,
+    FollowEvent,
+    JoinEvent,
+    LeaveEvent,
+    MemberJoinedEvent,
+    MemberLeftEvent,
+    MessageEvent,
+    PostbackEvent,
+    ThingsEvent,
+    UnfollowEvent,
+)
+from linebot.webhook import WebhookPayload
+
+from webhooks.line_api import handler
+from webhooks.metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+SYNC_MODE = "sync"
+CELERY_MODE = "celery"
+THREAD_MODE = "thread"
+
+# the event types WebhookParser.parse knows
+EVENT_CLASSES = {
+    "message": MessageEvent,
+    "follow": FollowEvent,
+    "unfollow": UnfollowEvent,
+    "join": JoinEvent,
+    "leave": LeaveEvent,
+    "postback": PostbackEvent,
+    "beacon": BeaconEvent,
+    "accountLink": AccountLinkEvent,
+    "memberJoined": MemberJoinedEvent,
+    "memberLeft": MemberLeftEvent,
+    "things": ThingsEvent,
+}
+
+
+def verify_signature(body, signature):
+    with STAGE_SECONDS.time(stage="signature"):
+        valid = handler.parser.signature_validator.validate(body, signature)
+    if not valid:
+        raise InvalidSignatureError("Invalid signature. signature=" + signature)
+
+
+def parse_payload(body):
+    # WebhookParser.parse without its own signature check, for a body that
+    # passed verify_signature
+    with STAGE_SECONDS.time(stage="parse"):
+        body_json = json.loads(body)
+        events = []
+        for event in body_json["events"]:
+            event_class = EVENT_CLASSES.get(event["type"])
+            if event_class is None:
+                logger.warning("unknown event type %s", event["type"])
+                continue
+            events.append(event_class.new_from_json_dict(event))
+    return WebhookPayload(events=events, destination=body_json.get("destination"))
+
+
+@contextmanager
+def db_connections():
+    # django only closes broken connections and the ones past CONN_MAX_AGE
+    # around a request it handles itself, the fast path, the event lanes and
+    # the loop's executor threads keep theirs until they do this
+    close_old_connections()
+    try:
+        yield
+    finally:
+        close_old_connections()
+
+
+def get_conversation_id(source):
+    # rooms and groups are both conversations of several users
+    return getattr(source, "room_id", None) or getattr(source, "group_id", None) or ""
+
+
+def get_push_target(source):
+    # where a push reaches the conversation an event came from
+    return get_conversation_id(source) or source.user_id
+
+
+def get_conversation_key(source):
+    return "{}_{}".format(
+        getattr(source, "user_id", None) or "", get_conversation_id(source)
+    )
+
+
+def group_by_conversation(events):
+    conversations = OrderedDict()
+    for event in events:
+        conversations.setdefault(get_conversation_key(event.source), []).append(event)
+    return list(conversations.values())
+
+
+def get_event_handler(event):
+    # the same lookup WebhookHandler.handle does, done here so every stage
+    # can be timed on its own. The sdk has no public lookup, this reads the
+    # private _handlers and _default of line-bot-sdk 1.13, as pinned in
+    # requirements.txt, and has to be checked when the sdk is upgraded
+    func = None
+    if isinstance(event, MessageEvent):
+        func = handler._handlers.get(
+            "{}_{}".format(event.__class__.__name__, event.message.__class__.__name__)
+        )
+    if func is None:
+        func = handler._handlers.get(event.__class__.__name__, handler._default)
+    return func
+
+
+_args_counts = {}
+
+
+def get_args_count(func):
+    # WebhookHandler passes nothing, the event, or the event and the
+    # destination, by how many arguments the handler takes
+    count = _args_counts.get(func)
+    if count is None:
+        count = _args_counts[func] = len(inspect.getfullargspec(func).args)
+    return count
+
+
+def handle_event(event, destination=None):
+    func = get_event_handler(event)
+    if func is None:
+        logger.info("no handler for %s", event.__class__.__name__)
+        return
+
+    with STAGE_SECONDS.time(stage="event", event=event.type):
+        args_count = get_args_count(func)
+        if args_count == 0:
+            func()
+        elif args_count == 1:
+            func(event)
+        else:
+            func(event, destination)
+
+
+def process_webhook(body, received_at=None):
+    """
+    Handles the events of a webhook whose signature dispatch_webhook
+    already checked, on the request thread or after the handoff.
+    """
+    # the handlers are registered on import of the views module, workers
+    # that never serve a request would otherwise dispatch to nothing
+    from webhooks import views  # noqa: F401
+
+    started_at = time.time()
+    if received_at is not None and settings.WEBHOOK_DISPATCH_MODE != SYNC_MODE:
+        STAGE_SECONDS.observe(started_at - received_at, stage="handoff")
+    payload = parse_payload(body)
+    for event in payload.events:
+        # the reply token budget counts from here
+        event.received_at = received_at
+    handle_events(payload.events, payload.destination)
+    if received_at is not None:
+        STAGE_SECONDS.observe(time.time() - received_at, stage="total")
+        logger.info(
+            "webhook handoff %.1fms, total %.1fms",
+            (started_at - received_at) * 1000,
+            (time.time() - received_at) * 1000,
+        )
+
+
+class EventPool(object):
+    """
+    Runs the conversations of one webhook side by side. Events of the same
+    conversation stay in order on one lane, a webhook never gets more than
+    `concurrency` lanes and the calling thread is always one of them, so a
+    busy pool only makes a webhook slower, never stuck.
+    """
+
+    def __init__(self, threads, concurrency):
+        self.threads = threads
+        self.concurrency = concurrency
+        self.lock = threading.Lock()
+        self.pid = None
+        self._executor = None
+
+    @property
+    def executor(self):
+        # threads do not survive a fork, every worker process makes its own
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(max_workers=self.threads)
+                    self.pid = os.getpid()
+        return self._executor
+
+    def run(self, events, handle):
+        """
+        Handles every event even when some fail, each failure is logged and
+        the first one is raised once all are done, on one lane or several.
+        """
+        conversations = group_by_conversation(events)
+        lanes = min(self.concurrency, len(conversations))
+        # a single lane takes the events in the order they came
+        pending = deque(conversations if lanes > 1 else [events])
+        errors = []
+
+        def drain():
+            with db_connections():
+                while True:
+                    try:
+                        conversation = pending.popleft()
+                    except IndexError:
+                        return
+                    for event in conversation:
+                        try:
+                            handle(event)
+                        except Exception as e:
+                            logger.exception("failed to handle %s event", event.type)
+                            errors.append(e)
+
+        futures = [self.executor.submit(drain) for _ in range(lanes - 1)]
+        drain()
+        for future in futures:
+            future.result()
+        if errors:
+            raise errors[0]
+
+
+event_pool = EventPool(
+    settings.WEBHOOK_EVENT_THREADS, settings.WEBHOOK_EVENT_CONCURRENCY
+)
+
+
+def handle_events(events, destination=None):
+    event_pool.run(events, lambda event: handle_event(event, destination=destination))
+
+
+class InProcessQueue(object):
+    def __init__(self, threads):
+        self.threads = threads
+        self.queue = Queue()
+        self.workers = []
+        self.lock = threading.Lock()
+
+    def put(self, body, received_at):
+        self._ensure_workers()
+        self.queue.put((body, received_at))
+
+    def _ensure_workers(self):
+        # started lazily so every forked gunicorn worker gets its own threads
+        if self.workers:
+            return
+        with self.lock:
+            if self.workers:
+                return
+            for _ in range(self.threads):
+                worker = threading.Thread(target=self._run)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+    def _run(self):
+        while True:
+            body, received_at = self.queue.get()
+            try:
+                process_webhook(body, received_at)
+            except Exception:
+                logger.exception("failed to process webhook")
+            finally:
+                self.queue.task_done()
+
+
+in_process_queue = InProcessQueue(settings.WEBHOOK_DISPATCH_THREADS)
+
+
+def dispatch_webhook(body, signature):
+    received_at = time.time()
+    mode = settings.WEBHOOK_DISPATCH_MODE
+    verify_signature(body, signature)
+    if mode == SYNC_MODE:
+        return process_webhook(body, received_at)
+
+    if mode == CELERY_MODE:
+        from webhooks.tasks import handle_webhook
+
+        handle_webhook.delay(body, signature, received_at)
+    elif mode == THREAD_MODE:
+        in_process_queue.put(body, received_at)
+    else:
+        raise ValueError("Unknown WEBHOOK_DISPATCH_MODE {}".format(mode))
@@ -0,0 +1,104 @@
+"""
+A WSGI front for the webhook that answers the callback and metrics paths
+itself and hands every other request to Django. A signed POST from LINE
+needs none of the sessions, auth, messages or CSRF middleware, nor the url
+resolution and request objects, and the Django handler is only built on
+the first request that does, like the admin.
+
+    gunicorn --pythonpath line_bot line_bot.wsgi
+"""
+
+import logging
+import threading
+
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
+
+from webhooks.dispatch import db_connections, dispatch_webhook
+from webhooks.metrics import render
+
+# registers the event handlers on the shared WebhookHandler
+import webhooks.views  # noqa: F401
+
+logger = logging.getLogger(__name__)
+
+CALLBACK_PATHS = frozenset(["/webhooks/callback", "/webhooks/callback/"])
+METRICS_PATHS = frozenset(["/webhooks/metrics", "/webhooks/metrics/"])
+
+STATUSES = {
+    200: "200 OK",
+    400: "400 Bad Request",
+    403: "403 Forbidden",
+    405: "405 Method Not Allowed",
+}
+
+
+def _respond(
+    start_response,
+    status,
+    body=b"",
+    content_type="text/html; charset=utf-8",
+    allow=None,
+):
+    headers = [("Content-Type", content_type), ("Content-Length", str(len(body)))]
+    if allow:
+        headers.append(("Allow", allow))
+    start_response(STATUSES[status], headers)
+    return [body]
+
+
+def _read_body(environ):
+    try:
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        length = 0
+    return environ["wsgi.input"].read(length) if length > 0 else b""
+
+
+class FastPathApplication(object):
+    def __init__(self, get_fallback):
+        self.get_fallback = get_fallback
+        self.fallback = None
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        if path in CALLBACK_PATHS:
+            return self.callback(environ, start_response)
+        if path in METRICS_PATHS:
+            return self.metrics(environ, start_response)
+        return self.get_django()(environ, start_response)
+
+    def get_django(self):
+        if self.fallback is None:
+            with self.lock:
+                if self.fallback is None:
+                    self.fallback = self.get_fallback()
+        return self.fallback
+
+    def callback(self, environ, start_response):
+        # the same answers as views.callback
+        if environ["REQUEST_METHOD"] != "POST":
+            return _respond(start_response, 405, allow="POST")
+
+        signature = environ.get("HTTP_X_LINE_SIGNATURE", "")
+        body = _read_body(environ).decode("utf-8")
+        try:
+            with db_connections():
+                dispatch_webhook(body, signature)
+        except InvalidSignatureError as e:
+            logger.warning("invalid signature %s", e.message)
+            return _respond(start_response, 403)
+        except LineBotApiError as e:
+            logger.warning("LINE API error %s %s", e.status_code, e.error.message)
+            return _respond(start_response, 400)
+        return _respond(start_response, 200, b"Ok")
+
+    def metrics(self, environ, start_response):
+        if environ["REQUEST_METHOD"] != "GET":
+            return _respond(start_response, 405, allow="GET")
+        return _respond(
+            start_response,
+            200,
+            render().encode("utf-8"),
+            content_type="text/plain; version=0.0.4",
+        )
@@ -0,0 +1,212 @@
+import os
+import random
+import threading
+import time
+import uuid
+
+import requests
+from linebot.http_client import HttpClient, RequestsHttpResponse
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connectionpool import (
+    HTTPConnectionPool,
+    HTTPSConnectionPool,
+)
+
+from webhooks.metrics import Counter, Histogram
+
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "PUT", "DELETE", "OPTIONS"])
+
+# LINE accepts a push or multicast once per retry key and answers a repeat
+# with 409, so those are safe to send again after a 5xx. A reply takes no key
+RETRY_KEY_HEADER = "X-Line-Retry-Key"
+RETRY_KEY_PATHS = (
+    "/message/push",
+    "/message/multicast",
+    "/message/narrowcast",
+    "/message/broadcast",
+)
+ACCEPTED_BEFORE = 409
+
+POOL_REQUESTS = Counter(
+    "line_api_pool_requests_total",
+    "Connections taken from the LINE API pools, new or reused.",
+)
+POOL_CONNECTIONS = Counter(
+    "line_api_pool_connections_total",
+    "Connections the LINE API pools opened, every other request reused one.",
+)
+POOL_WAIT_SECONDS = Histogram(
+    "line_api_pool_wait_seconds",
+    "Time LINE API calls waited for a free pooled connection.",
+)
+RETRIES = Counter("line_api_retries_total", "LINE API calls sent again, by status.")
+
+
+def with_retry_key(url, headers):
+    if not url.rstrip("/").endswith(RETRY_KEY_PATHS):
+        return headers
+    headers = dict(headers or {})
+    headers.setdefault(RETRY_KEY_HEADER, str(uuid.uuid4()))
+    return headers
+
+
+def is_retryable(method, status, headers):
+    # a 429 was never processed, a 5xx may have been, and is only sent
+    # again when that cannot deliver anything twice
+    if status not in RETRY_STATUSES:
+        return False
+    return (
+        status == 429
+        or method in IDEMPOTENT_METHODS
+        or RETRY_KEY_HEADER in (headers or {})
+    )
+
+
+def is_accepted_before(attempt, status, headers):
+    # the first attempt went through after all, its 5xx notwithstanding
+    return attempt > 0 and status == ACCEPTED_BEFORE and RETRY_KEY_HEADER in headers
+
+
+def get_retry_delay(attempt, backoff, max_backoff, retry_after=None):
+    # full jitter keeps the retries of many workers from lining up
+    delay = random.uniform(0, min(max_backoff, backoff * 2**attempt))
+    try:
+        return max(delay, float(retry_after or 0))
+    except ValueError:
+        return delay
+
+
+class AcceptedResponse(RequestsHttpResponse):
+    # the 409 of a retry LINE had accepted under its key, the sdk raises on
+    # anything but a 2xx
+    @property
+    def status_code(self):
+        return 200
+
+
+class TimedPoolMixin(object):
+    # times how long requests waited for a free connection and counts the
+    # connections opened, the rest were reused
+    def _get_conn(self, timeout=None):
+        POOL_REQUESTS.inc()
+        with POOL_WAIT_SECONDS.time():
+            return super(TimedPoolMixin, self)._get_conn(timeout=timeout)
+
+    def _new_conn(self):
+        POOL_CONNECTIONS.inc()
+        return super(TimedPoolMixin, self)._new_conn()
+
+
+class TimedHTTPConnectionPool(TimedPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class TimedHTTPSConnectionPool(TimedPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class PooledAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super(PooledAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool,
+        }
+
+
+class PooledHttpClient(HttpClient):
+    """
+    Keeps a bounded keep-alive connection pool per process. The pool is
+    rebuilt lazily after a fork, so gunicorn and the celery prefork children
+    never share sockets inherited from their parent.
+    """
+
+    def __init__(
+        self,
+        timeout=HttpClient.DEFAULT_TIMEOUT,
+        pool_size=10,
+        max_retries=3,
+        backoff=0.2,
+        max_backoff=5.0,
+        on_throttle=None,
+    ):
+        super(PooledHttpClient, self).__init__(timeout)
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # called with the url and Retry-After of every 429
+        self.on_throttle = on_throttle
+        self.lock = threading.Lock()
+        self.pid = None
+        self.adapter = None
+        self._session = None
+
+    @property
+    def session(self):
+        return self._ensure_session()
+
+    def _ensure_session(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.adapter, self._session = self._build_session()
+                    self.pid = os.getpid()
+        return self._session
+
+    def _build_session(self):
+        # pool_block keeps the pool bounded, callers wait for a connection
+        # instead of opening throwaway ones
+        adapter = PooledAdapter(
+            pool_connections=1, pool_maxsize=self.pool_size, pool_block=True
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return adapter, session
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._request(
+            "GET", url, headers=headers, params=params, stream=stream, timeout=timeout
+        )
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._request(
+            "POST",
+            url,
+            headers=with_retry_key(url, headers),
+            data=data,
+            timeout=timeout,
+        )
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._request("DELETE", url, headers=headers, data=data, timeout=timeout)
+
+    def _request(self, method, url, timeout=None, headers=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+
+        attempt = 0
+        while True:
+            response = self.session.request(
+                method, url, timeout=timeout, headers=headers, **kwargs
+            )
+            status = response.status_code
+            if status == 429 and self.on_throttle is not None:
+                self.on_throttle(url, response.headers.get("Retry-After"))
+            if is_accepted_before(attempt, status, headers or {}):
+                return AcceptedResponse(response)
+            if not is_retryable(method, status, headers) or attempt >= self.max_retries:
+                return RequestsHttpResponse(response)
+
+            delay = self._get_delay(attempt, response)
+            response.close()
+            RETRIES.inc(status=str(status))
+            attempt += 1
+            time.sleep(delay)
+
+    def _get_delay(self, attempt, response):
+        return get_retry_delay(
+            attempt, self.backoff, self.max_backoff, response.headers.get("Retry-After")
+        )
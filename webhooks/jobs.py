@@ -1,19 +1,44 @@
 import attr
+import json
+import uuid
 from abc import ABCMeta
-from datetime import datetime, timedelta
+from datetime import datetime
 from six import with_metaclass
 
+from django.utils import timezone
 from linebot.models import TemplateSendMessage, TextSendMessage
-from linebot.models.actions import DatetimePickerAction
-from linebot.models.template import ButtonsTemplate
+from linebot.models.actions import DatetimePickerAction, PostbackAction
+from linebot.models.template import ButtonsTemplate, CarouselColumn, CarouselTemplate
 
-from .tasks import send
+from .messages import MessageTemplate
+from .metrics import STAGE_SECONDS
+from .models import Reminder
+from .recurrence import Recurrence
+from .scheduler import reminder_scheduler
+from .state import STATE_PARAM, ExpiredState, decode_state, encode_state, state_store
+from .zones import convert, get_zone
+
+REMINDER_PREFIX = "來自專屬秘書的叮嚀: \n "
 
 
 def get_readable_date_time(date_time):
     return date_time.strftime("%Y-%m-%d %I:%M %p")
 
 
+def format_cursor(reminder):
+    return "{}_{}".format(reminder.due_at.strftime("%Y%m%d%H%M%S%f"), reminder.pk)
+
+
+def parse_cursor(cursor):
+    if not cursor:
+        return None
+    due_at, pk = cursor.split("_")
+    return (
+        datetime.strptime(due_at, "%Y%m%d%H%M%S%f").replace(tzinfo=timezone.utc),
+        int(pk),
+    )
+
+
 class DateTimeConvert(object):
     @classmethod
     def to_datetime(self, datetime_str):
@@ -23,71 +48,114 @@ class DateTimeConvert(object):
         return datetime.strptime(datetime_str, "%Y-%m-%dT%H:%M")
 
 
-@attr.s
+@attr.s(slots=True)
 class TimeConvertParamsWrapper(object):
     target_datetime = attr.ib(converter=DateTimeConvert.to_datetime, default=None)
     from_country = attr.ib(default="")
     to_country = attr.ib(default="")
+    from_tz = attr.ib(default="")
+    to_tz = attr.ib(default="")
+    # buttons sent before there were zone names still carry hour offsets
     from_hours = attr.ib(converter=int, default=0)
     to_hours = attr.ib(converter=int, default=0)
 
 
-
-@attr.s
+@attr.s(slots=True)
 class ReminderDataWrapper(object):
     target_datetime = attr.ib(converter=DateTimeConvert.to_datetime, default=None)
     text = attr.ib(default="")
-    tz = attr.ib(converter=int, default=0)
+    tz = attr.ib(converter=str, default="UTC")
+    repeat = attr.ib(default="")
+    reminder_id = attr.ib(default="")
+    after = attr.ib(default="")
+
+
+class UnknownAction(KeyError):
+    pass
 
 
 class BaseWoody(with_metaclass(ABCMeta, object)):
+    TYPE = None
     WRAPPER_CLASS = None
+    ACTIONS = {}  # filled per subclass: action name -> can_ method
+    STATE_FIELDS = ()  # wrapper fields kept server side between steps
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.ACTIONS = {
+            name[len("can_") :]: getattr(cls, name)
+            for name in dir(cls)
+            if name.startswith("can_") and callable(getattr(cls, name))
+        }
 
     def __init__(self, data, key=None, type=None, *args, **kwargs):
-        self.type = type
+        self.type = type or self.TYPE
         self.key = key
         self.wrapper_data_instance = self._get_wrapper_instance(data)
         self.actions = self.get_actions()
 
-    def get_actions(self):
-        return set(
-            [
-                func
-                for func in dir(self)
-                if func.startswith("can_") and callable(getattr(self, func))
-            ]
-        )
+    @classmethod
+    def get_actions(cls):
+        return set("can_{}".format(action) for action in cls.ACTIONS)
 
     def _get_wrapper_instance(self, data):
         return self.WRAPPER_CLASS(**data)
 
+    @classmethod
+    def save_state(cls, key, **data):
+        return state_store.save(key, encode_state(cls.TYPE, cls.STATE_FIELDS, data))
+
+    @classmethod
+    def restore_state(cls, key, data):
+        # the postback's own parameters, like a picked datetime, win
+        payload = state_store.load(key, data.pop(STATE_PARAM))
+        state = payload and decode_state(cls.TYPE, cls.STATE_FIELDS, payload)
+        if state is None:
+            raise ExpiredState(cls.TYPE, key)
+        state.update(data)
+        return state
+
 
 class WoodyTimeConverter(BaseWoody):
+    TYPE = "date_convert"
     WRAPPER_CLASS = TimeConvertParamsWrapper
 
-    def __init__(self, type="date_convert", *args, **kwargs):
-        super().__init__(type=type, *args, **kwargs)
-
     def can_choose(self):
-        utc_date = self.wrapper_data_instance.target_datetime - timedelta(hours=self.wrapper_data_instance.from_hours)
-        new_date = utc_date + timedelta(hours=self.wrapper_data_instance.to_hours)
+        instance = self.wrapper_data_instance
+        from_tz = instance.from_tz or str(instance.from_hours)
+        if instance.to_tz:
+            to_zones = instance.to_tz.split(",")
+        else:
+            to_zones = [str(instance.to_hours)]
+        new_dates = convert(instance.target_datetime, from_tz, to_zones)
+        if len(new_dates) == 1:
+            return TextSendMessage(
+                text="{instance.from_country}時間: {orig_date}，轉換至{instance.to_country}時間:{new_date}".format(
+                    instance=instance,
+                    orig_date=get_readable_date_time(instance.target_datetime),
+                    new_date=get_readable_date_time(new_dates[0]),
+                )
+            )
+
         return TextSendMessage(
-            text="{instance.from_country}時間: {orig_date}，轉換至{instance.to_country}時間:{new_date}".format(
-                instance=self.wrapper_data_instance,
-                orig_date=get_readable_date_time(self.wrapper_data_instance.target_datetime),
-                new_date=get_readable_date_time(new_date),
+            text="{}時間: {}，轉換至".format(
+                instance.from_country, get_readable_date_time(instance.target_datetime)
+            )
+            + "".join(
+                "\n{}時間:{}".format(country, get_readable_date_time(new_date))
+                for country, new_date in zip(instance.to_country.split("、"), new_dates)
             )
         )
 
 
 class WoodyReminder(BaseWoody):
+    TYPE = "reminder"
     WRAPPER_CLASS = ReminderDataWrapper
-
-    def __init__(self, type="reminder", *args, **kwargs):
-        super().__init__(type=type, *args, **kwargs)
-
-    def can_choose_date(self):
-        return TemplateSendMessage(
+    STATE_FIELDS = ("text", "repeat", "tz")
+    # a carousel takes ten columns, the last one turns the page
+    LIST_PAGE_SIZE = 9
+    CHOOSE_DATE_TEMPLATE = MessageTemplate(
+        TemplateSendMessage(
             alt_text="提醒小幫手",
             template=ButtonsTemplate(
                 title="提醒事項",
@@ -95,27 +163,186 @@ class WoodyReminder(BaseWoody):
                 actions=[
                     DatetimePickerAction(
                         label="選擇時間",
-                        data="type={type}&action=add_to_reminder&tz={tz}&text={text}".format(
-                            type=self.type,
-                            tz=self.wrapper_data_instance.tz,
-                            text=self.wrapper_data_instance.text,
+                        data="type={type}&action=add_to_reminder&{param}={state}".format(
+                            type=MessageTemplate.slot("type"),
+                            param=STATE_PARAM,
+                            state=MessageTemplate.slot("state"),
                         ),
                         mode="datetime",
                     )
                 ],
             ),
         )
+    )
+
+    def can_choose_date(self):
+        instance = self.wrapper_data_instance
+        return self.CHOOSE_DATE_TEMPLATE.render(
+            type=self.type,
+            state=self.save_state(
+                self.key, text=instance.text, repeat=instance.repeat, tz=instance.tz
+            ),
+        )
 
     def can_add_to_reminder(self):
-        time_to_send = self.wrapper_data_instance.target_datetime - timedelta(hours=self.wrapper_data_instance.tz)
+        target = self._get_target()
+        if self.wrapper_data_instance.repeat:
+            return self._add_recurring(target)
+
+        time_to_send = get_zone(self.wrapper_data_instance.tz).to_utc(
+            self.wrapper_data_instance.target_datetime
+        )
+        self._schedule(target, time_to_send)
+
+        return TextSendMessage(
+            text="設定完畢！將於 {} 提醒您。".format(
+                get_readable_date_time(self.wrapper_data_instance.target_datetime)
+            )
+        )
+
+    def _add_recurring(self, target):
+        try:
+            recurrence = Recurrence(
+                self.wrapper_data_instance.repeat,
+                self.wrapper_data_instance.tz,
+                self.wrapper_data_instance.target_datetime,
+            )
+            time_to_send = recurrence.first()
+        except ValueError:
+            return TextSendMessage(text="對不起 看不懂重複提醒的規則")
+
+        self._schedule(target, time_to_send, rule=recurrence.as_dict())
+        return TextSendMessage(
+            text="設定完畢！將從 {} 起{}提醒您。".format(
+                get_readable_date_time(recurrence.zone.from_utc(time_to_send)),
+                recurrence.label,
+            )
+        )
+
+    def _get_target(self):
         user_id, room_id = self.key.split("_")
-        target = room_id if room_id else user_id
-        reminder_text = "來自專屬秘書的叮嚀: \n {}".format(self.wrapper_data_instance.text)
-        send.apply_async((target, reminder_text), eta=time_to_send)
+        return room_id if room_id else user_id
 
+    def _schedule(self, target, time_to_send, rule=None):
+        # the row is what listing and cancelling see, the scheduler entry
+        # under the same key is what fires
+        instance = self.wrapper_data_instance
+        key = uuid.uuid4().hex
+        Reminder.objects.create(
+            key=key,
+            target=target,
+            text=instance.text,
+            tz=instance.tz,
+            rule=json.dumps(rule) if rule else "",
+            due_at=time_to_send.replace(tzinfo=timezone.utc),
+        )
+        reminder_scheduler.schedule(
+            target,
+            REMINDER_PREFIX + instance.text,
+            time_to_send,
+            reminder_id=key,
+            rule=rule,
+        )
+
+    def can_list(self):
+        after = self.wrapper_data_instance.after
+        reminders = list(
+            Reminder.objects.pending_for(
+                self._get_target(),
+                after=parse_cursor(after),
+                limit=self.LIST_PAGE_SIZE + 1,
+            )
+        )
+        if not reminders:
+            return TextSendMessage(
+                text="沒有更多提醒了" if after else "目前沒有設定任何提醒"
+            )
+
+        page = reminders[: self.LIST_PAGE_SIZE]
+        columns = [self._get_column(reminder) for reminder in page]
+        if len(reminders) > len(page):
+            columns.append(
+                CarouselColumn(
+                    title="還有更多提醒",
+                    text="查看接下來的提醒",
+                    actions=[
+                        PostbackAction(
+                            label="下一頁",
+                            data="type=reminder&action=list&after={}".format(
+                                format_cursor(page[-1])
+                            ),
+                        )
+                    ],
+                )
+            )
+        return TemplateSendMessage(
+            alt_text="我的提醒", template=CarouselTemplate(columns=columns)
+        )
+
+    def _get_column(self, reminder):
+        title = "#{} {}".format(reminder.pk, self._get_local_time(reminder))
+        if reminder.rule:
+            title += " {}".format(reminder.recurrence.label.strip())
+        return CarouselColumn(
+            title=title[:40],
+            text=reminder.text[:60] or "-",
+            actions=[
+                PostbackAction(
+                    label="取消",
+                    data="type=reminder&action=cancel&reminder_id={}".format(
+                        reminder.pk
+                    ),
+                )
+            ],
+        )
+
+    def _get_local_time(self, reminder):
+        utc = timezone.make_naive(reminder.due_at, timezone.utc)
+        return get_readable_date_time(get_zone(reminder.tz).from_utc(utc))
+
+    def can_cancel(self):
+        reminder = Reminder.objects.cancel_for(
+            self._get_target(), self.wrapper_data_instance.reminder_id
+        )
+        if reminder is None:
+            return TextSendMessage(text="找不到這個提醒，可能已經發送或取消了")
+
+        reminder_scheduler.cancel(reminder.key)
         return TextSendMessage(
-            text="設定完畢！將於 {} 提醒您。".format(get_readable_date_time(self.wrapper_data_instance.target_datetime))
+            text="已取消 {} 的提醒：{}".format(
+                self._get_local_time(reminder), reminder.text
+            )
         )
 
 
-JOB_API = {"reminder": WoodyReminder, "date_convert": WoodyTimeConverter}
+class ActionRegistry(object):
+    # (type, action) -> (woody class, can_ method), resolved without reflection
+    def __init__(self, woodies):
+        self.woodies = {}
+        self.handlers = {}
+        for woody in woodies:
+            self.register(woody)
+
+    def register(self, woody):
+        self.woodies[woody.TYPE] = woody
+        for action, handler in woody.ACTIONS.items():
+            self.handlers[(woody.TYPE, action)] = (woody, handler)
+
+    def __getitem__(self, type):
+        return self.woodies[type]
+
+    def resolve(self, type, action):
+        try:
+            return self.handlers[(type, action)]
+        except KeyError:
+            raise UnknownAction(type, action)
+
+    def dispatch(self, type, action, data, key=None):
+        woody, handler = self.resolve(type, action)
+        if STATE_PARAM in data:
+            data = woody.restore_state(key, data)
+        with STAGE_SECONDS.time(stage="action", action="{}.{}".format(type, action)):
+            return handler(woody(data=data, key=key))
+
+
+JOB_API = ActionRegistry([WoodyReminder, WoodyTimeConverter])
@@ -1,5 +1,22 @@
+from functools import partial
+
 from linebot import LineBotApi, WebhookHandler
 from django.conf import settings
+from django.utils.module_loading import import_string
+
+from webhooks.ratelimit import outbound_limiter
+
+http_options = dict(settings.LINE_API_HTTP_OPTIONS)
+if settings.OUTBOUND_RATE_LIMITED:
+    # a 429 seen by one process holds the endpoint back in all of them
+    http_options["on_throttle"] = outbound_limiter.throttled
+
+http_client = partial(import_string(settings.LINE_API_HTTP_CLIENT), **http_options)
 
-line_bot_api = LineBotApi(settings.LINE_BOT_API)
+line_bot_api = LineBotApi(
+    settings.LINE_BOT_API,
+    endpoint=settings.LINE_API_ENDPOINT,
+    timeout=(settings.LINE_API_CONNECT_TIMEOUT, settings.LINE_API_READ_TIMEOUT),
+    http_client=http_client,
+)
 handler = WebhookHandler(settings.LINE_BOT_HANDLER)
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from webhooks.audience import audience, broadcaster
+from webhooks.delivery import MAX_MESSAGES_PER_PUSH
+from webhooks.tasks import dispatch_chunks
+
+
+class Command(BaseCommand):
+    help = "Broadcasts texts to everyone the bot heard from, or shows or resumes one."
+
+    def add_arguments(self, parser):
+        parser.add_argument("command", choices=["send", "status", "resume", "count"])
+        parser.add_argument(
+            "args", nargs="*", help="texts to send, or the id of a broadcast"
+        )
+
+    def handle(self, *args, **options):
+        command = options["command"]
+        if command == "count":
+            self.stdout.write(
+                ", ".join(
+                    "{} {}".format(count, kind)
+                    for kind, count in sorted(audience.count().items())
+                )
+            )
+        elif command == "send":
+            if not 0 < len(args) <= MAX_MESSAGES_PER_PUSH:
+                raise CommandError(
+                    "send takes 1 to {} texts".format(MAX_MESSAGES_PER_PUSH)
+                )
+            broadcast_id, chunks = broadcaster.start(list(args))
+            dispatch_chunks(broadcast_id, chunks)
+            self.stdout.write(
+                "broadcast {} queued in {} chunks".format(broadcast_id, len(chunks))
+            )
+        else:
+            if len(args) != 1:
+                raise CommandError("{} takes the id of a broadcast".format(command))
+            try:
+                if command == "resume":
+                    chunks = broadcaster.pending(args[0])
+                    dispatch_chunks(args[0], chunks)
+                    self.stdout.write("{} chunks queued again".format(len(chunks)))
+                else:
+                    status = broadcaster.status(args[0])
+                    self.stdout.write(
+                        ", ".join(
+                            "{} {}".format(key, value)
+                            for key, value in sorted(status.items())
+                        )
+                    )
+            except KeyError:
+                raise CommandError("no broadcast {}".format(args[0]))
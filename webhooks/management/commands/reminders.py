@@ -0,0 +1,74 @@
+import json
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from webhooks.jobs import REMINDER_PREFIX
+from webhooks.models import Reminder, from_timestamp
+from webhooks.scheduler import reminder_scheduler
+
+
+class Command(BaseCommand):
+    help = "Counts due reminders, or imports the ones only the scheduler knows."
+
+    def add_arguments(self, parser):
+        parser.add_argument("command", choices=["due", "import"])
+        parser.add_argument(
+            "--within", type=int, default=3600, help="seconds ahead to count"
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if options["command"] == "due":
+            now = timezone.now()
+            count = Reminder.objects.due_between(
+                now, now + timedelta(seconds=options["within"])
+            ).count()
+            self.stdout.write(
+                "{} reminders due in {}s".format(count, options["within"])
+            )
+        else:
+            created = self.import_scheduled(options["batch_size"])
+            self.stdout.write("imported {} reminders".format(created))
+
+    def import_scheduled(self, batch_size):
+        created = 0
+        batch = []
+        for key, payload in reminder_scheduler.redis.hscan_iter(
+            reminder_scheduler.payload_key, count=batch_size
+        ):
+            batch.append((key.decode("utf-8"), json.loads(payload)))
+            if len(batch) >= batch_size:
+                created += self._import(batch)
+                batch = []
+        if batch:
+            created += self._import(batch)
+        return created
+
+    def _import(self, batch):
+        known = set(
+            Reminder.objects.filter(key__in=[key for key, _ in batch]).values_list(
+                "key", flat=True
+            )
+        )
+        rows = []
+        for key, reminder in batch:
+            if key in known:
+                continue
+            text = reminder["text"]
+            if text.startswith(REMINDER_PREFIX):
+                text = text[len(REMINDER_PREFIX) :]
+            rule = reminder.get("rule")
+            rows.append(
+                Reminder(
+                    key=key,
+                    target=reminder["target"],
+                    text=text,
+                    tz=rule["tz"] if rule else "UTC",
+                    rule=json.dumps(rule) if rule else "",
+                    due_at=from_timestamp(reminder["due"]),
+                )
+            )
+        Reminder.objects.bulk_create(rows)
+        return len(rows)
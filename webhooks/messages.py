@@ -0,0 +1,75 @@
+import json
+import re
+
+
+class SerializedMessage(object):
+    # a reply already in its wire format, either as the dict the sdk would
+    # produce or as the json text itself, so nothing walks a model tree again
+    def __init__(self, payload=None, json_string=None):
+        self._payload = payload
+        self._json = json_string
+
+    @classmethod
+    def from_message(cls, message):
+        if isinstance(message, SerializedMessage):
+            return message
+        return cls(payload=message.as_json_dict())
+
+    def as_json_dict(self):
+        if self._payload is None:
+            self._payload = json.loads(self._json)
+        return self._payload
+
+    @property
+    def json(self):
+        if self._json is None:
+            self._json = json.dumps(self._payload)
+        return self._json
+
+    def as_json_string(self):
+        return json.dumps(self.as_json_dict(), sort_keys=True)
+
+    def __str__(self):
+        return self.as_json_string()
+
+    __repr__ = __str__
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, SerializedMessage)
+            and self.as_json_dict() == other.as_json_dict()
+        )
+
+
+def to_json(message):
+    if isinstance(message, SerializedMessage):
+        return message.json
+    return json.dumps(message.as_json_dict())
+
+
+SLOT_PATTERN = re.compile(r"\{\{(\w+)\}\}")
+
+
+class MessageTemplate(object):
+    """
+    Serializes a message skeleton once and keeps its json text split around
+    the slots. Rendering only escapes the slot values and joins the pieces.
+    Build the skeleton with ``MessageTemplate.slot(name)`` wherever a value
+    goes, it may sit inside a longer string.
+    """
+
+    def __init__(self, message):
+        skeleton = json.dumps(message.as_json_dict())
+        self.parts = SLOT_PATTERN.split(skeleton)
+        self.slots = set(self.parts[1::2])
+
+    @staticmethod
+    def slot(name):
+        return "{{{{{}}}}}".format(name)
+
+    def render(self, **values):
+        parts = list(self.parts)
+        for index in range(1, len(parts), 2):
+            # json.dumps escapes the value as a string literal, the quotes go
+            parts[index] = json.dumps("{}".format(values[parts[index]]))[1:-1]
+        return SerializedMessage(json_string="".join(parts))
@@ -0,0 +1,324 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django_redis import get_redis_connection
+from redis import StrictRedis
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+REGISTRY = OrderedDict()
+
+
+class Metric(object):
+    TYPE = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.lock = threading.Lock()
+        self.values = {}
+        # what was observed since the last flush to the shared store
+        self.pending = {}
+        REGISTRY[name] = self
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted(labels.items()))
+
+    def take_pending(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        return pending
+
+    def copy_values(self):
+        return dict(self.values)
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._labels(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+            self.pending[key] = self.pending.get(key, 0) + amount
+        _collector.ensure_started()
+
+    def fields(self, pending):
+        return [(json.dumps([key, "value"]), amount) for key, amount in pending.items()]
+
+    def samples(self, values):
+        for key, amount in sorted(values.items()):
+            yield self.name, key, amount
+
+
+class Gauge(Metric):
+    # per process and never shared, for values that only make sense locally,
+    # unless ``collect`` reads them from a shared place on every render
+    TYPE = "gauge"
+
+    def __init__(self, name, documentation, collect=None):
+        super(Gauge, self).__init__(name, documentation)
+        self.collect = collect
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._labels(labels)] = value
+
+    def copy_values(self):
+        if self.collect is None:
+            return dict(self.values)
+        try:
+            return {self._labels(labels): value for labels, value in self.collect()}
+        except Exception:
+            logger.exception("failed to collect %s", self.name)
+            return {}
+
+    def take_pending(self):
+        return {}
+
+    def fields(self, pending):
+        return []
+
+    def samples(self, values):
+        for key, value in sorted(values.items()):
+            if self.collect is None:
+                key += (("pid", str(os.getpid())),)
+            yield self.name, key, value
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation)
+        self.buckets = tuple(buckets)
+
+    def _empty(self):
+        return [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+    def copy_values(self):
+        return {
+            key: [list(counts), total, count]
+            for key, (counts, total, count) in self.values.items()
+        }
+
+    def observe(self, value, **labels):
+        key = self._labels(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            for store in (self.values, self.pending):
+                entry = store.get(key)
+                if entry is None:
+                    entry = store[key] = self._empty()
+                entry[0][index] += 1
+                entry[1] += value
+                entry[2] += 1
+        _collector.ensure_started()
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, **labels)
+
+    def fields(self, pending):
+        fields = []
+        for key, (counts, total, count) in pending.items():
+            for index, bucket_count in enumerate(counts):
+                if bucket_count:
+                    fields.append((json.dumps([key, "bucket", index]), bucket_count))
+            fields.append((json.dumps([key, "sum"]), total))
+            fields.append((json.dumps([key, "count"]), count))
+        return fields
+
+    def from_fields(self, fields):
+        values = {}
+        for field, amount in fields:
+            parts = json.loads(field)
+            key = tuple(tuple(label) for label in parts[0])
+            entry = values.get(key)
+            if entry is None:
+                entry = values[key] = self._empty()
+            if parts[1] == "bucket":
+                entry[0][parts[2]] += int(float(amount))
+            elif parts[1] == "sum":
+                entry[1] += float(amount)
+            else:
+                entry[2] += int(float(amount))
+        return values
+
+    def samples(self, values):
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield self.name + "_bucket", key + (("le", le),), cumulative
+            yield self.name + "_sum", key, total
+            yield self.name + "_count", key, count
+
+
+class Collector(object):
+    """
+    Every process keeps its own metrics and a background thread adds what it
+    observed to hashes in Redis every few seconds, so the endpoint can show
+    the web workers and the celery workers together. Without an alias the
+    endpoint shows the process that serves it.
+    """
+
+    def __init__(self, alias=None, interval=5.0, prefix="metrics"):
+        self.alias = alias
+        self.interval = interval
+        self.prefix = prefix
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def ensure_started(self):
+        if not self.alias or self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            if self.pid is not None:
+                # forked, whatever the parent had pending is its to flush
+                for metric in REGISTRY.values():
+                    metric.take_pending()
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self.pid = os.getpid()
+
+    def _key(self, metric):
+        return "{}:{}".format(self.prefix, metric.name)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("failed to flush metrics")
+
+    def flush(self):
+        pipeline = get_redis_connection(self.alias).pipeline(transaction=False)
+        for metric in list(REGISTRY.values()):
+            for field, amount in metric.fields(metric.take_pending()):
+                pipeline.hincrbyfloat(self._key(metric), field, amount)
+        pipeline.execute()
+
+    def values(self, metric):
+        if not self.alias or metric.TYPE == "gauge":
+            with metric.lock:
+                return metric.copy_values()
+        fields = get_redis_connection(self.alias).hgetall(self._key(metric))
+        fields = [
+            (field.decode("utf-8"), amount.decode("utf-8"))
+            for field, amount in fields.items()
+        ]
+        if metric.TYPE == "histogram":
+            return metric.from_fields(fields)
+        values = {}
+        for field, amount in fields:
+            key = tuple(tuple(label) for label in json.loads(field)[0])
+            values[key] = float(amount)
+        return values
+
+
+def render():
+    lines = []
+    for metric in list(REGISTRY.values()):
+        lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+        lines.append("# TYPE {} {}".format(metric.name, metric.TYPE))
+        for name, labels, value in metric.samples(_collector.values(metric)):
+            if labels:
+                name = "{}{{{}}}".format(
+                    name,
+                    ",".join(
+                        '{}="{}"'.format(label, _escape(label_value))
+                        for label, label_value in labels
+                    ),
+                )
+            lines.append("{} {}".format(name, _format(value)))
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format(value):
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
+
+
+_collector = Collector(settings.METRICS_REDIS_ALIAS, settings.METRICS_FLUSH_INTERVAL)
+
+STAGE_SECONDS = Histogram(
+    "webhook_stage_seconds", "Time spent in each stage of handling a webhook."
+)
+TASK_SECONDS = Histogram("celery_task_seconds", "Run time of celery tasks.")
+TASK_QUEUE_SECONDS = Histogram(
+    "celery_task_queue_seconds", "Time celery tasks waited between publish and start."
+)
+
+_broker = []
+
+
+def get_celery_queue_depths():
+    # the redis transport keeps a list per queue and priority step
+    if not _broker:
+        _broker.append(StrictRedis.from_url(settings.CELERY_BROKER_URL))
+    options = settings.CELERY_BROKER_TRANSPORT_OPTIONS
+    queues = set(route["queue"] for route in settings.CELERY_TASK_ROUTES.values())
+    queues.add(settings.CELERY_TASK_DEFAULT_QUEUE)
+    queues = sorted(queues)
+
+    pipe = _broker[0].pipeline(transaction=False)
+    for queue in queues:
+        pipe.llen(queue)
+        for step in options["priority_steps"]:
+            if step:
+                pipe.llen("{}{}{}".format(queue, options["sep"], step))
+    lengths = iter(pipe.execute())
+    steps = len([step for step in options["priority_steps"] if step])
+    return [
+        ({"queue": queue}, sum(next(lengths) for _ in range(steps + 1)))
+        for queue in queues
+    ]
+
+
+CELERY_QUEUE_DEPTH = Gauge(
+    "celery_queue_depth",
+    "Tasks waiting in each celery queue.",
+    collect=get_celery_queue_depths,
+)
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 18:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Reminder',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('key', models.CharField(max_length=32, unique=True)),
+                ('target', models.CharField(max_length=64)),
+                ('text', models.TextField()),
+                ('tz', models.CharField(default='UTC', max_length=64)),
+                ('rule', models.TextField(blank=True, default='')),
+                ('status', models.PositiveSmallIntegerField(choices=[(0, 'pending'), (1, 'delivered'), (2, 'cancelled')], default=0)),
+                ('due_at', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('delivered_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='reminder',
+            index=models.Index(fields=['target', 'status', 'due_at'], name='reminder_target_due_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reminder',
+            index=models.Index(fields=['status', 'due_at'], name='reminder_status_due_idx'),
+        ),
+    ]
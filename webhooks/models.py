@@ -1,3 +1,133 @@
+import json
+from datetime import datetime, timedelta
+
 from django.db import models
+from django.db.models import Case, Q, When
+from django.utils import timezone
+
+from webhooks.recurrence import Recurrence
+
+
+def from_timestamp(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc)
+
+
+class ReminderQuerySet(models.QuerySet):
+    # pending reminders overdue by more than this are left out of listings,
+    # so a listing never walks the delivered history of a target
+    LIST_GRACE = timedelta(hours=1)
+
+    def pending_for(self, target, after=None, limit=9):
+        """
+        One page of a target's pending reminders in due order, read through
+        the (target, status, due_at) index. ``after`` is the (due_at, id) of the last
+        reminder of the previous page.
+        """
+        reminders = self.filter(
+            target=target,
+            status=Reminder.PENDING,
+            due_at__gte=timezone.now() - self.LIST_GRACE,
+        )
+        if after is not None:
+            due_at, pk = after
+            reminders = reminders.filter(
+                Q(due_at__gt=due_at) | Q(due_at=due_at, pk__gt=pk)
+            )
+        return reminders.order_by("due_at", "pk")[:limit]
+
+    def cancel_for(self, target, pk):
+        # only the conversation a reminder was set in may cancel it
+        try:
+            reminder = self.get(pk=int(pk), target=target, status=Reminder.PENDING)
+        except (ValueError, Reminder.DoesNotExist):
+            return None
+        cancelled = self.filter(pk=reminder.pk, status=Reminder.PENDING).update(
+            status=Reminder.CANCELLED
+        )
+        return reminder if cancelled else None
+
+    def due_between(self, start, end):
+        # answered from the (status, due_at) index alone
+        return self.filter(status=Reminder.PENDING, due_at__gte=start, due_at__lt=end)
+
+    def record_delivery(self, reminders):
+        """
+        Marks a delivered batch in two statements whatever its size: one shot
+        reminders become delivered, recurring ones move on to the next_due
+        the scheduler rearmed them with.
+        """
+        now = timezone.now()
+        once = [
+            reminder["id"] for reminder in reminders if not reminder.get("next_due")
+        ]
+        recurring = [reminder for reminder in reminders if reminder.get("next_due")]
+        updated = 0
+        if once:
+            updated += self.filter(key__in=once, status=Reminder.PENDING).update(
+                status=Reminder.DELIVERED, delivered_at=now
+            )
+        if recurring:
+            updated += self.filter(
+                key__in=[reminder["id"] for reminder in recurring],
+                status=Reminder.PENDING,
+            ).update(
+                due_at=Case(
+                    *[
+                        When(
+                            key=reminder["id"],
+                            then=models.Value(from_timestamp(reminder["next_due"])),
+                        )
+                        for reminder in recurring
+                    ],
+                    output_field=models.DateTimeField()
+                ),
+                delivered_at=now,
+            )
+        return updated
+
+
+class Reminder(models.Model):
+    """
+    The durable record of a reminder, the scheduler's Redis entry with the
+    same key is what makes it fire. Recurring reminders keep one row whose
+    due_at is their next occurrence.
+    """
+
+    PENDING = 0
+    DELIVERED = 1
+    CANCELLED = 2
+    STATUS_CHOICES = (
+        (PENDING, "pending"),
+        (DELIVERED, "delivered"),
+        (CANCELLED, "cancelled"),
+    )
+
+    id = models.BigAutoField(primary_key=True)
+    key = models.CharField(max_length=32, unique=True)
+    target = models.CharField(max_length=64)
+    text = models.TextField()
+    tz = models.CharField(max_length=64, default="UTC")
+    rule = models.TextField(blank=True, default="")
+    status = models.PositiveSmallIntegerField(choices=STATUS_CHOICES, default=PENDING)
+    due_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+
+    objects = ReminderQuerySet.as_manager()
+
+    class Meta:
+        # status sits between target and due_at, so a listing reads a single
+        # range of pending rows in due order however much history there is
+        indexes = [
+            models.Index(
+                fields=["target", "status", "due_at"], name="reminder_target_due_idx"
+            ),
+            models.Index(fields=["status", "due_at"], name="reminder_status_due_idx"),
+        ]
+
+    def __str__(self):
+        return "{} at {}".format(self.target, self.due_at)
 
-# Create your models here.
+    @property
+    def recurrence(self):
+        return Recurrence.from_dict(json.loads(self.rule)) if self.rule else None
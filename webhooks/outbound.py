@@ -0,0 +1,186 @@
+import json
+import logging
+import time
+
+from django.conf import settings
+from linebot.exceptions import LineBotApiError
+
+from webhooks.breaker import CircuitOpen, line_api_breaker
+from webhooks.dispatch import get_push_target
+from webhooks.line_api import line_bot_api
+from webhooks.messages import to_json
+from webhooks.metrics import STAGE_SECONDS, Counter, Histogram
+from webhooks.ratelimit import MULTICAST, PUSH, REPLY, outbound_limiter
+
+logger = logging.getLogger(__name__)
+
+# The sdk turns every message back into a dict and dumps the whole request,
+# these build the body from json fragments so pre-serialized replies are
+# sent as they are.
+
+
+def _messages_json(messages):
+    if not isinstance(messages, (list, tuple)):
+        messages = [messages]
+    return "[{}]".format(", ".join(to_json(message) for message in messages))
+
+
+def _post(path, body, api=line_bot_api, timeout=None):
+    with STAGE_SECONDS.time(stage="line_api", endpoint=path.rsplit("/", 1)[-1]):
+        if is_guarded(api):
+            with line_api_breaker.track():
+                api._post(path, data=body, timeout=timeout)
+        else:
+            api._post(path, data=body, timeout=timeout)
+
+
+def is_guarded(api):
+    # calls through another api object are the caller's business
+    return settings.LINE_API_BREAKER and api is line_bot_api
+
+
+REPLY_PATH = "/v2/bot/message/reply"
+PUSH_PATH = "/v2/bot/message/push"
+MULTICAST_PATH = "/v2/bot/message/multicast"
+
+
+def reply_body(reply_token, messages):
+    return '{{"replyToken": {}, "messages": {}}}'.format(
+        json.dumps(reply_token), _messages_json(messages)
+    )
+
+
+def push_body(to, messages):
+    # multicast takes the same body with a list of recipients
+    return '{{"to": {}, "messages": {}}}'.format(
+        json.dumps(to), _messages_json(messages)
+    )
+
+
+def _send_bulk(kind, path, body, api, timeout):
+    # pushes past the rate limit wait in line for drain_outbound, which sends
+    # them through the default api, and while the breaker is open they are
+    # parked for drain_parked
+    if is_guarded(api) and not line_api_breaker.allow():
+        line_api_breaker.park(kind, path, body)
+        return
+    if (
+        settings.OUTBOUND_RATE_LIMITED
+        and api is line_bot_api
+        and not outbound_limiter.submit(kind, path, body)
+    ):
+        return
+    _post(path, body, api=api, timeout=timeout)
+
+
+def reply_message(reply_token, messages, api=line_bot_api, timeout=None):
+    # a reply token does not outlive an outage, there is no parking it
+    if is_guarded(api):
+        line_api_breaker.check(REPLY)
+    if settings.OUTBOUND_RATE_LIMITED:
+        outbound_limiter.acquire(REPLY)
+    _post(REPLY_PATH, reply_body(reply_token, messages), api=api, timeout=timeout)
+
+
+def push_message(to, messages, api=line_bot_api, timeout=None):
+    _send_bulk(PUSH, PUSH_PATH, push_body(to, messages), api, timeout)
+
+
+def multicast(to, messages, api=line_bot_api, timeout=None):
+    _send_bulk(MULTICAST, MULTICAST_PATH, push_body(to, messages), api, timeout)
+
+
+def send_queued(path, body):
+    # calls the rate limiter queued meet the breaker like new ones
+    kind = path.rsplit("/", 1)[-1]
+    if settings.LINE_API_BREAKER and not line_api_breaker.allow():
+        line_api_breaker.park(kind, path, body)
+        return
+    _post(path, body)
+
+
+def send_parked(path, body):
+    # parked calls still take their turn in the rate limit
+    if settings.OUTBOUND_RATE_LIMITED:
+        outbound_limiter.acquire(path.rsplit("/", 1)[-1])
+    _post(path, body)
+
+
+# how an answer to an event went out
+REPLIED = "reply"
+PUSHED = "push"
+EXPIRED = "expired"
+USED = "used"
+BROKEN = "breaker"
+
+ANSWER_PATHS = Counter(
+    "webhook_answer_total",
+    "Answers to events sent as a reply, as a push because the reply token was "
+    "about to expire, as a push after LINE rejected an expired token, not at "
+    "all because LINE rejected a token already used, or parked as a push "
+    "while the circuit breaker was open.",
+)
+ANSWER_SECONDS = Histogram(
+    "webhook_answer_seconds",
+    "Time from receiving an event to answering it, reply tokens expire after "
+    "WEBHOOK_REPLY_TOKEN_TTL.",
+)
+
+
+def get_received_at(event):
+    # LINE's own timestamp counts as well, a redelivered event arrives late
+    received_at = event.timestamp / 1000.0
+    if getattr(event, "received_at", None) is not None:
+        received_at = min(received_at, event.received_at)
+    return received_at
+
+
+def has_reply_budget(event):
+    # the margin covers the reply call itself
+    deadline = get_received_at(event) + settings.WEBHOOK_REPLY_TOKEN_TTL
+    return time.time() + settings.WEBHOOK_REPLY_MARGIN < deadline
+
+
+def is_expired_token(error):
+    return (
+        error.status_code == 400
+        and "reply token" in (error.error.message or "").lower()
+    )
+
+
+def get_rejected_path(event):
+    # LINE rejects a used token like an expired one. Rejected with time to
+    # spare, it was used by a delivery of the same event dedup missed, whose
+    # answer arrived already
+    deadline = get_received_at(event) + settings.WEBHOOK_REPLY_TOKEN_TTL
+    if time.time() + 2 * settings.WEBHOOK_REPLY_MARGIN < deadline:
+        return USED
+    return EXPIRED
+
+
+def record_answer(event, path):
+    ANSWER_PATHS.inc(path=path)
+    ANSWER_SECONDS.observe(time.time() - get_received_at(event), path=path)
+
+
+def answer(event, messages, api=line_bot_api):
+    """
+    Replies to ``event`` while its reply token is still good and pushes the
+    same messages to its conversation once it is not, so a slow answer
+    arrives late rather than never.
+    """
+    path = PUSHED
+    if has_reply_budget(event):
+        try:
+            reply_message(event.reply_token, messages, api=api)
+            path = REPLIED
+        except LineBotApiError as e:
+            if not is_expired_token(e):
+                raise
+            path = get_rejected_path(event)
+            logger.warning("reply token of a %s event %s", event.type, path)
+        except CircuitOpen:
+            path = BROKEN
+    if path not in (REPLIED, USED):
+        push_message(get_push_target(event.source), messages, api=api)
+    record_answer(event, path)
@@ -0,0 +1,315 @@
+import json
+import logging
+import time
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from webhooks.metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+REPLY = "reply"
+PUSH = "push"
+MULTICAST = "multicast"
+
+OK = b"ok"
+WAIT = b"wait"
+QUEUED = b"queued"
+EMPTY = b"empty"
+
+# Takes a token from the endpoint bucket and the bucket the whole channel
+# shares, or tells how long until both have one. Pushes and multicasts leave
+# `floor` tokens of the shared bucket to replies, and once any bulk call is
+# queued every later one queues behind it so their order holds. With ARGV[1]
+# "drain" it moves the head of the queue to the processing list when its
+# tokens are there.
+ACQUIRE_SCRIPT = """
+local mode, now, kind, prefix = ARGV[1], tonumber(ARGV[2]), ARGV[3], ARGV[4]
+local rates, shared_rate, floor = cjson.decode(ARGV[5]), tonumber(ARGV[6]), tonumber(ARGV[7])
+local item = ARGV[8]
+local queued = redis.call('LLEN', KEYS[2])
+
+if mode == 'bulk' then
+    queued = queued + redis.call('LLEN', KEYS[3])
+end
+
+if mode == 'drain' then
+    if queued == 0 then
+        return {'empty', '0'}
+    end
+    item = redis.call('LINDEX', KEYS[2], 0)
+    kind = cjson.decode(item)['kind']
+elseif mode == 'bulk' and queued > 0 then
+    redis.call('RPUSH', KEYS[2], item)
+    return {'queued', tostring(queued + 1)}
+end
+
+local wait = 0
+local blocked = redis.call('PTTL', prefix .. ':blocked:' .. kind)
+if blocked > 0 then
+    wait = blocked / 1000
+end
+
+local buckets = {
+    {prefix .. ':bucket:' .. kind, tonumber(rates[kind]) or shared_rate, 0},
+    {KEYS[1], shared_rate, floor},
+}
+for _, bucket in ipairs(buckets) do
+    local rate = bucket[2]
+    local state = redis.call('HMGET', bucket[1], 'tokens', 'at')
+    local tokens = tonumber(state[1]) or rate
+    local at = tonumber(state[2]) or now
+    tokens = math.min(rate, tokens + math.max(0, now - at) * rate)
+    if tokens < 1 + bucket[3] then
+        wait = math.max(wait, (1 + bucket[3] - tokens) / rate)
+    end
+    bucket[3] = tokens
+end
+
+if wait > 0 then
+    if mode == 'bulk' then
+        redis.call('RPUSH', KEYS[2], item)
+        return {'queued', tostring(queued + 1)}
+    end
+    return {'wait', tostring(wait)}
+end
+
+for _, bucket in ipairs(buckets) do
+    redis.call('HSET', bucket[1], 'tokens', tostring(bucket[3] - 1), 'at', tostring(now))
+    redis.call('EXPIRE', bucket[1], 60)
+end
+if mode == 'drain' then
+    redis.call('LPOP', KEYS[2])
+    redis.call('RPUSH', KEYS[3], item)
+    return {'item', item}
+end
+return {'ok', '0'}
+"""
+
+THROTTLE_SECONDS = Counter(
+    "outbound_throttle_seconds_total",
+    "Time outbound calls waited for the rate limit.",
+)
+QUEUED_CALLS = Counter(
+    "outbound_queued_total", "Pushes and multicasts queued behind the rate limit."
+)
+RATE_LIMITED = Counter(
+    "outbound_rate_limited_total", "Calls the LINE API answered with 429."
+)
+QUEUE_SECONDS = Histogram(
+    "outbound_queue_seconds", "Time queued calls waited before being sent."
+)
+
+
+class OutboundLimiter(object):
+    """
+    Token buckets in Redis shared by every web and celery process, one per
+    endpoint and one for the channel. Replies wait a moment for a token,
+    pushes and multicasts that find none are queued and sent by drain() in
+    order. A 429 blocks its endpoint for everyone until Retry-After passes.
+    """
+
+    def __init__(
+        self,
+        alias="default",
+        rates=None,
+        shared_rate=2000,
+        reply_reserve=0.2,
+        reply_max_wait=1.0,
+        prefix="outbound",
+    ):
+        self.alias = alias
+        self.rates = dict(rates or {})
+        self.shared_rate = shared_rate
+        self.reply_reserve = reply_reserve
+        self.reply_max_wait = reply_max_wait
+        self.prefix = prefix
+        self.queue_key = "{}:queue".format(prefix)
+        self.processing_key = "{}:processing".format(prefix)
+        self.drain_lock_key = "{}:draining".format(prefix)
+        self.shared_key = "{}:bucket".format(prefix)
+        self._script = None
+
+    @property
+    def redis(self):
+        return get_redis_connection(self.alias)
+
+    @property
+    def script(self):
+        if self._script is None:
+            self._script = self.redis.register_script(ACQUIRE_SCRIPT)
+        return self._script
+
+    def _blocked_key(self, kind):
+        return "{}:blocked:{}".format(self.prefix, kind)
+
+    def _run(self, mode, kind, item=""):
+        floor = 0 if kind == REPLY else self.shared_rate * self.reply_reserve
+        status, value = self.script(
+            keys=[self.shared_key, self.queue_key, self.processing_key],
+            args=[
+                mode,
+                time.time(),
+                kind,
+                self.prefix,
+                json.dumps(self.rates),
+                self.shared_rate,
+                floor,
+                item,
+            ],
+        )
+        return status, value
+
+    def acquire(self, kind, max_wait=None):
+        """
+        Waits for a token for up to ``max_wait`` seconds, and lets the call
+        through after that, a reply is worthless once its token expires.
+        """
+        max_wait = self.reply_max_wait if max_wait is None else max_wait
+        deadline = time.time() + max_wait
+        while True:
+            wait = self.try_acquire(kind)
+            if not wait:
+                return
+            wait = min(wait, deadline - time.time())
+            if wait <= 0:
+                return
+            THROTTLE_SECONDS.inc(wait, kind=kind)
+            time.sleep(wait)
+
+    def try_acquire(self, kind):
+        # seconds until a token is there, 0 once one is taken
+        try:
+            status, value = self._run("send", kind)
+        except Exception:
+            # without redis the calls go out unthrottled rather than not at all
+            logger.exception("outbound rate limit unavailable")
+            return 0
+        return 0 if status == OK else float(value)
+
+    def submit(self, kind, path, body):
+        """
+        True when the call may go out now, False when it was queued.
+        """
+        item = json.dumps(
+            {"kind": kind, "path": path, "body": body, "queued_at": time.time()}
+        )
+        try:
+            status, value = self._run("bulk", kind, item)
+        except Exception:
+            logger.exception("outbound rate limit unavailable")
+            return True
+        if status == QUEUED:
+            QUEUED_CALLS.inc(kind=kind)
+            if int(value) == 1:
+                _schedule_drain()
+            return False
+        return True
+
+    def drain(self, send, budget=5.0):
+        """
+        Sends queued calls as their tokens come in, for up to ``budget``
+        seconds, and returns how many were sent. A call stays in the
+        processing list until ``send(path, body)`` returned, a 429, a 5xx or
+        a transport error puts it back at the head of the queue, and so does
+        the next drain when a worker was lost mid-call.
+        """
+        from linebot.exceptions import LineBotApiError
+
+        from webhooks.breaker import is_failure
+
+        redis = self.redis
+        if not redis.set(self.drain_lock_key, 1, nx=True, px=int(budget * 2000) or 1):
+            return 0
+        try:
+            self._restore_processing(redis)
+            deadline = time.time() + budget
+            sent = 0
+            while time.time() < deadline:
+                status, value = self._run("drain", "")
+                if status == EMPTY:
+                    break
+                if status == WAIT:
+                    wait = min(float(value), deadline - time.time())
+                    if wait > 0:
+                        THROTTLE_SECONDS.inc(wait, kind="queue")
+                        time.sleep(wait)
+                    continue
+
+                item = json.loads(value.decode("utf-8"))
+                try:
+                    send(item["path"], item["body"])
+                except Exception as e:
+                    if is_failure(e) or (
+                        isinstance(e, LineBotApiError) and e.status_code == 429
+                    ):
+                        logger.warning("queued %s failed, requeued", item["kind"])
+                        self._restore_processing(redis)
+                        break
+                    # one blocked or unknown target must not hold up the others
+                    logger.exception("queued %s failed", item["kind"])
+                else:
+                    QUEUE_SECONDS.observe(
+                        time.time() - item["queued_at"], kind=item["kind"]
+                    )
+                    sent += 1
+                redis.lrem(self.processing_key, 1, value)
+            return sent
+        finally:
+            redis.delete(self.drain_lock_key)
+
+    def _restore_processing(self, redis):
+        # back to the head of the queue, in the same order
+        items = redis.lrange(self.processing_key, 0, -1)
+        if items:
+            pipeline = redis.pipeline()
+            pipeline.lpush(self.queue_key, *reversed(items))
+            pipeline.delete(self.processing_key)
+            pipeline.execute()
+
+    def throttled(self, url, retry_after):
+        """
+        Called by the http client for every 429, holds the endpoint back in
+        every process until Retry-After has passed.
+        """
+        kind = url.rstrip("/").rsplit("/", 1)[-1]
+        RATE_LIMITED.inc(kind=kind)
+        try:
+            retry_after = float(retry_after or 1)
+        except ValueError:
+            retry_after = 1.0
+        try:
+            self.redis.set(
+                self._blocked_key(kind), 1, px=max(1, int(retry_after * 1000))
+            )
+        except Exception:
+            logger.exception("outbound rate limit unavailable")
+
+    def queue_depth(self):
+        return self.redis.llen(self.queue_key) + self.redis.llen(self.processing_key)
+
+
+def _schedule_drain():
+    # the beat drains the queue as well, this only saves waiting for it
+    from webhooks.tasks import drain_outbound
+
+    try:
+        drain_outbound.delay()
+    except Exception:
+        logger.exception("failed to schedule an outbound drain")
+
+
+outbound_limiter = OutboundLimiter(
+    settings.OUTBOUND_REDIS_ALIAS,
+    rates=settings.OUTBOUND_RATE_LIMITS,
+    shared_rate=settings.OUTBOUND_SHARED_RATE,
+    reply_reserve=settings.OUTBOUND_REPLY_RESERVE,
+    reply_max_wait=settings.OUTBOUND_REPLY_MAX_WAIT,
+)
+
+QUEUE_DEPTH = Gauge(
+    "outbound_queue_depth",
+    "Pushes and multicasts waiting for the rate limit.",
+    collect=lambda: [({}, outbound_limiter.queue_depth())],
+)
@@ -0,0 +1,159 @@
+"""
+Recurring reminder rules. A rule is kept as one reminder whose next
+occurrence is worked out when the current one fires, in the reminder's own
+zone so 9 AM stays 9 AM across daylight saving.
+"""
+
+import calendar
+import re
+from datetime import datetime, timedelta
+
+from .zones import get_zone
+
+DAILY = "daily"
+WEEKDAYS = "weekdays"
+WEEKLY = "weekly"
+MONTHLY = "monthly"
+CRON_PATTERN = re.compile(r"^cron\(([^)]*)\)$")
+
+LABELS = {DAILY: "每天", WEEKDAYS: "平日每天", WEEKLY: "每週", MONTHLY: "每月"}
+
+# ranges of minute, hour, day of month, month and day of week, where both 0
+# and 7 are sunday
+CRON_FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+
+def parse_cron_field(field, low, high):
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/", 1)
+            step = int(step)
+        if part == "*":
+            start, stop = low, high
+        elif "-" in part:
+            start, stop = (int(value) for value in part.split("-", 1))
+        else:
+            start = stop = int(part)
+            if step != 1:
+                stop = high
+        if step < 1 or start < low or stop > high or start > stop:
+            raise ValueError("cron field {!r} out of range".format(field))
+        values.update(range(start, stop + 1, step))
+    return sorted(values)
+
+
+class CronSpec(object):
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError("cron needs five fields, got {!r}".format(expression))
+        self.minutes, self.hours, self.days, self.months, weekdays = [
+            parse_cron_field(field, low, high)
+            for field, (low, high) in zip(fields, CRON_FIELDS)
+        ]
+        self.weekdays = set(weekday % 7 for weekday in weekdays)
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def matches_day(self, day):
+        if day.month not in self.months:
+            return False
+        in_month = day.day in self.days
+        in_week = (day.weekday() + 1) % 7 in self.weekdays
+        # like cron, a restricted day of month and day of week are either/or
+        if self.any_day:
+            return in_week
+        if self.any_weekday:
+            return in_month
+        return in_month or in_week
+
+    def next_after(self, local):
+        start = local.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        day = start.replace(hour=0, minute=0)
+        # every schedule cron can express comes round within a few years
+        for _ in range(366 * 5):
+            if self.matches_day(day):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        candidate = day.replace(hour=hour, minute=minute)
+                        if candidate >= start:
+                            return candidate
+            day += timedelta(days=1)
+        raise ValueError("cron schedule never fires")
+
+
+class Recurrence(object):
+    def __init__(self, repeat, tz, start):
+        # start is the local time the user picked, the first occurrence is
+        # the earliest one at or after it
+        self.repeat = repeat
+        self.tz = tz
+        self.zone = get_zone(tz)
+        self.start = start.replace(second=0, microsecond=0)
+        self.cron = None
+        match = CRON_PATTERN.match(repeat)
+        if match:
+            self.cron = CronSpec(match.group(1))
+        elif repeat not in LABELS:
+            raise ValueError("unknown repeat {!r}".format(repeat))
+
+    @classmethod
+    def from_dict(cls, rule):
+        return cls(
+            rule["repeat"],
+            rule["tz"],
+            datetime.strptime(rule["start"], "%Y-%m-%dT%H:%M"),
+        )
+
+    def as_dict(self):
+        return {
+            "repeat": self.repeat,
+            "tz": self.tz,
+            "start": self.start.strftime("%Y-%m-%dT%H:%M"),
+        }
+
+    @property
+    def label(self):
+        if self.cron is not None:
+            return "依照 {} ".format(self.repeat)
+        return LABELS[self.repeat]
+
+    def first(self):
+        return self.zone.to_utc(self._local_after(self.start - timedelta(minutes=1)))
+
+    def next_after(self, utc):
+        local = max(self.zone.from_utc(utc), self.start - timedelta(minutes=1))
+        return self.zone.to_utc(self._local_after(local))
+
+    def _local_after(self, local):
+        if self.cron is not None:
+            return self.cron.next_after(local)
+
+        if self.repeat == MONTHLY:
+            year, month = local.year, local.month
+            while True:
+                candidate = self._in_month(year, month)
+                if candidate > local:
+                    return candidate
+                year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+        candidate = datetime.combine(local.date(), self.start.time())
+        if candidate <= local:
+            candidate += timedelta(days=1)
+        while not self._on_day(candidate):
+            candidate += timedelta(days=1)
+        return candidate
+
+    def _on_day(self, candidate):
+        if self.repeat == WEEKDAYS:
+            return candidate.weekday() < 5
+        if self.repeat == WEEKLY:
+            return candidate.weekday() == self.start.weekday()
+        return True
+
+    def _in_month(self, year, month):
+        # the 31st falls on the last day of shorter months
+        day = min(self.start.day, calendar.monthrange(year, month)[1])
+        return datetime(year, month, day, self.start.hour, self.start.minute)
@@ -0,0 +1,132 @@
+import re
+from collections import namedtuple
+
+Token = namedtuple("Token", ["value", "text", "start", "end"])
+Route = namedtuple("Route", ["intent", "keyword", "slots"])
+
+KEYWORD_GROUP = "kw"
+
+
+def trie_pattern(words):
+    """
+    Builds a regex matching any of ``words`` shaped like a trie, so the
+    engine walks one branch per character instead of trying every word at
+    every position. The longest word wins when one is a prefix of another.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node):
+        terminal = "" in node
+        branches = [
+            re.escape(char) + build(child)
+            for char, child in sorted(node.items())
+            if char
+        ]
+        if not branches:
+            return ""
+        body = (
+            branches[0] if len(branches) == 1 else "(?:{})".format("|".join(branches))
+        )
+        if terminal:
+            return "(?:{})?".format(body)
+        return body
+
+    return build(trie)
+
+
+class IntentRouter(object):
+    """
+    Compiles every intent keyword and slot pattern into one alternation of
+    named groups, so a message is classified and its slots are extracted in
+    a single scan. Intents keep the priority of their declaration order no
+    matter where in the message they appear.
+    """
+
+    def __init__(self, intents, slots=()):
+        # intents: [(pattern, intent)], slots: [(name, value, pattern)]
+        # patterns may only use non-capturing groups, the match is resolved
+        # through the name of the outer group. Plain keywords share a single
+        # trie, anything with regex syntax gets a group of its own.
+        self.intents = [intent for _, intent in intents]
+        self.keywords = {}
+        self.intent_groups = {}
+        self.slot_groups = {}
+        # a slot spelled exactly like an intent keyword is filled by the
+        # intent match itself, it would never win the alternation otherwise
+        self.intent_slots = {}
+
+        alternatives = []
+        patterns = {}
+        for priority, (pattern, _) in enumerate(intents):
+            patterns.setdefault(pattern, priority)
+            if _is_literal(pattern):
+                self.keywords.setdefault(pattern, priority)
+            else:
+                group = "i{}".format(priority)
+                self.intent_groups[group] = priority
+                alternatives.append("(?P<{}>{})".format(group, pattern))
+
+        if self.keywords:
+            alternatives.insert(
+                0, "(?P<{}>{})".format(KEYWORD_GROUP, trie_pattern(self.keywords))
+            )
+
+        seen = set()
+        for name, value, pattern in slots:
+            if (name, value, pattern) in seen:
+                continue
+            seen.add((name, value, pattern))
+            if pattern in patterns:
+                self.intent_slots.setdefault(patterns[pattern], []).append(
+                    (name, value)
+                )
+                continue
+
+            group = "s{}".format(len(self.slot_groups))
+            self.slot_groups[group] = (name, value)
+            alternatives.append("(?P<{}>{})".format(group, pattern))
+
+        self.pattern = re.compile("|".join(alternatives) or "(?!)")
+
+    def route(self, message):
+        best = None
+        keyword = None
+        slots = {}
+        for match in self.pattern.finditer(message):
+            group = match.lastgroup
+            start, end = match.span()
+            if group == KEYWORD_GROUP:
+                # every keyword that is a prefix of the match matched as well
+                matched = [
+                    (self.keywords[message[start:stop]], stop)
+                    for stop in range(start + 1, end + 1)
+                    if message[start:stop] in self.keywords
+                ]
+            elif group in self.intent_groups:
+                matched = [(self.intent_groups[group], end)]
+            else:
+                name, value = self.slot_groups[group]
+                slots.setdefault(name, []).append(
+                    Token(value, match.group(), start, end)
+                )
+                continue
+
+            for priority, stop in matched:
+                token = Token(None, message[start:stop], start, stop)
+                if best is None or priority < best:
+                    best = priority
+                    keyword = token
+                for name, value in self.intent_slots.get(priority, ()):
+                    slots.setdefault(name, []).append(token._replace(value=value))
+
+        intent = self.intents[best] if best is not None else None
+        return Route(intent, keyword, slots)
+
+
+def _is_literal(pattern):
+    return not any(char in pattern for char in ".^$*+?{}[]\\|()")
@@ -0,0 +1,248 @@
+import calendar
+import json
+import logging
+import time
+import uuid
+from datetime import datetime
+
+import redis
+from django.conf import settings
+
+from webhooks.recurrence import Recurrence
+
+logger = logging.getLogger(__name__)
+
+# Moves due reminders to the in-flight set in one step, so concurrent
+# pollers never hand out the same reminder twice.
+CLAIM_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #due == 0 then
+    return {}
+end
+for _, id in ipairs(due) do
+    redis.call('ZADD', KEYS[2], ARGV[3], id)
+end
+redis.call('ZREM', KEYS[1], unpack(due))
+local payloads = redis.call('HMGET', KEYS[3], unpack(due))
+local claimed = {}
+for i, id in ipairs(due) do
+    claimed[#claimed + 1] = id
+    claimed[#claimed + 1] = payloads[i]
+end
+return claimed
+"""
+
+# Puts back reminders whose poller died between claiming and handing off.
+REQUEUE_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, id in ipairs(expired) do
+    redis.call('ZADD', KEYS[1], ARGV[1], id)
+end
+if #expired > 0 then
+    redis.call('ZREM', KEYS[2], unpack(expired))
+end
+return #expired
+"""
+
+
+# Puts fired recurring reminders back with their next due time, unless they
+# were cancelled while in flight.
+REARM_SCRIPT = """
+local rearmed = 0
+for i = 1, #ARGV, 3 do
+    local id = ARGV[i]
+    redis.call('ZREM', KEYS[2], id)
+    if redis.call('HEXISTS', KEYS[3], id) == 1 then
+        redis.call('HSET', KEYS[3], id, ARGV[i + 2])
+        redis.call('ZADD', KEYS[1], ARGV[i + 1], id)
+        rearmed = rearmed + 1
+    end
+end
+return rearmed
+"""
+
+
+def to_timestamp(date_time):
+    # naive datetimes are UTC all over the reminder flow
+    if date_time.tzinfo is not None:
+        return calendar.timegm(date_time.utctimetuple()) + date_time.microsecond / 1e6
+    return calendar.timegm(date_time.timetuple()) + date_time.microsecond / 1e6
+
+
+def next_due(reminder, now):
+    # one that fired late is not caught up, it continues after now
+    recurrence = Recurrence.from_dict(reminder["rule"])
+    return to_timestamp(
+        recurrence.next_after(datetime.utcfromtimestamp(max(now, reminder["due"])))
+    )
+
+
+class ReminderScheduler(object):
+    """
+    Keeps pending reminders in a Redis sorted set scored by due time, with
+    the payloads in a hash next to it. Workers hold nothing until a reminder
+    is due, then poll() claims it atomically and hands it over. A recurring
+    reminder stays a single entry, rearmed with its next occurrence each time
+    it fires.
+    """
+
+    def __init__(self, url, prefix="reminders", batch_size=500, lease=60):
+        self.url = url
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.lease = lease
+        self.due_key = "{}:due".format(prefix)
+        self.inflight_key = "{}:inflight".format(prefix)
+        self.payload_key = "{}:payload".format(prefix)
+        self._redis = None
+        self._claim = None
+        self._requeue = None
+        self._rearm = None
+
+    @property
+    def redis(self):
+        # redis-py resets its connection pool itself when the pid changes
+        if self._redis is None:
+            self._redis = redis.StrictRedis.from_url(self.url)
+        return self._redis
+
+    @property
+    def claim_script(self):
+        if self._claim is None:
+            self._claim = self.redis.register_script(CLAIM_SCRIPT)
+        return self._claim
+
+    @property
+    def requeue_script(self):
+        if self._requeue is None:
+            self._requeue = self.redis.register_script(REQUEUE_SCRIPT)
+        return self._requeue
+
+    @property
+    def rearm_script(self):
+        if self._rearm is None:
+            self._rearm = self.redis.register_script(REARM_SCRIPT)
+        return self._rearm
+
+    def schedule(self, target, text, due_at, reminder_id=None, rule=None):
+        reminder_id = reminder_id or uuid.uuid4().hex
+        due = to_timestamp(due_at)
+        reminder = {"target": target, "text": text, "due": due}
+        if rule is not None:
+            reminder["rule"] = rule
+        payload = json.dumps(reminder)
+        pipeline = self.redis.pipeline()
+        pipeline.hset(self.payload_key, reminder_id, payload)
+        pipeline.zadd(self.due_key, {reminder_id: due})
+        pipeline.execute()
+        return reminder_id
+
+    def cancel(self, reminder_id):
+        pipeline = self.redis.pipeline()
+        pipeline.zrem(self.due_key, reminder_id)
+        pipeline.hdel(self.payload_key, reminder_id)
+        removed, _ = pipeline.execute()
+        return bool(removed)
+
+    def pending(self):
+        return self.redis.zcard(self.due_key)
+
+    def claim_due(self, now=None):
+        now = time.time() if now is None else now
+        claimed = self.claim_script(
+            keys=[self.due_key, self.inflight_key, self.payload_key],
+            args=[now, self.batch_size, now + self.lease],
+        )
+        reminders = []
+        for index in range(0, len(claimed), 2):
+            reminder_id, payload = claimed[index], claimed[index + 1]
+            if payload is not None:
+                reminders.append((reminder_id, json.loads(payload)))
+            else:
+                self.ack([reminder_id])
+        return reminders
+
+    def ack(self, reminder_ids):
+        if not reminder_ids:
+            return
+        pipeline = self.redis.pipeline()
+        pipeline.zrem(self.inflight_key, *reminder_ids)
+        pipeline.hdel(self.payload_key, *reminder_ids)
+        pipeline.execute()
+
+    def rearm(self, claimed, now=None):
+        """
+        Schedules the next occurrence of fired recurring reminders.
+        """
+        now = time.time() if now is None else now
+        args = []
+        dropped = []
+        for reminder_id, reminder in claimed:
+            try:
+                due = next_due(reminder, now)
+            except (KeyError, ValueError):
+                logger.exception("dropped reminder %s with a broken rule", reminder_id)
+                dropped.append(reminder_id)
+                continue
+            args.extend([reminder_id, due, json.dumps(dict(reminder, due=due))])
+
+        self.ack(dropped)
+        if not args:
+            return 0
+        return self.rearm_script(
+            keys=[self.due_key, self.inflight_key, self.payload_key], args=args
+        )
+
+    def requeue_expired(self, now=None):
+        now = time.time() if now is None else now
+        return self.requeue_script(
+            keys=[self.due_key, self.inflight_key], args=[now, self.batch_size]
+        )
+
+    def _handoff(self, reminder_id, reminder, now):
+        # the id and next occurrence let the delivery update its records
+        reminder = dict(reminder, id=reminder_id.decode("utf-8"))
+        if "rule" in reminder:
+            try:
+                reminder["next_due"] = next_due(
+                    reminder, time.time() if now is None else now
+                )
+            except (KeyError, ValueError):
+                pass
+        return reminder
+
+    def poll(self, deliver, now=None, max_batches=20):
+        """
+        Hands every due reminder to ``deliver``, one claimed batch per call,
+        and returns how many were delivered. Stops after ``max_batches`` so
+        one beat tick stays short.
+        """
+        self.requeue_expired(now)
+        delivered = 0
+        for _ in range(max_batches):
+            claimed = self.claim_due(now)
+            if not claimed:
+                break
+
+            reminders = [
+                self._handoff(reminder_id, reminder, now)
+                for reminder_id, reminder in claimed
+            ]
+            # a failed handoff is not acked and comes back once the lease ends
+            deliver(reminders)
+            recurring = [item for item in claimed if "rule" in item[1]]
+            self.ack([item[0] for item in claimed if "rule" not in item[1]])
+            self.rearm(recurring, now)
+
+            delivered += len(reminders)
+            lag = time.time() - min(reminder["due"] for reminder in reminders)
+            logger.debug("delivered %d reminders, max lag %.3fs", len(reminders), lag)
+            if len(claimed) < self.batch_size:
+                break
+
+        return delivered
+
+
+reminder_scheduler = ReminderScheduler(
+    settings.REMINDER_REDIS_URL, batch_size=settings.REMINDER_BATCH_SIZE
+)
@@ -0,0 +1,103 @@
+import base64
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+# the only flow parameter a postback still carries
+STATE_PARAM = "s"
+
+
+class ExpiredState(KeyError):
+    pass
+
+
+def encode_state(type, fields, data):
+    # positional, the field names are known to both ends, trailing blanks
+    # are left out
+    values = [data.get(name, "") for name in fields]
+    while values and values[-1] == "":
+        values.pop()
+    return json.dumps([type] + values, ensure_ascii=False, separators=(",", ":"))
+
+
+def decode_state(type, fields, payload):
+    values = json.loads(payload)
+    if values[0] != type:
+        return None
+    return dict(zip(fields, values[1:]))
+
+
+def new_token():
+    return base64.urlsafe_b64encode(os.urandom(6)).decode("ascii")
+
+
+class StateStore(object):
+    """
+    Flow state of a conversation, kept server side so postbacks only carry a
+    short token. Entries are keyed by the conversation and the token, so a
+    token is worthless anywhere else. They live in a shared Django cache and
+    fall back to a bounded in-process LRU when it is unset or unreachable.
+    """
+
+    def __init__(self, alias=None, ttl=604800, size=10000, prefix="webhooks:state"):
+        self.alias = alias
+        self.ttl = ttl
+        self.size = size
+        self.prefix = prefix
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def shared(self):
+        return caches[self.alias] if self.alias else None
+
+    def _key(self, key, token):
+        return "{}:{}:{}".format(self.prefix, key, token)
+
+    def save(self, key, payload):
+        token = new_token()
+        name = self._key(key, token)
+        if self.alias:
+            try:
+                self.shared.set(name, payload, timeout=self.ttl)
+                return token
+            except Exception:
+                logger.exception("shared flow state unavailable")
+
+        with self.lock:
+            self.entries[name] = (payload, time.time() + self.ttl)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return token
+
+    def load(self, key, token):
+        name = self._key(key, token)
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None and entry[1] < time.time():
+                del self.entries[name]
+                entry = None
+        if entry is not None:
+            return entry[0]
+
+        if self.alias:
+            try:
+                return self.shared.get(name)
+            except Exception:
+                logger.exception("shared flow state unavailable")
+        return None
+
+
+state_store = StateStore(
+    alias=settings.FLOW_STATE_ALIAS,
+    ttl=settings.FLOW_STATE_TTL,
+    size=settings.FLOW_STATE_LOCAL_SIZE,
+)
@@ -1,14 +1,117 @@
+import logging
+import time
+
+from celery import group
+from celery.signals import before_task_publish, task_postrun, task_prerun
+from django.conf import settings
+from django.db import DatabaseError
 from linebot.models import TextSendMessage
 
 from line_bot.celery_tasks import app
-from webhooks.line_api import line_bot_api
+from webhooks.audience import broadcaster
+from webhooks.breaker import line_api_breaker
+from webhooks.delivery import deliver
+from webhooks.metrics import TASK_QUEUE_SECONDS, TASK_SECONDS
+from webhooks.models import Reminder
+from webhooks.outbound import push_message, reply_message, send_parked, send_queued
+from webhooks.ratelimit import outbound_limiter
+from webhooks.scheduler import reminder_scheduler
+
+logger = logging.getLogger(__name__)
 
 
 @app.task
 def reply(reply_token, text):
-    line_bot_api.reply_message(reply_token, TextSendMessage(text=text))
+    reply_message(reply_token, TextSendMessage(text=text))
 
 
 @app.task
 def send(token, text):
-    line_bot_api.push_message(token, TextSendMessage(text=text))
+    push_message(token, TextSendMessage(text=text))
+
+
+@app.task
+def handle_webhook(body, signature, received_at=None):
+    # the signature was checked before the webhook was queued, it stays an
+    # argument for the tasks already queued with it
+    from webhooks.dispatch import process_webhook
+
+    process_webhook(body, received_at)
+
+
+@app.task(ignore_result=True)
+def poll_reminders():
+    reminder_scheduler.poll(deliver_reminders.delay)
+
+
+# poll acks the claimed reminders once this is published, so the message is
+# their only copy until the pushes went out
+@app.task(ignore_result=True, acks_late=True, reject_on_worker_lost=True)
+def deliver_reminders(reminders):
+    deliver(reminders)
+    try:
+        # reminders scheduled before they had rows carry no id
+        Reminder.objects.record_delivery(
+            [reminder for reminder in reminders if "id" in reminder]
+        )
+    except DatabaseError:
+        logger.exception("failed to record %d delivered reminders", len(reminders))
+
+
+@app.task(ignore_result=True)
+def broadcast(texts):
+    broadcast_id, chunks = broadcaster.start(texts)
+    dispatch_chunks(broadcast_id, chunks)
+    return broadcast_id
+
+
+def dispatch_chunks(broadcast_id, chunks):
+    # one task per chunk, spread over every worker of the bulk queue
+    if chunks:
+        group(
+            broadcast_chunk.si(broadcast_id, kind, start) for kind, start in chunks
+        ).apply_async()
+
+
+# a chunk is checked off once sent, a lost worker's chunk runs again
+@app.task(ignore_result=True, acks_late=True, reject_on_worker_lost=True)
+def broadcast_chunk(broadcast_id, kind, start):
+    broadcaster.run_chunk(broadcast_id, kind, start)
+
+
+@app.task(ignore_result=True)
+def drain_outbound():
+    outbound_limiter.drain(send_queued, budget=settings.OUTBOUND_DRAIN_SECONDS)
+
+
+@app.task(ignore_result=True)
+def drain_parked():
+    line_api_breaker.drain(send_parked, budget=settings.LINE_API_PARKED_DRAIN_SECONDS)
+
+
+@before_task_publish.connect
+def stamp_sent_at(headers=None, **kwargs):
+    headers["sent_at"] = time.time()
+
+
+def get_queue(task):
+    return (task.request.delivery_info or {}).get("routing_key") or ""
+
+
+@task_prerun.connect
+def record_queue_time(task=None, **kwargs):
+    task.request.started_at = time.time()
+    sent_at = getattr(task.request, "sent_at", None)
+    if sent_at is not None:
+        TASK_QUEUE_SECONDS.observe(
+            task.request.started_at - sent_at, task=task.name, queue=get_queue(task)
+        )
+
+
+@task_postrun.connect
+def record_run_time(task=None, **kwargs):
+    started_at = getattr(task.request, "started_at", None)
+    if started_at is not None:
+        TASK_SECONDS.observe(
+            time.time() - started_at, task=task.name, queue=get_queue(task)
+        )
@@ -1,3 +1,736 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+import unittest
+import uuid
+from datetime import datetime, timedelta
+from unittest import mock
+from urllib.parse import parse_qs
 
-# Create your tests here.
+import pytz
+import redis
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
+from linebot.models import (
+    BeaconEvent,
+    MessageEvent,
+    Postback,
+    PostbackEvent,
+    SourceGroup,
+    TextMessage,
+    TextSendMessage,
+)
+from linebot.models.error import Error
+
+from webhooks import aioserver, jobs, outbound
+from webhooks.breaker import CircuitBreaker
+from webhooks.cache import CACHE_LOOKUPS, CACHE_SAVED_SECONDS, ResponseCache
+from webhooks.dedup import DEDUP_EVENTS, DEDUP_FALSE_POSITIVES, EventDeduplicator
+from webhooks.dispatch import (
+    SYNC_MODE,
+    EventPool,
+    dispatch_webhook,
+    handle_event,
+)
+from webhooks.metrics import STAGE_SECONDS
+from webhooks.http_client import (
+    POOL_CONNECTIONS,
+    POOL_REQUESTS,
+    POOL_WAIT_SECONDS,
+    RETRIES,
+    RETRY_KEY_HEADER,
+    PooledHttpClient,
+    TimedHTTPConnectionPool,
+)
+from webhooks.line_api import handler
+from webhooks.Parsers import (
+    BaseController,
+    BaseParser,
+    DateTimeConvertController,
+    TextParser,
+)
+from webhooks.messages import to_json
+from webhooks.recurrence import CronSpec, Recurrence
+from webhooks.scheduler import ReminderScheduler, next_due, to_timestamp
+from webhooks.state import StateStore
+from webhooks.views import build_postback_reply, build_text_reply
+from webhooks.zones import gazetteer, get_zone
+
+
+def redis_available():
+    try:
+        return redis.StrictRedis.from_url(settings.REMINDER_REDIS_URL).ping()
+    except redis.RedisError:
+        return False
+
+
+class HandleEventTests(SimpleTestCase):
+    # called like WebhookHandler.handle calls them, by their argument count
+    def setUp(self):
+        self.calls = []
+        self.event = BeaconEvent.new_from_json_dict(
+            {
+                "type": "beacon",
+                "timestamp": 1462629479859,
+                "source": {"type": "user", "userId": "U1"},
+                "beacon": {"hwid": "d41d8cd98f", "type": "enter"},
+            }
+        )
+
+    def handle(self, func):
+        with mock.patch.dict(handler._handlers, {"BeaconEvent": func}):
+            handle_event(self.event, destination="Ubot")
+
+    def test_no_arguments(self):
+        self.handle(lambda: self.calls.append(()))
+        self.assertEqual(self.calls, [()])
+
+    def test_event(self):
+        self.handle(lambda event: self.calls.append((event,)))
+        self.assertEqual(self.calls, [(self.event,)])
+
+    def test_event_and_destination(self):
+        self.handle(lambda event, destination: self.calls.append((event, destination)))
+        self.assertEqual(self.calls, [(self.event, "Ubot")])
+
+
+@override_settings(WEBHOOK_DISPATCH_MODE=SYNC_MODE)
+class SyncDispatchTests(SimpleTestCase):
+    BODY = json.dumps(
+        {
+            "destination": "B1",
+            "events": [
+                {
+                    "type": "beacon",
+                    "timestamp": 1,
+                    "source": {"type": "user", "userId": "U1"},
+                    "beacon": {"hwid": "h1", "type": "enter"},
+                },
+                {"type": "unknown", "timestamp": 1},
+            ],
+        }
+    )
+
+    def count(self, stage):
+        entry = STAGE_SECONDS.values.get(STAGE_SECONDS._labels({"stage": stage}))
+        return entry[2] if entry else 0
+
+    def test_times_the_signature_check_once(self):
+        signature, parse = self.count("signature"), self.count("parse")
+        validate = mock.Mock(return_value=True)
+        with mock.patch.object(
+            handler.parser.signature_validator, "validate", validate
+        ):
+            with mock.patch("webhooks.dispatch.handle_events") as handle_events:
+                with self.assertLogs("webhooks.dispatch", "WARNING"):
+                    dispatch_webhook(self.BODY, "s")
+        validate.assert_called_once_with(self.BODY, "s")
+        self.assertEqual(self.count("signature"), signature + 1)
+        self.assertEqual(self.count("parse"), parse + 1)
+        events, destination = handle_events.call_args[0]
+        self.assertEqual([event.type for event in events], ["beacon"])
+        self.assertEqual(destination, "B1")
+
+    def test_rejects_a_bad_signature(self):
+        with mock.patch("webhooks.dispatch.handle_events") as handle_events:
+            with self.assertRaises(InvalidSignatureError):
+                dispatch_webhook(self.BODY, "s")
+        handle_events.assert_not_called()
+
+
+class EventPoolTests(SimpleTestCase):
+    def get_events(self):
+        return [
+            mock.Mock(
+                type="message",
+                source=mock.Mock(user_id=user, room_id=None, group_id=None),
+            )
+            for user in ["U1", "U2", "U1", "U3"]
+        ]
+
+    def run_pool(self, concurrency):
+        handled = []
+
+        def handle(event):
+            handled.append(event)
+            if event.source.user_id == "U2":
+                raise ValueError(event.source.user_id)
+
+        events = self.get_events()
+        with self.assertLogs("webhooks.dispatch", "ERROR"):
+            with self.assertRaisesMessage(ValueError, "U2"):
+                EventPool(threads=2, concurrency=concurrency).run(events, handle)
+        return events, handled
+
+    def test_one_lane_handles_every_event_before_raising(self):
+        events, handled = self.run_pool(concurrency=1)
+        self.assertEqual(handled, events)
+
+    def test_lanes_handle_every_event_before_raising(self):
+        events, handled = self.run_pool(concurrency=3)
+        self.assertCountEqual(handled, events)
+
+
+@mock.patch.object(outbound, "record_answer")
+@mock.patch.object(outbound, "push_message")
+@mock.patch.object(outbound, "reply_message")
+class AnswerTests(SimpleTestCase):
+    INVALID_TOKEN = LineBotApiError(400, Error(message="Invalid reply token"))
+
+    def get_event(self, age):
+        received_at = time.time() - age
+        return mock.Mock(
+            type="message",
+            reply_token="r1",
+            timestamp=received_at * 1000,
+            received_at=received_at,
+            source=mock.Mock(user_id="U1", room_id=None, group_id=None),
+        )
+
+    def answer(self, age):
+        event = self.get_event(age)
+        outbound.answer(event, TextSendMessage(text="hi"))
+        return event
+
+    def test_replies_within_the_budget(self, reply, push, record):
+        event = self.answer(age=1)
+        reply.assert_called_once()
+        push.assert_not_called()
+        record.assert_called_once_with(event, outbound.REPLIED)
+
+    def test_pushes_once_the_budget_is_spent(self, reply, push, record):
+        event = self.answer(age=settings.WEBHOOK_REPLY_TOKEN_TTL)
+        reply.assert_not_called()
+        push.assert_called_once()
+        record.assert_called_once_with(event, outbound.PUSHED)
+
+    def test_pushes_when_a_token_near_its_end_is_rejected(self, reply, push, record):
+        reply.side_effect = self.INVALID_TOKEN
+        age = settings.WEBHOOK_REPLY_TOKEN_TTL - 1.5 * settings.WEBHOOK_REPLY_MARGIN
+        with self.assertLogs("webhooks.outbound", "WARNING"):
+            event = self.answer(age=age)
+        push.assert_called_once()
+        record.assert_called_once_with(event, outbound.EXPIRED)
+
+    def test_does_not_push_again_for_a_used_token(self, reply, push, record):
+        # a redelivery dedup missed, its first delivery answered already
+        reply.side_effect = self.INVALID_TOKEN
+        with self.assertLogs("webhooks.outbound", "WARNING"):
+            event = self.answer(age=1)
+        push.assert_not_called()
+        record.assert_called_once_with(event, outbound.USED)
+
+
+@override_settings(LINE_API_BREAKER=True)
+class AsyncBreakerTests(SimpleTestCase):
+    def post(self, recorded, error=None):
+        async def post(path, body):
+            if error is not None:
+                raise error
+
+        def record(latency, failed, probe=False):
+            recorded.append((failed, threading.current_thread()))
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            with mock.patch.object(aioserver.line_api_breaker, "record", record):
+                loop.run_until_complete(
+                    aioserver._post("/message/push", "{}", mock.Mock(post=post))
+                )
+        finally:
+            loop.close()
+            asyncio.set_event_loop(None)
+
+    def test_records_off_the_loop(self):
+        recorded = []
+        self.post(recorded)
+        [(failed, thread)] = recorded
+        self.assertFalse(failed)
+        self.assertIsNot(thread, threading.current_thread())
+
+    def test_records_a_failure(self):
+        recorded = []
+        with self.assertRaises(LineBotApiError):
+            self.post(recorded, LineBotApiError(503, Error(message="down")))
+        [(failed, thread)] = recorded
+        self.assertTrue(failed)
+        self.assertIsNot(thread, threading.current_thread())
+
+
+@mock.patch.object(CircuitBreaker, "_flush")
+class BreakerBatchTests(SimpleTestCase):
+    def get_breaker(self, **options):
+        breaker = CircuitBreaker(flush_seconds=60, **options)
+        breaker.flushed_at = time.time()
+        return breaker
+
+    def test_successes_wait_for_the_interval(self, flush):
+        breaker = self.get_breaker()
+        for _ in range(5):
+            breaker.record(0.1, False)
+        flush.assert_not_called()
+
+    def test_a_failure_is_added_right_away(self, flush):
+        breaker = self.get_breaker()
+        breaker.record(0.1, False)
+        breaker.record(0.1, True)
+        flush.assert_called_once_with([2, 1, 0])
+
+    def test_a_slow_call_is_added_right_away(self, flush):
+        breaker = self.get_breaker(slow_seconds=1.0)
+        breaker.record(1.5, False)
+        flush.assert_called_once_with([1, 0, 1])
+
+    def test_a_full_batch_is_added(self, flush):
+        breaker = self.get_breaker(flush_calls=3)
+        for _ in range(3):
+            breaker.record(0.1, False)
+        flush.assert_called_once_with([3, 0, 0])
+
+
+class DedupMetricsTests(SimpleTestCase):
+    def count(self, metric, **labels):
+        return metric.values.get(metric._labels(labels), 0)
+
+    def test_counts_new_and_redelivered_events(self):
+        deduplicator = EventDeduplicator()
+        new = self.count(DEDUP_EVENTS, result="new", checked="redis")
+        duplicate = self.count(DEDUP_EVENTS, result="duplicate", checked="redis")
+        with mock.patch.object(deduplicator, "_claim", side_effect=[True, False]):
+            self.assertFalse(deduplicator.is_duplicate("e1"))
+            self.assertTrue(deduplicator.is_duplicate("e1"))
+        self.assertEqual(
+            self.count(DEDUP_EVENTS, result="new", checked="redis"), new + 1
+        )
+        self.assertEqual(
+            self.count(DEDUP_EVENTS, result="duplicate", checked="redis"),
+            duplicate + 1,
+        )
+
+    def test_counts_filter_false_positives(self):
+        deduplicator = EventDeduplicator(local_filter=True)
+        deduplicator.pid = os.getpid()
+        deduplicator.filter = mock.MagicMock(**{"__contains__.return_value": True})
+        false_positives = self.count(DEDUP_FALSE_POSITIVES)
+        with mock.patch.object(deduplicator, "_claim", return_value=True):
+            self.assertFalse(deduplicator.is_duplicate("e2"))
+        self.assertEqual(self.count(DEDUP_FALSE_POSITIVES), false_positives + 1)
+
+
+class ResponseCacheMetricsTests(SimpleTestCase):
+    def count(self, metric, **labels):
+        return metric.values.get(metric._labels(labels), 0)
+
+    def test_counts_hits_and_the_time_they_saved(self):
+        cache = ResponseCache()
+        hits = self.count(CACHE_LOOKUPS, result="hit")
+        misses = self.count(CACHE_LOOKUPS, result="miss")
+        saved = self.count(CACHE_SAVED_SECONDS)
+        clock = [10.0]
+
+        def build():
+            clock[0] += 0.5
+            return TextSendMessage(text="hi")
+
+        with mock.patch("webhooks.cache.time.time", side_effect=lambda: clock[0]):
+            cache.get_or_build("k", build)
+            cache.get_or_build("k", build)
+        self.assertEqual(clock[0], 10.5)
+        self.assertEqual(self.count(CACHE_LOOKUPS, result="hit"), hits + 1)
+        self.assertEqual(self.count(CACHE_LOOKUPS, result="miss"), misses + 1)
+        self.assertEqual(self.count(CACHE_SAVED_SECONDS), saved + 0.5)
+
+
+class PooledHttpClientRetryTests(SimpleTestCase):
+    ENDPOINT = "https://api.line.me/v2/bot"
+
+    def send(self, method, path, *statuses):
+        client = PooledHttpClient(max_retries=3, backoff=0)
+        responses = [mock.Mock(status_code=status, headers={}) for status in statuses]
+        session = mock.Mock(**{"request.side_effect": responses})
+        with mock.patch.object(PooledHttpClient, "session", session):
+            if method == "GET":
+                response = client.get(self.ENDPOINT + path)
+            else:
+                response = client.post(self.ENDPOINT + path, headers={}, data="{}")
+        return response.status_code, session.request.call_args_list
+
+    def test_reply_is_not_sent_again_after_a_5xx(self):
+        status, calls = self.send("POST", "/message/reply", 500, 200)
+        self.assertEqual((status, len(calls)), (500, 1))
+
+    def test_reply_is_sent_again_after_a_429(self):
+        status, calls = self.send("POST", "/message/reply", 429, 200)
+        self.assertEqual((status, len(calls)), (200, 2))
+
+    def test_push_is_sent_again_under_the_same_retry_key(self):
+        status, calls = self.send("POST", "/message/push", 503, 200)
+        self.assertEqual((status, len(calls)), (200, 2))
+        keys = [call[1]["headers"][RETRY_KEY_HEADER] for call in calls]
+        self.assertEqual(keys[0], keys[1])
+
+    def test_push_accepted_before_its_retry_succeeds(self):
+        status, calls = self.send("POST", "/message/multicast", 500, 409)
+        self.assertEqual((status, len(calls)), (200, 2))
+
+    def test_get_is_sent_again_after_a_5xx(self):
+        retries = RETRIES.values.get(RETRIES._labels({"status": "502"}), 0)
+        status, calls = self.send("GET", "/profile/U1", 502, 200)
+        self.assertEqual((status, len(calls)), (200, 2))
+        self.assertEqual(
+            RETRIES.values[RETRIES._labels({"status": "502"})], retries + 1
+        )
+
+    def test_pool_counts_reused_connections_and_waits(self):
+        pool = TimedHTTPConnectionPool("localhost", maxsize=1, block=True)
+        requests_count = POOL_REQUESTS.values.get((), 0)
+        connections = POOL_CONNECTIONS.values.get((), 0)
+        waits = POOL_WAIT_SECONDS.values.get((), [None, 0, 0])[2]
+        pool._put_conn(pool._get_conn())
+        pool._get_conn()
+        self.assertEqual(POOL_REQUESTS.values[()], requests_count + 2)
+        self.assertEqual(POOL_CONNECTIONS.values[()], connections + 1)
+        self.assertEqual(POOL_WAIT_SECONDS.values[()][2], waits + 2)
+
+
+class ReminderFlowStateTests(SimpleTestCase):
+    @mock.patch.object(jobs, "state_store", StateStore(alias=None))
+    def test_group_member_without_user_id_gets_the_flow_back(self):
+        source = SourceGroup(group_id="G1")
+        asked = build_text_reply(
+            MessageEvent(source=source, message=TextMessage(text="提醒 喝水"))
+        )
+        data = re.search(r'action=choose_date[^"]*', to_json(asked)).group(0)
+        answer = build_postback_reply(
+            PostbackEvent(
+                source=source, postback=Postback(data="type=reminder&" + data)
+            )
+        )
+        self.assertEqual(json.loads(to_json(answer))["type"], "template")
+
+
+class SingleLetterUnitController(BaseController):
+    # the slots the temperature controller used to declare
+    SLOTS = [
+        ("unit", "C", "(?:[cC])+|(?:攝)+"),
+        ("unit", "F", "(?:[fF])+|(?:華)+"),
+        ("number", None, r"\d+"),
+    ]
+
+    @property
+    def result(self):
+        return None
+
+
+class SingleLetterUnitParser(BaseParser):
+    CONVERT_CLASSES = [
+        ("溫度", SingleLetterUnitController),
+        ("時間轉換", DateTimeConvertController),
+    ]
+
+
+@mock.patch.object(DateTimeConvertController, "CACHE_RESPONSES", False)
+class DateTimeConvertRoutingTests(SimpleTestCase):
+    PLACES = [
+        ("Chicago", "America/Chicago"),
+        ("Frankfurt", "Europe/Berlin"),
+        ("France", "Europe/Paris"),
+        ("Canada", "America/Toronto"),
+        ("Copenhagen", "Europe/Copenhagen"),
+        ("華盛頓", "America/New_York"),
+    ]
+
+    def get_choice(self, parser, message):
+        reply = json.loads(parser(message).parse().json)
+        data = parse_qs(reply["template"]["actions"][0]["data"])
+        return data["from_tz"][0], data["to_tz"][0]
+
+    def test_places_resolve(self):
+        for place, zone in self.PLACES:
+            with self.subTest(place=place):
+                self.assertEqual(
+                    self.get_choice(TextParser, "台灣時間轉換" + place),
+                    ("Asia/Taipei", zone),
+                )
+
+    def test_slots_of_other_controllers_do_not_take_place_names(self):
+        for place, zone in self.PLACES:
+            with self.subTest(place=place):
+                self.assertEqual(
+                    self.get_choice(SingleLetterUnitParser, "台灣時間轉換" + place),
+                    ("Asia/Taipei", zone),
+                )
+
+
+class ZoneTests(SimpleTestCase):
+    def test_hour_offsets(self):
+        self.assertEqual(get_zone("-9.5").offsets, [timedelta(hours=-9.5)])
+        self.assertEqual(get_zone("14").offsets, [timedelta(hours=14)])
+
+    def test_rejects_offsets_no_zone_has(self):
+        for name in ["inf", "-inf", "nan", "1e400", "15"]:
+            with self.subTest(name=name):
+                with self.assertRaises(pytz.UnknownTimeZoneError):
+                    get_zone(name)
+
+    def test_zone_cities_are_cities(self):
+        self.assertEqual(gazetteer.lookup("Kolkata").zone, "Asia/Kolkata")
+        self.assertEqual(
+            gazetteer.lookup("Buenos Aires").zone, "America/Argentina/Buenos_Aires"
+        )
+        for word in ["Eastern", "Central", "Pacific", "General", "Center", "Easter"]:
+            with self.subTest(word=word):
+                self.assertIsNone(gazetteer.lookup(word))
+
+
+class CronSpecTests(SimpleTestCase):
+    # 2030-03-01 is a friday
+    def test_weekdays_skip_the_weekend(self):
+        self.assertEqual(
+            CronSpec("0 9 * * 1-5").next_after(datetime(2030, 3, 1, 10, 0)),
+            datetime(2030, 3, 4, 9, 0),
+        )
+
+    def test_next_is_after_the_current_minute(self):
+        self.assertEqual(
+            CronSpec("30 8 1,15 * *").next_after(datetime(2030, 3, 1, 8, 30)),
+            datetime(2030, 3, 15, 8, 30),
+        )
+
+    def test_day_of_month_or_day_of_week(self):
+        self.assertEqual(
+            CronSpec("0 0 13 * 5").next_after(datetime(2030, 3, 1, 0, 0)),
+            datetime(2030, 3, 8, 0, 0),
+        )
+
+    def test_rejects_out_of_range_fields(self):
+        with self.assertRaises(ValueError):
+            CronSpec("0 24 * * *")
+
+
+class RecurrenceTests(SimpleTestCase):
+    def occurrences(self, recurrence, count):
+        occurrences = [recurrence.first()]
+        while len(occurrences) < count:
+            occurrences.append(recurrence.next_after(occurrences[-1]))
+        return occurrences
+
+    def test_daily(self):
+        recurrence = Recurrence("daily", "Asia/Taipei", datetime(2030, 3, 1, 9, 0))
+        self.assertEqual(
+            self.occurrences(recurrence, 3),
+            [
+                datetime(2030, 3, 1, 1, 0),
+                datetime(2030, 3, 2, 1, 0),
+                datetime(2030, 3, 3, 1, 0),
+            ],
+        )
+
+    def test_weekdays(self):
+        recurrence = Recurrence("weekdays", "Asia/Taipei", datetime(2030, 3, 1, 9, 0))
+        self.assertEqual(
+            self.occurrences(recurrence, 2),
+            [datetime(2030, 3, 1, 1, 0), datetime(2030, 3, 4, 1, 0)],
+        )
+
+    def test_monthly_falls_on_the_last_day_of_shorter_months(self):
+        recurrence = Recurrence("monthly", "Asia/Taipei", datetime(2030, 1, 31, 9, 0))
+        self.assertEqual(
+            self.occurrences(recurrence, 4),
+            [
+                datetime(2030, 1, 31, 1, 0),
+                datetime(2030, 2, 28, 1, 0),
+                datetime(2030, 3, 31, 1, 0),
+                datetime(2030, 4, 30, 1, 0),
+            ],
+        )
+
+    def test_local_time_holds_across_daylight_saving(self):
+        # los angeles moves to daylight saving on 2030-03-10
+        recurrence = Recurrence(
+            "daily", "America/Los_Angeles", datetime(2030, 3, 9, 9, 0)
+        )
+        self.assertEqual(
+            self.occurrences(recurrence, 3),
+            [
+                datetime(2030, 3, 9, 17, 0),
+                datetime(2030, 3, 10, 16, 0),
+                datetime(2030, 3, 11, 16, 0),
+            ],
+        )
+
+    def test_cron_across_daylight_saving(self):
+        # london moves to summer time on 2030-03-31
+        recurrence = Recurrence(
+            "cron(0 9 * * *)", "Europe/London", datetime(2030, 3, 30, 9, 0)
+        )
+        self.assertEqual(
+            self.occurrences(recurrence, 2),
+            [datetime(2030, 3, 30, 9, 0), datetime(2030, 3, 31, 8, 0)],
+        )
+
+    def test_round_trips_through_its_dict(self):
+        recurrence = Recurrence("weekly", "Asia/Tokyo", datetime(2030, 3, 1, 9, 0))
+        again = Recurrence.from_dict(json.loads(json.dumps(recurrence.as_dict())))
+        self.assertEqual(self.occurrences(again, 3), self.occurrences(recurrence, 3))
+
+
+@unittest.skipUnless(redis_available(), "needs the redis of REMINDER_REDIS_URL")
+class FakeRearmScript(object):
+    # what REARM_SCRIPT does to the due set and the payloads, in dicts
+    def __init__(self, due, payloads):
+        self.due = due
+        self.payloads = payloads
+
+    def __call__(self, keys, args):
+        rearmed = 0
+        for index in range(0, len(args), 3):
+            reminder_id, due, payload = args[index : index + 3]
+            if reminder_id in self.payloads:
+                self.payloads[reminder_id] = payload
+                self.due[reminder_id] = due
+                rearmed += 1
+        return rearmed
+
+
+class RearmTests(SimpleTestCase):
+    RULES = 100000
+    REPEATS = ["daily", "weekdays", "weekly", "monthly", "cron(0 */6 * * *)"]
+    EPOCH = datetime(2030, 3, 1)
+
+    def get_reminder(self, repeat, due_at, zone="America/Los_Angeles"):
+        recurrence = Recurrence(repeat, zone, due_at)
+        return {
+            "target": "U1",
+            "text": "recurring",
+            "due": to_timestamp(recurrence.first()),
+            "rule": recurrence.as_dict(),
+        }
+
+    def test_next_due_is_the_next_occurrence(self):
+        reminder = self.get_reminder("daily", self.EPOCH)
+        self.assertEqual(
+            next_due(reminder, reminder["due"]), reminder["due"] + 24 * 3600
+        )
+
+    def test_late_firing_continues_after_now(self):
+        reminder = self.get_reminder("daily", self.EPOCH)
+        late = reminder["due"] + 3 * 24 * 3600 + 60
+        self.assertEqual(next_due(reminder, late), reminder["due"] + 4 * 24 * 3600)
+
+    def test_handoff_carries_the_id_and_next_occurrence(self):
+        scheduler = ReminderScheduler("redis://localhost:1/0")
+        reminder = self.get_reminder("daily", self.EPOCH)
+        handed = scheduler._handoff(b"rule-1", reminder, reminder["due"])
+        self.assertEqual(handed["id"], "rule-1")
+        self.assertEqual(handed["next_due"], reminder["due"] + 24 * 3600)
+        broken = dict(reminder, rule={})
+        self.assertNotIn("next_due", scheduler._handoff(b"rule-2", broken, 0))
+
+    def test_broken_rule_is_dropped(self):
+        scheduler = ReminderScheduler("redis://localhost:1/0")
+        scheduler._rearm = FakeRearmScript({}, {})
+        with mock.patch.object(scheduler, "ack") as ack:
+            with self.assertLogs("webhooks.scheduler", "ERROR"):
+                self.assertEqual(scheduler.rearm([(b"rule-1", {"due": 0})], 0), 0)
+        ack.assert_called_once_with([b"rule-1"])
+
+    def test_every_rule_stays_one_entry(self):
+        due, payloads = {}, {}
+        for index in range(self.RULES):
+            reminder = self.get_reminder(
+                self.REPEATS[index % len(self.REPEATS)],
+                self.EPOCH + timedelta(minutes=index % 1440),
+            )
+            reminder_id = "rule-{}".format(index)
+            due[reminder_id] = reminder["due"]
+            payloads[reminder_id] = json.dumps(reminder)
+        scheduler = ReminderScheduler("redis://localhost:1/0")
+        scheduler._rearm = FakeRearmScript(due, payloads)
+
+        fired = set()
+        now = to_timestamp(self.EPOCH)
+        # hourly polls until every rule fired, weekly and monthly rules once
+        for _ in range(36):
+            now += 3600
+            claimed = [
+                (reminder_id, json.loads(payloads[reminder_id]))
+                for reminder_id, score in list(due.items())
+                if score <= now
+            ]
+            for reminder_id, _ in claimed:
+                del due[reminder_id]
+            self.assertEqual(scheduler.rearm(claimed, now), len(claimed))
+            self.assertEqual((len(due), len(payloads)), (self.RULES, self.RULES))
+            fired.update(reminder_id for reminder_id, _ in claimed)
+
+        self.assertEqual(len(fired), self.RULES)
+        self.assertTrue(all(score > now for score in due.values()))
+
+
+class RecurringRearmTests(SimpleTestCase):
+    RULES = 1000
+    REPEATS = RearmTests.REPEATS
+    EPOCH = RearmTests.EPOCH
+
+    def setUp(self):
+        self.scheduler = ReminderScheduler(
+            settings.REMINDER_REDIS_URL,
+            prefix="test:{}".format(uuid.uuid4().hex),
+            batch_size=200,
+        )
+        self.addCleanup(
+            self.scheduler.redis.delete,
+            self.scheduler.due_key,
+            self.scheduler.inflight_key,
+            self.scheduler.payload_key,
+        )
+        for index in range(self.RULES):
+            recurrence = Recurrence(
+                self.REPEATS[index % len(self.REPEATS)],
+                "America/Los_Angeles",
+                self.EPOCH + timedelta(minutes=index),
+            )
+            self.scheduler.schedule(
+                "U{}".format(index),
+                "recurring",
+                recurrence.first(),
+                reminder_id="rule-{}".format(index),
+                rule=recurrence.as_dict(),
+            )
+
+    def footprint(self):
+        redis = self.scheduler.redis
+        return (
+            redis.zcard(self.scheduler.due_key),
+            redis.zcard(self.scheduler.inflight_key),
+            redis.hlen(self.scheduler.payload_key),
+        )
+
+    def test_every_rule_stays_one_entry(self):
+        fired = []
+        now = to_timestamp(self.EPOCH)
+        # two weeks of hourly polls, daylight saving starts on the way
+        for _ in range(14 * 24):
+            now += 3600
+            while self.scheduler.poll(fired.extend, now=now):
+                pass
+            self.assertEqual(self.footprint(), (self.RULES, 0, self.RULES))
+
+        self.assertGreater(len(fired), self.RULES * 7)
+        due = self.scheduler.redis.zrange(
+            self.scheduler.due_key, 0, -1, withscores=True
+        )
+        self.assertTrue(all(score > now for _, score in due))
+
+    def test_cancelled_rule_is_not_rearmed(self):
+        self.scheduler.cancel("rule-0")
+        now = to_timestamp(self.EPOCH + timedelta(days=2))
+        while self.scheduler.poll(lambda reminders: None, now=now):
+            pass
+        self.assertEqual(self.footprint(), (self.RULES - 1, 0, self.RULES - 1))
@@ -0,0 +1,246 @@
+"""
+Quantities in a message and what they are in other units.
+
+Every unit alias goes into one trie shaped pattern and a dict, so finding the
+quantities of a message is a single scan and a lookup per match however many
+units there are. A unit is a scale and offset onto the base unit of its
+dimension, any two units of a dimension convert through it.
+"""
+
+import re
+from collections import namedtuple
+
+from .router import trie_pattern
+
+TEMPERATURE = "temperature"
+LENGTH = "length"
+WEIGHT = "weight"
+VOLUME = "volume"
+SPEED = "speed"
+CURRENCY = "currency"
+
+Unit = namedtuple("Unit", ["name", "dimension", "scale", "offset", "default", "label"])
+Quantity = namedtuple("Quantity", ["value", "unit", "target", "start", "end"])
+Conversion = namedtuple("Conversion", ["quantity", "target", "value"])
+
+# (name, dimension, scale, offset, converted to by default, label, aliases).
+# base = value * scale + offset, the bases are kelvin, metre, gram, litre,
+# metre per second and new taiwan dollar.
+UNITS = [
+    ("C", TEMPERATURE, 1.0, 273.15, "F", "°C", ["°C", "℃", "攝氏", "攝", "celsius"]),
+    (
+        "F",
+        TEMPERATURE,
+        5 / 9.0,
+        273.15 - 32 * 5 / 9.0,
+        "C",
+        "°F",
+        ["°F", "℉", "華氏", "華", "fahrenheit"],
+    ),
+    ("K", TEMPERATURE, 1.0, 0.0, "C", "K", ["kelvin", "克氏"]),
+    ("mm", LENGTH, 0.001, 0, "inch", "公釐", ["公釐", "毫米", "millimeter"]),
+    ("cm", LENGTH, 0.01, 0, "inch", "公分", ["公分", "釐米", "centimeter"]),
+    ("m", LENGTH, 1.0, 0, "ft", "公尺", ["公尺", "米", "meter", "meters", "metre"]),
+    (
+        "km",
+        LENGTH,
+        1000.0,
+        0,
+        "mi",
+        "公里",
+        ["公里", "千米", "kilometer", "kilometers"],
+    ),
+    ("inch", LENGTH, 0.0254, 0, "cm", "英吋", ["英吋", "吋", "inches"]),
+    ("ft", LENGTH, 0.3048, 0, "m", "英尺", ["英尺", "呎", "feet", "foot"]),
+    ("yd", LENGTH, 0.9144, 0, "m", "碼", ["碼", "yard", "yards"]),
+    ("mi", LENGTH, 1609.344, 0, "km", "英里", ["英里", "哩", "mile", "miles"]),
+    ("mg", WEIGHT, 0.001, 0, "g", "毫克", ["毫克"]),
+    ("g", WEIGHT, 1.0, 0, "oz", "公克", ["公克", "克", "gram", "grams"]),
+    ("kg", WEIGHT, 1000.0, 0, "lb", "公斤", ["公斤", "千克", "kilogram", "kilograms"]),
+    ("t", WEIGHT, 1e6, 0, "kg", "公噸", ["公噸", "噸", "ton", "tons"]),
+    ("oz", WEIGHT, 28.349523125, 0, "g", "盎司", ["盎司", "ounce", "ounces"]),
+    ("lb", WEIGHT, 453.59237, 0, "kg", "磅", ["磅", "lbs", "pound", "pounds"]),
+    ("台斤", WEIGHT, 600.0, 0, "kg", "台斤", ["斤"]),
+    ("ml", VOLUME, 0.001, 0, "floz", "毫升", ["毫升", "cc", "milliliter"]),
+    ("l", VOLUME, 1.0, 0, "gal", "公升", ["公升", "升", "liter", "liters", "litre"]),
+    ("floz", VOLUME, 0.0295735295625, 0, "ml", "液量盎司", ["液量盎司", "fl oz"]),
+    ("cup", VOLUME, 0.2365882365, 0, "ml", "杯", ["cups"]),
+    ("gal", VOLUME, 3.785411784, 0, "l", "加侖", ["加侖", "gallon", "gallons"]),
+    (
+        "km/h",
+        SPEED,
+        1 / 3.6,
+        0,
+        "mph",
+        "公里/小時",
+        ["公里/小時", "公里每小時", "kmh", "kph"],
+    ),
+    ("m/s", SPEED, 1.0, 0, "km/h", "公尺/秒", ["公尺/秒", "公尺每秒", "mps"]),
+    ("mph", SPEED, 0.44704, 0, "km/h", "英里/小時", ["英里/小時", "英里每小時"]),
+    ("knot", SPEED, 1852 / 3600.0, 0, "km/h", "節", ["節", "knots", "kn"]),
+    # fixed reference rates, not a live quote
+    (
+        "TWD",
+        CURRENCY,
+        1.0,
+        0,
+        "USD",
+        "新台幣",
+        ["新台幣", "台幣", "臺幣", "元", "塊", "NTD", "NT"],
+    ),
+    ("USD", CURRENCY, 31.5, 0, "TWD", "美元", ["美元", "美金", "US$"]),
+    ("EUR", CURRENCY, 34.0, 0, "TWD", "歐元", ["歐元", "€"]),
+    ("JPY", CURRENCY, 0.21, 0, "TWD", "日圓", ["日圓", "日元", "日幣", "円", "yen"]),
+    ("CNY", CURRENCY, 4.35, 0, "TWD", "人民幣", ["人民幣", "RMB"]),
+    ("HKD", CURRENCY, 4.05, 0, "TWD", "港幣", ["港幣", "港元"]),
+    ("KRW", CURRENCY, 0.023, 0, "TWD", "韓元", ["韓元", "韓圜", "won"]),
+    ("GBP", CURRENCY, 40.0, 0, "TWD", "英鎊", ["英鎊", "£"]),
+]
+
+# aliases that may come before the number as well, 華氏98度 or USD 100
+PREFIXES = {
+    "C": ["攝氏", "攝"],
+    "F": ["華氏", "華"],
+    "TWD": ["新台幣", "台幣", "NT$", "NTD", "TWD"],
+    "USD": ["美金", "US$", "USD"],
+    "EUR": ["€", "EUR"],
+    "JPY": ["JPY"],
+    "GBP": ["£", "GBP"],
+}
+
+# what asks for a conversion, 10公里轉英里 or 30C = ?F
+CONNECTORS = [
+    "轉",
+    "換",
+    "轉成",
+    "換成",
+    "換算",
+    "等於",
+    "是多少",
+    "是幾",
+    "=",
+    "to",
+    "in",
+]
+
+NUMBER = r"[-+]?(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?"
+
+MAX_QUANTITIES = 10
+
+
+def _is_ascii(name):
+    return all(ord(char) < 128 for char in name)
+
+
+def _alternation(words):
+    # latin words have to stand alone, m is not in "me"
+    alternatives = []
+    others = [word for word in words if not _is_ascii(word)]
+    latin = [word for word in words if _is_ascii(word)]
+    if others:
+        alternatives.append("(?i:{})".format(trie_pattern(others)))
+    if latin:
+        alternatives.append("(?i:(?<![a-z]){}(?![a-z]))".format(trie_pattern(latin)))
+    return "|".join(alternatives) or "(?!)"
+
+
+def format_number(value):
+    if value and abs(value) < 0.01:
+        return "{:.3g}".format(value)
+    text = "{:,.2f}".format(value).rstrip("0").rstrip(".")
+    return "0" if text == "-0" else text
+
+
+class UnitTable(object):
+    def __init__(self, entries, prefixes=PREFIXES):
+        self.units = {}
+        self.aliases = {}
+        for name, dimension, scale, offset, default, label, aliases in entries:
+            self.units[name] = Unit(name, dimension, scale, offset, default, label)
+            for alias in [name] + aliases:
+                self.aliases.setdefault(alias.lower(), name)
+        self.prefixes = {}
+        for name, aliases in prefixes.items():
+            for alias in aliases:
+                self.prefixes.setdefault(alias.lower(), name)
+                self.aliases.setdefault(alias.lower(), name)
+
+        unit = _alternation(self.aliases)
+        prefix = _alternation(self.prefixes)
+        # the router takes a quantity followed by a connector as the intent,
+        # it may only have non-capturing groups
+        quantity = r"{number}\s*度?\s*(?:{unit})|(?:{prefix})\s*{number}".format(
+            number=NUMBER, unit=unit, prefix=prefix
+        )
+        self.pattern = r"(?:{})\s*(?:{})".format(quantity, _alternation(CONNECTORS))
+        self.regex = re.compile(
+            r"(?P<number>{number})\s*度?\s*(?P<unit>{unit})"
+            r"|(?P<prefix>{prefix})\s*(?P<prefixed>{number})(?:\s*度)?"
+            r"|(?P<target>{unit})".format(number=NUMBER, unit=unit, prefix=prefix)
+        )
+
+    def __len__(self):
+        return len(self.aliases)
+
+    def lookup(self, alias):
+        return self.units[self.aliases[alias.lower()]]
+
+    def find(self, text):
+        """
+        The quantities of ``text`` in order, each with the unit to convert it
+        to. A unit standing alone is the target of the quantities of its
+        dimension before it, the others get the default of their unit.
+        """
+        quantities = []
+        for match in self.regex.finditer(text):
+            if match.group("target"):
+                target = self.lookup(match.group("target"))
+                for index, quantity in enumerate(quantities):
+                    if (
+                        quantity.target is None
+                        and quantity.unit.dimension == target.dimension
+                        and quantity.unit != target
+                    ):
+                        quantities[index] = quantity._replace(target=target)
+                continue
+
+            if len(quantities) == MAX_QUANTITIES:
+                break
+            number = match.group("number") or match.group("prefixed")
+            unit = self.lookup(match.group("unit") or match.group("prefix"))
+            quantities.append(
+                Quantity(float(number.replace(",", "")), unit, None, *match.span())
+            )
+
+        return [
+            (
+                quantity._replace(target=self.units[quantity.unit.default])
+                if quantity.target is None
+                else quantity
+            )
+            for quantity in quantities
+        ]
+
+    def convert(self, quantities):
+        return [
+            Conversion(
+                quantity,
+                quantity.target,
+                (
+                    quantity.value * quantity.unit.scale
+                    + quantity.unit.offset
+                    - quantity.target.offset
+                )
+                / quantity.target.scale,
+            )
+            for quantity in quantities
+        ]
+
+    def describe(self, value, unit):
+        number = format_number(value)
+        if unit.label.startswith("°"):
+            return number + unit.label
+        return "{} {}".format(number, unit.label)
+
+
+unit_table = UnitTable(UNITS)
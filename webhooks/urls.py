@@ -4,4 +4,7 @@ from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 
 from webhooks import views
 
-urlpatterns = [url(r"^callback/?", views.callback)]
+urlpatterns = [
+    url(r"^callback/?", views.callback),
+    url(r"^metrics/?$", views.metrics),
+]
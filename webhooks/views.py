@@ -1,15 +1,33 @@
+import logging
 from urllib.parse import parse_qsl
 
 from linebot.exceptions import InvalidSignatureError, LineBotApiError
-from linebot.models import MessageEvent, PostbackEvent, TextMessage, TextSendMessage
+from linebot.models import (
+    FollowEvent,
+    JoinEvent,
+    LeaveEvent,
+    MessageEvent,
+    PostbackEvent,
+    TextMessage,
+    TextSendMessage,
+    UnfollowEvent,
+)
 
 from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_GET, require_POST
 
 from webhooks.Parsers import TextGenerator
-from webhooks.line_api import handler, line_bot_api
-from webhooks.jobs import JOB_API
+from webhooks.audience import audience
+from webhooks.dedup import deduplicate
+from webhooks.dispatch import dispatch_webhook, get_conversation_key
+from webhooks.line_api import handler
+from webhooks.jobs import JOB_API, UnknownAction
+from webhooks.metrics import render
+from webhooks.outbound import answer
+from webhooks.state import ExpiredState
+
+logger = logging.getLogger(__name__)
 
 
 @csrf_exempt
@@ -18,7 +36,7 @@ def callback(request):
     signature = request.META["HTTP_X_LINE_SIGNATURE"]
     body = request.body.decode("utf-8")
     try:
-        handler.handle(body, signature)
+        dispatch_webhook(body, signature)
     except InvalidSignatureError as e:
         print(e.__class__, e.message)
         return HttpResponseForbidden()
@@ -29,35 +47,61 @@ def callback(request):
     return HttpResponse("Ok")
 
 
+@require_GET
+def metrics(request):
+    return HttpResponse(render(), content_type="text/plain; version=0.0.4")
+
+
 @handler.add(MessageEvent, message=TextMessage)
+@deduplicate
 def handle_text_message(event):
-    if event.source.type == "user":
-        text_generator = TextGenerator(event.message.text, user_id=event.source.user_id)
-    else:
-        text_generator = TextGenerator(
-            event.message.text,
-            user_id=event.source.user_id,
-            room_id=event.source.room_id,
-        )
-
-    message = text_generator.generate()
-    line_bot_api.reply_message(event.reply_token, message)
+    audience.record(event.source)
+    answer(event, build_text_reply(event))
 
 
 @handler.add(PostbackEvent)
+@deduplicate
 def handle_post_text_message(event):
-    key = "{}_{}".format(event.source.user_id, getattr(event.source, "room_id", ""))
+    audience.record(event.source)
+    answer(event, build_postback_reply(event))
+
+
+@handler.add(FollowEvent)
+@handler.add(JoinEvent)
+def handle_joined(event):
+    # the member may still be cached as added by a process that did not see
+    # it leave
+    audience.record(event.source, refresh=True)
+
+
+@handler.add(UnfollowEvent)
+@handler.add(LeaveEvent)
+def handle_gone(event):
+    # blocked or removed, a broadcast would only fail there
+    audience.forget(event.source)
+
+
+def build_text_reply(event):
+    # the key postbacks restore the flow state with
+    text_generator = TextGenerator(
+        event.message.text, key=get_conversation_key(event.source)
+    )
+    return text_generator.generate()
+
+
+def build_postback_reply(event):
+    key = get_conversation_key(event.source)
     data, func_name, woody_type = _handle_postback_data(event.postback)
-    api = JOB_API[woody_type](data=data, key=key)
-    func = "can_{}".format(func_name)
     try:
-        message = getattr(api, func)()
+        return JOB_API.dispatch(woody_type, func_name, data=data, key=key)
 
-    except AttributeError:
-        message = TextSendMessage(text="錯誤的訊息")
+    except UnknownAction as e:
+        logger.warning("unknown postback action %s", e)
+        return TextSendMessage(text="錯誤的訊息")
 
-    finally:
-        line_bot_api.reply_message(event.reply_token, message)
+    except ExpiredState as e:
+        logger.info("expired postback state %s", e)
+        return TextSendMessage(text="這個按鈕已經過期了，請重新輸入一次")
 
 
 def _handle_postback_data(postback):
@@ -67,4 +111,4 @@ def _handle_postback_data(postback):
 
     if getattr(postback, "params"):
         data["target_datetime"] = postback.params["datetime"]
-    return data, data.pop("action"), data.pop("type")
+    return data, data.pop("action", None), data.pop("type", None)
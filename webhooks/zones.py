@@ -0,0 +1,387 @@
+"""
+Place names to IANA zones, and datetimes between zones.
+
+Every name of the gazetteer goes into one trie shaped pattern and a dict, so
+finding the places of a message is a single scan and a lookup per mention no
+matter how many names there are. Conversions read the utc offset from the
+zone's transition table with a binary search, daylight saving included.
+"""
+
+import bisect
+import re
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import pytz
+
+from .router import trie_pattern
+
+CITY = 0
+COUNTRY = 1
+
+# city names of zones that are ordinary words too
+COMMON_WORDS = frozenset(
+    ["Christmas", "Easter", "Midway", "Oral", "Resolute", "Reunion", "Troll", "Wake"]
+)
+
+Place = namedtuple("Place", ["name", "zone", "country", "kind"])
+Mention = namedtuple("Mention", ["text", "place", "start", "end"])
+
+# (zone, country code, kind, names). A country points at the zone most of its
+# people live in, a city of the same country mentioned with it wins.
+GAZETTEER = [
+    ("Asia/Taipei", "TW", COUNTRY, ["台灣", "臺灣", "Taiwan", "Tai"]),
+    (
+        "Asia/Taipei",
+        "TW",
+        CITY,
+        [
+            "台北",
+            "臺北",
+            "Taipei",
+            "新北",
+            "台中",
+            "臺中",
+            "Taichung",
+            "台南",
+            "臺南",
+            "Tainan",
+        ],
+    ),
+    (
+        "Asia/Taipei",
+        "TW",
+        CITY,
+        ["高雄", "Kaohsiung", "桃園", "Taoyuan", "新竹", "Hsinchu"],
+    ),
+    ("Asia/Tokyo", "JP", COUNTRY, ["日本", "Japan"]),
+    ("Asia/Tokyo", "JP", CITY, ["東京", "Tokyo", "大阪", "Osaka", "京都", "Kyoto"]),
+    (
+        "Asia/Tokyo",
+        "JP",
+        CITY,
+        ["名古屋", "Nagoya", "札幌", "Sapporo", "福岡", "Fukuoka", "沖繩", "Okinawa"],
+    ),
+    ("Asia/Seoul", "KR", COUNTRY, ["韓國", "南韓", "Korea", "South Korea"]),
+    ("Asia/Seoul", "KR", CITY, ["首爾", "Seoul", "釜山", "Busan"]),
+    ("Asia/Shanghai", "CN", COUNTRY, ["中國", "大陸", "China"]),
+    (
+        "Asia/Shanghai",
+        "CN",
+        CITY,
+        [
+            "北京",
+            "Beijing",
+            "上海",
+            "Shanghai",
+            "廣州",
+            "Guangzhou",
+            "深圳",
+            "Shenzhen",
+        ],
+    ),
+    ("Asia/Hong_Kong", "HK", CITY, ["香港", "Hong Kong", "HK"]),
+    ("Asia/Macau", "MO", CITY, ["澳門", "Macau", "Macao"]),
+    ("Asia/Singapore", "SG", CITY, ["新加坡", "Singapore"]),
+    ("Asia/Kuala_Lumpur", "MY", COUNTRY, ["馬來西亞", "大馬", "Malaysia"]),
+    ("Asia/Kuala_Lumpur", "MY", CITY, ["吉隆坡", "Kuala Lumpur", "KL"]),
+    ("Asia/Bangkok", "TH", COUNTRY, ["泰國", "Thailand"]),
+    ("Asia/Bangkok", "TH", CITY, ["曼谷", "Bangkok", "清邁", "Chiang Mai"]),
+    ("Asia/Ho_Chi_Minh", "VN", COUNTRY, ["越南", "Vietnam"]),
+    (
+        "Asia/Ho_Chi_Minh",
+        "VN",
+        CITY,
+        ["胡志明市", "胡志明", "Ho Chi Minh", "Saigon", "河內", "Hanoi"],
+    ),
+    ("Asia/Manila", "PH", COUNTRY, ["菲律賓", "Philippines"]),
+    ("Asia/Manila", "PH", CITY, ["馬尼拉", "Manila"]),
+    ("Asia/Jakarta", "ID", COUNTRY, ["印尼", "Indonesia"]),
+    ("Asia/Jakarta", "ID", CITY, ["雅加達", "Jakarta"]),
+    ("Asia/Makassar", "ID", CITY, ["峇里島", "巴里島", "Bali"]),
+    ("Asia/Kolkata", "IN", COUNTRY, ["印度", "India"]),
+    (
+        "Asia/Kolkata",
+        "IN",
+        CITY,
+        ["新德里", "New Delhi", "Delhi", "孟買", "Mumbai", "班加羅爾", "Bangalore"],
+    ),
+    ("Asia/Dubai", "AE", COUNTRY, ["阿聯", "阿聯酋", "UAE"]),
+    ("Asia/Dubai", "AE", CITY, ["杜拜", "Dubai"]),
+    ("Asia/Jerusalem", "IL", COUNTRY, ["以色列", "Israel"]),
+    ("Europe/Istanbul", "TR", COUNTRY, ["土耳其", "Turkey"]),
+    ("Europe/Istanbul", "TR", CITY, ["伊斯坦堡", "Istanbul"]),
+    ("Europe/London", "GB", COUNTRY, ["英國", "UK", "England", "Britain"]),
+    (
+        "Europe/London",
+        "GB",
+        CITY,
+        ["倫敦", "London", "曼徹斯特", "Manchester", "愛丁堡", "Edinburgh"],
+    ),
+    ("Europe/Dublin", "IE", COUNTRY, ["愛爾蘭", "Ireland"]),
+    ("Europe/Dublin", "IE", CITY, ["都柏林", "Dublin"]),
+    ("Europe/Paris", "FR", COUNTRY, ["法國", "France"]),
+    ("Europe/Paris", "FR", CITY, ["巴黎", "Paris"]),
+    ("Europe/Berlin", "DE", COUNTRY, ["德國", "Germany"]),
+    (
+        "Europe/Berlin",
+        "DE",
+        CITY,
+        ["柏林", "Berlin", "慕尼黑", "Munich", "法蘭克福", "Frankfurt"],
+    ),
+    ("Europe/Amsterdam", "NL", COUNTRY, ["荷蘭", "Netherlands", "Holland"]),
+    ("Europe/Amsterdam", "NL", CITY, ["阿姆斯特丹", "Amsterdam"]),
+    ("Europe/Brussels", "BE", COUNTRY, ["比利時", "Belgium"]),
+    ("Europe/Zurich", "CH", COUNTRY, ["瑞士", "Switzerland"]),
+    ("Europe/Zurich", "CH", CITY, ["蘇黎世", "Zurich", "日內瓦", "Geneva"]),
+    ("Europe/Vienna", "AT", COUNTRY, ["奧地利", "Austria"]),
+    ("Europe/Vienna", "AT", CITY, ["維也納", "Vienna"]),
+    ("Europe/Rome", "IT", COUNTRY, ["義大利", "意大利", "Italy"]),
+    ("Europe/Rome", "IT", CITY, ["羅馬", "Rome", "米蘭", "Milan", "威尼斯", "Venice"]),
+    ("Europe/Madrid", "ES", COUNTRY, ["西班牙", "Spain"]),
+    ("Europe/Madrid", "ES", CITY, ["馬德里", "Madrid", "巴塞隆納", "Barcelona"]),
+    ("Europe/Lisbon", "PT", COUNTRY, ["葡萄牙", "Portugal"]),
+    ("Europe/Lisbon", "PT", CITY, ["里斯本", "Lisbon"]),
+    ("Europe/Prague", "CZ", COUNTRY, ["捷克", "Czech"]),
+    ("Europe/Prague", "CZ", CITY, ["布拉格", "Prague"]),
+    ("Europe/Stockholm", "SE", COUNTRY, ["瑞典", "Sweden"]),
+    ("Europe/Copenhagen", "DK", COUNTRY, ["丹麥", "Denmark"]),
+    ("Europe/Oslo", "NO", COUNTRY, ["挪威", "Norway"]),
+    ("Europe/Helsinki", "FI", COUNTRY, ["芬蘭", "Finland"]),
+    ("Europe/Athens", "GR", COUNTRY, ["希臘", "Greece"]),
+    ("Europe/Moscow", "RU", COUNTRY, ["俄羅斯", "Russia"]),
+    ("Europe/Moscow", "RU", CITY, ["莫斯科", "Moscow"]),
+    ("America/Los_Angeles", "US", COUNTRY, ["美國", "USA", "America"]),
+    (
+        "America/Los_Angeles",
+        "US",
+        CITY,
+        [
+            "洛杉磯",
+            "LA",
+            "Los Angeles",
+            "舊金山",
+            "San Francisco",
+            "SF",
+            "矽谷",
+            "Silicon Valley",
+        ],
+    ),
+    (
+        "America/Los_Angeles",
+        "US",
+        CITY,
+        ["西雅圖", "Seattle", "拉斯維加斯", "Las Vegas", "聖地牙哥", "San Diego"],
+    ),
+    ("America/Denver", "US", CITY, ["丹佛", "Denver", "鹽湖城", "Salt Lake City"]),
+    ("America/Phoenix", "US", CITY, ["鳳凰城", "Phoenix"]),
+    (
+        "America/Chicago",
+        "US",
+        CITY,
+        [
+            "芝加哥",
+            "Chicago",
+            "達拉斯",
+            "Dallas",
+            "休士頓",
+            "Houston",
+            "奧斯汀",
+            "Austin",
+        ],
+    ),
+    (
+        "America/New_York",
+        "US",
+        CITY,
+        [
+            "紐約",
+            "New York",
+            "NYC",
+            "波士頓",
+            "Boston",
+            "華盛頓",
+            "Washington",
+            "DC",
+            "邁阿密",
+            "Miami",
+        ],
+    ),
+    ("America/New_York", "US", CITY, ["亞特蘭大", "Atlanta", "費城", "Philadelphia"]),
+    ("Pacific/Honolulu", "US", CITY, ["夏威夷", "Hawaii", "檀香山", "Honolulu"]),
+    ("America/Anchorage", "US", CITY, ["阿拉斯加", "Alaska", "安克拉治", "Anchorage"]),
+    ("America/Toronto", "CA", COUNTRY, ["加拿大", "Canada"]),
+    (
+        "America/Toronto",
+        "CA",
+        CITY,
+        ["多倫多", "Toronto", "蒙特婁", "Montreal", "渥太華", "Ottawa"],
+    ),
+    ("America/Vancouver", "CA", CITY, ["溫哥華", "Vancouver"]),
+    ("America/Mexico_City", "MX", COUNTRY, ["墨西哥", "Mexico"]),
+    ("America/Sao_Paulo", "BR", COUNTRY, ["巴西", "Brazil"]),
+    ("America/Sao_Paulo", "BR", CITY, ["聖保羅", "Sao Paulo", "里約", "Rio"]),
+    ("America/Argentina/Buenos_Aires", "AR", COUNTRY, ["阿根廷", "Argentina"]),
+    ("America/Argentina/Buenos_Aires", "AR", CITY, ["布宜諾斯艾利斯", "Buenos Aires"]),
+    ("America/Santiago", "CL", COUNTRY, ["智利", "Chile"]),
+    ("America/Lima", "PE", COUNTRY, ["秘魯", "Peru"]),
+    ("Australia/Sydney", "AU", COUNTRY, ["澳洲", "澳大利亞", "Australia"]),
+    ("Australia/Sydney", "AU", CITY, ["雪梨", "悉尼", "Sydney", "坎培拉", "Canberra"]),
+    ("Australia/Melbourne", "AU", CITY, ["墨爾本", "Melbourne"]),
+    (
+        "Australia/Brisbane",
+        "AU",
+        CITY,
+        ["布里斯本", "Brisbane", "黃金海岸", "Gold Coast"],
+    ),
+    ("Australia/Perth", "AU", CITY, ["伯斯", "珀斯", "Perth"]),
+    ("Australia/Adelaide", "AU", CITY, ["阿德雷德", "Adelaide"]),
+    ("Pacific/Auckland", "NZ", COUNTRY, ["紐西蘭", "New Zealand"]),
+    ("Pacific/Auckland", "NZ", CITY, ["奧克蘭", "Auckland", "威靈頓", "Wellington"]),
+    ("Africa/Cairo", "EG", COUNTRY, ["埃及", "Egypt"]),
+    ("Africa/Johannesburg", "ZA", COUNTRY, ["南非", "South Africa"]),
+    ("Africa/Nairobi", "KE", COUNTRY, ["肯亞", "Kenya"]),
+    ("UTC", "", CITY, ["UTC", "GMT", "格林威治"]),
+]
+
+
+class Zone(object):
+    def __init__(self, name, transitions, offsets):
+        # offsets[i] is in force from the utc time transitions[i] on
+        self.name = name
+        self.transitions = transitions
+        self.offsets = offsets
+
+    @classmethod
+    def from_pytz(cls, name):
+        tz = pytz.timezone(name)
+        transitions = getattr(tz, "_utc_transition_times", None)
+        if not transitions:
+            return cls.fixed(name, tz.utcoffset(datetime(2000, 1, 1)))
+        return cls(name, list(transitions), [info[0] for info in tz._transition_info])
+
+    @classmethod
+    def fixed(cls, name, offset):
+        return cls(name, [datetime.min], [offset])
+
+    def utcoffset(self, utc):
+        index = bisect.bisect_right(self.transitions, utc) - 1
+        return self.offsets[max(index, 0)]
+
+    def from_utc(self, utc):
+        return utc + self.utcoffset(utc)
+
+    def to_utc(self, local):
+        # reading the table at the local time finds the offsets around it,
+        # the one that maps back onto the local time is the right one
+        offset = self.utcoffset(local)
+        utc = local - offset
+        actual = self.utcoffset(utc)
+        if actual != offset and self.utcoffset(local - actual) == actual:
+            return local - actual
+        return utc
+
+
+_zones = {}
+
+# no place on earth is further from utc
+MAX_OFFSET = timedelta(hours=14)
+
+
+def get_zone(name):
+    """
+    A zone by IANA name. Numbers are hour offsets, the way time zones were
+    passed around before there were names. Anything else, inf and nan or an
+    offset past 14 hours included, raises pytz's UnknownTimeZoneError.
+    """
+    zone = _zones.get(name)
+    if zone is None:
+        try:
+            offset = timedelta(hours=float(name))
+        except (ValueError, OverflowError):
+            offset = None
+        if offset is not None and abs(offset) <= MAX_OFFSET:
+            zone = Zone.fixed(name, offset)
+        else:
+            zone = Zone.from_pytz(name)
+        _zones[name] = zone
+    return zone
+
+
+def convert(local, from_zone, to_zones):
+    utc = get_zone(from_zone).to_utc(local)
+    return [get_zone(name).from_utc(utc) for name in to_zones]
+
+
+def _is_ascii(name):
+    return all(ord(char) < 128 for char in name)
+
+
+class Gazetteer(object):
+    def __init__(self, entries, zone_cities=True):
+        self.places = {}
+        for zone, country, kind, names in entries:
+            for name in names:
+                self.places.setdefault(name.lower(), Place(name, zone, country, kind))
+        if zone_cities:
+            self._add_zone_cities()
+
+        words = [name for name in self.places if not _is_ascii(name)]
+        latin = [name for name in self.places if _is_ascii(name)]
+        alternatives = []
+        if words:
+            alternatives.append(trie_pattern(words))
+        if latin:
+            # latin names have to stand alone, LA is not in "please"
+            alternatives.append(
+                "(?i:(?<![a-z]){}(?![a-z]))".format(trie_pattern(latin))
+            )
+        self.pattern = "|".join(alternatives) or "(?!)"
+        self.regex = re.compile(self.pattern)
+
+    def _add_zone_cities(self):
+        # only the canonical Area/City zones of a country name a city, the
+        # aliases like US/Eastern and the Indiana/Knox kind of counties and
+        # towns would make ordinary words places
+        for country, zones in sorted(pytz.country_timezones.items()):
+            for zone in zones:
+                if zone.count("/") != 1:
+                    continue
+                name = zone.split("/")[1].replace("_", " ")
+                if name in COMMON_WORDS:
+                    continue
+                self.places.setdefault(name.lower(), Place(name, zone, country, CITY))
+
+    def __len__(self):
+        return len(self.places)
+
+    def lookup(self, name):
+        return self.places.get(name.lower())
+
+    def find(self, text):
+        return [
+            Mention(match.group(), self.lookup(match.group()), *match.span())
+            for match in self.regex.finditer(text)
+        ]
+
+    def pick(self, mentions):
+        """
+        The distinct zones of ``mentions`` in the order they were mentioned.
+        A country is left out when one of its cities is there too.
+        """
+        cities = set(
+            mention.place.country for mention in mentions if mention.place.kind == CITY
+        )
+        picked = []
+        zones = set()
+        for mention in sorted(mentions, key=lambda mention: mention.start):
+            place = mention.place
+            if place.kind == COUNTRY and place.country in cities:
+                continue
+            if place.zone not in zones:
+                zones.add(place.zone)
+                picked.append(mention)
+        return picked
+
+
+gazetteer = Gazetteer(GAZETTEER)